@@ -1,16 +1,21 @@
 from pathlib import Path
 
-from enaml.icon import Icon, IconImage
-from enaml.image import Image
-
 from .version import __version__
 
 
 def load_icon():
+    from enaml.icon import Icon, IconImage
+    from enaml.image import Image
     path = Path(__file__).parent / 'abr-icon.png'
     image = Image(data=path.read_bytes())
     icon_image = IconImage(image=image)
     return Icon(images=[icon_image])
 
 
-main_icon = load_icon()
+def __getattr__(name):
+    # The icon is loaded on first access so that importing the package (e.g.,
+    # for the command-line tools that do not need a GUI) does not import enaml.
+    if name == 'main_icon':
+        globals()['main_icon'] = icon = load_icon()
+        return icon
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -14,7 +14,89 @@ mp.rcParams['figure.subplot.right'] = 0.8
 mp.rcParams['figure.subplot.bottom'] = 0.1
 mp.rcParams['figure.subplot.top'] = 0.8
 
+from matplotlib.lines import Line2D
 from matplotlib.pylab import setp
+from matplotlib import transforms as T
+import numpy as np
+
+from abr import timing
+
+
+def decimate_minmax(x, y, n_bins):
+    '''
+    Reduce trace to the minimum and maximum of each bin
+
+    The samples are split into `n_bins` bins of equal size and only the
+    samples at the minimum and maximum of each bin (in the order they were
+    acquired) and the first and last sample are kept. When each bin is drawn
+    in a single pixel column, the decimated trace looks the same as the full
+    trace (including the extrema) but has at most `2 * n_bins + 2` points.
+
+    Returns
+    -------
+    x : 1D array
+    y : 1D array
+        Decimated trace (the input arrays if no decimation is needed).
+    '''
+    n = len(y)
+    if n_bins < 1 or n <= 2 * n_bins + 2:
+        return x, y
+    size = int(np.ceil(n / n_bins))
+    m = n // size
+    bins = y[:m*size].reshape((m, size))
+    offset = np.arange(m) * size
+    i = np.stack([bins.argmin(axis=1), bins.argmax(axis=1)], axis=1)
+    i.sort(axis=1)
+    indices = [[0], (i + offset[:, np.newaxis]).ravel()]
+    if m * size < n:
+        tail = y[m*size:]
+        indices.append(np.sort([tail.argmin(), tail.argmax()]) + m * size)
+    indices.append([n-1])
+    i = np.unique(np.concatenate(indices))
+    return x[i], y[i]
+
+
+class DecimatedLine(Line2D):
+    '''
+    Line that only draws as many points as there are pixels to draw them in
+
+    The full trace is reduced (see `decimate_minmax`) to one bin per pixel
+    column (scaled by the zoom so that the visible part of the trace keeps the
+    same resolution) when the line is drawn. The decimated trace is cached
+    until the trace, the width of the axes or the zoom changes, so the cost of
+    redrawing depends on the size of the axes rather than the number of
+    samples. The first and last samples are always kept, so the data limits
+    of the line are the same as for the full trace.
+    '''
+
+    def __init__(self, x, y, **kwargs):
+        super().__init__(x, y, **kwargs)
+        self.set_full_data(x, y)
+
+    def set_full_data(self, x, y):
+        self._x_full = np.asarray(x)
+        self._y_full = np.asarray(y)
+        self._n_bins = None
+        self.set_data(self._x_full, self._y_full)
+
+    def get_full_data(self):
+        return self._x_full, self._y_full
+
+    def _get_n_bins(self):
+        x = self._x_full
+        if self.axes is None or len(x) < 2:
+            return 0
+        view = self.axes.viewLim.intervalx
+        span = abs(x[-1] - x[0])
+        zoom = span / abs(view[1] - view[0]) if view[1] != view[0] else 1
+        return int(np.ceil(self.axes.bbox.width * max(zoom, 1)))
+
+    def draw(self, renderer):
+        n_bins = self._get_n_bins()
+        if n_bins != self._n_bins:
+            self.set_data(*decimate_minmax(self._x_full, self._y_full, n_bins))
+            self._n_bins = n_bins
+        super().draw(renderer)
 
 
 class StylePlot:
@@ -148,10 +230,12 @@ class WaveformPlot(StylePlot):
         self.point_plots = {}
         self.transform = transform
 
-        # Create the plot
-        self.plot, = self.axis.plot(self.waveform.x, self.waveform.y, 'k-',
-                                    transform=transform, clip_on=False,
-                                    picker=10)
+        # Create the plot. Points are placed using the full waveform, only the
+        # trace that is drawn is decimated.
+        self.plot = DecimatedLine(self.waveform.x, self.waveform.y, color='k',
+                                  linestyle='-', transform=transform,
+                                  clip_on=False, picker=10)
+        self.axis.add_line(self.plot)
         self.update()
 
     STYLE = {
@@ -161,6 +245,29 @@ class WaveformPlot(StylePlot):
         (False, False): SUBTH_PLOT,
     }
 
+    def set_waveform(self, waveform):
+        '''
+        Reuse the plot (and the plots of the points) for another waveform
+        '''
+        self.waveform = waveform
+        self.current = False
+        for point_plot in self.point_plots.values():
+            point_plot.current = False
+        self.plot.set_full_data(waveform.x, waveform.y)
+        self.update()
+
+    def remove(self):
+        for point_plot in self.point_plots.values():
+            point_plot.remove()
+        self.point_plots = {}
+        self.plot.remove()
+
+    def update_signal(self):
+        '''
+        Redraw the waveform after its signal has been replaced
+        '''
+        self.plot.set_full_data(self.waveform.x, self.waveform.y)
+
     def get_style(self):
         style = self.current, self.waveform.is_suprathreshold()
         return self.STYLE[style]
@@ -183,3 +290,125 @@ class WaveformPlot(StylePlot):
             p.update()
 
         super().update()
+
+
+class SeriesPlot:
+    '''
+    Stack of waveforms drawn on an axes
+
+    The artists (and the transforms used to scale and offset each waveform)
+    are kept when the next series is loaded and are updated in place. Artists
+    are only created or removed when the number of levels changes.
+
+    Parameters
+    ----------
+    axes : matplotlib.axes.Axes
+        Axes to draw on.
+    '''
+
+    def __init__(self, axes):
+        self.axes = axes
+        self.plots = []
+        self.texts = []
+        self._translates = []
+
+        self._bscale_in_box = T.Bbox([[0, -1], [1, 1]])
+        bscale_out_box = T.Bbox([[0, -1], [1, 1]])
+        tscale_in_box = T.Bbox([[0, -1], [1, 1]])
+        self._tscale_out_box = T.Bbox([[0, 0], [1, 1]])
+        minmax_in_box = T.Bbox([[0, 0], [1, 1]])
+        minmax_out_box = T.Bbox([[0, 0], [1, 1]])
+
+        self._bscale = T.BboxTransformFrom(self._bscale_in_box) + \
+            T.BboxTransformTo(bscale_out_box)
+        self._tscale = T.BboxTransformFrom(tscale_in_box) + \
+            T.BboxTransformTo(self._tscale_out_box)
+        self._minmax = T.BboxTransformFrom(minmax_in_box) + \
+            T.BboxTransformTo(minmax_out_box) + \
+            axes.transAxes
+
+        self.boxes = {
+            'tscale': tscale_in_box,
+            'tnorm': [],
+            'norm_limits': np.empty((0, 2)),
+            'base_scale': np.nan,
+            'minmax': minmax_out_box,
+        }
+
+        axes.set_yticks([])
+        axes.grid()
+        for spine in ('top', 'left', 'right'):
+            axes.spines[spine].set_visible(False)
+
+    def _add_level(self, waveform):
+        tnorm_in_box = T.Bbox([[0, -1], [1, 1]])
+        tnorm_out_box = T.Bbox([[0, -1], [1, 1]])
+        tnorm_in = T.BboxTransformFrom(tnorm_in_box)
+        tnorm_out = T.BboxTransformTo(tnorm_out_box)
+        translate = T.Affine2D()
+
+        y_trans = self._bscale + tnorm_in + tnorm_out + self._tscale + \
+            translate + self._minmax
+        trans = T.blended_transform_factory(self.axes.transData, y_trans)
+        text_trans = T.blended_transform_factory(self.axes.transAxes, y_trans)
+
+        self.plots.append(WaveformPlot(waveform, self.axes, trans))
+        self.texts.append(self.axes.text(-0.05, 0, '', transform=text_trans))
+        self._translates.append(translate)
+        self.boxes['tnorm'].append(tnorm_in_box)
+
+    def _remove_level(self):
+        self.plots.pop().remove()
+        self.texts.pop().remove()
+        self._translates.pop()
+        self.boxes['tnorm'].pop()
+
+    @timing.timed('SeriesPlot.load')
+    def load(self, model):
+        '''
+        Draw the series, reusing the artists from the previous series
+
+        Returns
+        -------
+        plots : list of WaveformPlot
+            Plot for each waveform (in the same order as the waveforms).
+        boxes : dict
+            Boxes controlling the scale and normalization of the waveforms.
+        '''
+        n = len(model.waveforms)
+        offset_step = 1/(n+1)
+
+        limits = np.array([(w.y.min(), w.y.max()) for w in model.waveforms])
+        base_scale = np.mean(np.abs(limits))
+
+        # Reset the scale and limits since the boxes are shared by all series.
+        self._bscale_in_box.set_points(
+            np.array([[0, -base_scale], [1, base_scale]]))
+        self._tscale_out_box.set_points(np.array([[0, 0], [1, offset_step]]))
+        self.boxes['tscale'].set_points(np.array([[0, -1], [1, 1]]))
+        self.boxes['minmax'].set_points(np.array([[0, 0], [1, 1]]))
+
+        while len(self.plots) > n:
+            self._remove_level()
+        for i, waveform in enumerate(model.waveforms):
+            if i < len(self.plots):
+                self.plots[i].set_waveform(waveform)
+            else:
+                self._add_level(waveform)
+            self.boxes['tnorm'][i].set_points(np.array([[0, -1], [1, 1]]))
+            offset = offset_step * i + offset_step * 0.5
+            self._translates[i].clear().translate(0, offset)
+            self.texts[i].set_text(f'{waveform.level}')
+
+        self.boxes['norm_limits'] = limits/base_scale
+        self.boxes['base_scale'] = base_scale
+
+        # Lines that were reused do not update the data limits.
+        self.axes.relim()
+        self.axes.autoscale_view()
+        return list(self.plots), self.boxes
+
+
+@timing.timed('plot_model')
+def plot_model(axes, model):
+    return SeriesPlot(axes).load(model)
@@ -0,0 +1,312 @@
+'''
+Deterministic benchmarks for loading, peak guessing and rendering
+
+Synthetic studies of a configurable size are generated in a temporary
+directory using a fixed seed so that results are comparable across runs and
+versions. Each benchmark reports the median time, throughput and peak memory.
+Results can be saved as a baseline and later runs compared against it to catch
+regressions.
+'''
+import argparse
+import json
+from pathlib import Path
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from abr.main import P_LATENCY_PARAMS
+
+
+FILTER_SETTINGS = {'highpass': 300, 'lowpass': 3000, 'order': 1}
+
+
+def synthetic_waveforms(levels, n_samples, fs, rng):
+    '''
+    Generate level x time matrix (in V) of ABR-like waveforms with a threshold
+    of 30 dB SPL
+    '''
+    t = np.arange(n_samples) / fs * 1e3
+    levels = np.asarray(levels, dtype=float)[:, np.newaxis]
+    amplitude = np.clip(levels - 30, 0, None) / 50
+    waveforms = np.zeros((len(levels), n_samples))
+    for i, latency in enumerate([1.5, 2.6, 3.4, 4.2, 5.4]):
+        latency = latency + 0.02 * (80 - levels)
+        sign = 1 if i % 2 == 0 else 0.6
+        waveforms += sign * amplitude * np.exp(-((t - latency) / 0.15) ** 2)
+    waveforms += rng.normal(0, 0.05, waveforms.shape)
+    return t, waveforms * 1e-6
+
+
+def make_psi_study(path, n_collections=4, frequencies=(8000, 16000),
+                   levels=range(10, 85, 5), n_samples=213, fs=25e3, seed=0):
+    '''
+    Create study containing synthetic psiexperiment ABR runs
+    '''
+    rng = np.random.default_rng(seed)
+    path = Path(path)
+    for c in range(n_collections):
+        collection = path / f'animal{c} abr_io'
+        collection.mkdir(parents=True, exist_ok=True)
+        header_freq = []
+        header_level = []
+        data = []
+        for frequency in frequencies:
+            t, w = synthetic_waveforms(levels, n_samples, fs, rng)
+            header_freq.extend([frequency] * len(w))
+            header_level.extend(levels)
+            data.append(w)
+        data = np.concatenate(data).T
+        t = t * 1e-3
+        filename = collection / 'ABR average waveforms.csv'
+        with filename.open('w') as fh:
+            fh.write('frequency,' + ','.join(str(f) for f in header_freq) + '\n')
+            fh.write('level,' + ','.join(str(l) for l in header_level) + '\n')
+            fh.write('epoch_n,' + ','.join('512' for _ in header_freq) + '\n')
+            fh.write('time' + ',' * len(header_freq) + '\n')
+            np.savetxt(fh, np.c_[t, data], delimiter=',', fmt='%.6e')
+        settings = collection / 'ABR processing settings.json'
+        settings.write_text(json.dumps({'actual_fs': fs}))
+    return path
+
+
+def make_epl_file(filename, levels=range(10, 85, 5), n_samples=850, fs=1e5,
+                  frequency=16, seed=0):
+    '''
+    Create synthetic EPL CFTS ABR file
+    '''
+    rng = np.random.default_rng(seed)
+    _, w = synthetic_waveforms(levels, n_samples, fs, rng)
+    levels = ';'.join(str(l) for l in levels)
+    header = f':RUN-3\tLEVEL SWEEP\tSW FREQ: {frequency:.2f}\t' \
+        f'SAMPLE (usec): {1e6/fs:.0f}\t:LEVELS:{levels};:DATA'
+    with open(filename, 'w', encoding='ISO-8859-1') as fh:
+        fh.write(header + '\n')
+        np.savetxt(fh, w.T * 1e6, fmt='%.6f', delimiter='\t')
+    return filename
+
+
+class Benchmark:
+
+    def __init__(self, name, func, n_items, setup=None):
+        self.name = name
+        self.func = func
+        self.n_items = n_items
+        self.setup = setup
+
+    def run(self, repeat):
+        times = []
+        for _ in range(repeat):
+            if self.setup is not None:
+                self.setup()
+            start = time.perf_counter()
+            self.func()
+            times.append(time.perf_counter() - start)
+
+        # Memory is measured in a separate pass since tracemalloc adds
+        # considerable overhead.
+        if self.setup is not None:
+            self.setup()
+        tracemalloc.start()
+        self.func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        median = statistics.median(times)
+        return {
+            'time': median,
+            'throughput': self.n_items / median,
+            'peak_memory': peak / 1e6,
+            'n_items': self.n_items,
+        }
+
+
+def build_benchmarks(path, n_collections, frequencies, levels, n_samples,
+                     seed=0):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from abr import priors
+    from abr.parsers import Parser, PSI, EPL
+    from abr.abrpanel import SeriesPlot, plot_model
+
+    study = make_psi_study(path / 'study', n_collections, frequencies, levels,
+                           n_samples, seed=seed)
+    epl_files = []
+    for c in range(n_collections):
+        filename = path / 'epl' / f'ABR-{c}-1'
+        filename.parent.mkdir(exist_ok=True)
+        epl_files.append(make_epl_file(filename, levels, seed=seed + c))
+
+    latencies = {w: priors.norm(*p) for w, p in P_LATENCY_PARAMS.items()}
+    parser = Parser('PSI', FILTER_SETTINGS, 'benchmark')
+    datasets = list(parser.iter_all(study))
+    filenames = [ds.filename for ds in datasets]
+    n_datasets = len(datasets)
+    n_waveforms = n_datasets * len(levels)
+    state = {}
+
+    def clear_cache():
+        PSI._read_file.cache_clear()
+
+    def reset_datasets():
+        # The collections cache the data they have read, so new collections
+        # are needed for each repetition to measure loading from disk.
+        # Scanning would read the data, so they are created directly.
+        clear_cache()
+        collections = {}
+        for i, ds in enumerate(datasets):
+            filename = ds.parent.filename
+            if filename not in collections:
+                collections[filename] = PSI.PSIDataCollection(filename)
+            datasets[i] = PSI.PSIDataset(collections[filename], ds.frequency)
+
+    def read_files():
+        for filename in set(filenames):
+            PSI.read_file(filename)
+
+    def load_epl():
+        for filename in epl_files:
+            EPL.load(filename, FILTER_SETTINGS)
+
+    def get_series():
+        state['series'] = [parser.load(ds) for ds in datasets]
+
+    def guess_p():
+        for series in state['series']:
+            series.clear_points()
+            series.guess_p(latencies)
+
+    def guess_n():
+        for series in state['series']:
+            series.clear_valleys()
+            series.guess_n()
+
+    def save():
+        for series in state['series']:
+            series.threshold = 30
+            parser.save(series)
+
+    def load_analyses():
+        parser.load_analyses(study)
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_axes([0.1, 0.1, 0.8, 0.8])
+
+    def render():
+        for series in state['series']:
+            axes.clear()
+            state['plots'], _ = plot_model(axes, series)
+            figure.canvas.draw()
+
+    def render_pooled():
+        axes.clear()
+        series_plot = SeriesPlot(axes)
+        for series in state['series']:
+            state['plots'], _ = series_plot.load(series)
+            figure.canvas.draw()
+
+    def redraw():
+        for _ in range(n_datasets):
+            for p in state['plots']:
+                p.update()
+            figure.canvas.draw()
+
+    get_series()
+    guess_p()
+
+    return [
+        Benchmark('read_file', read_files, len(set(filenames)), clear_cache),
+        Benchmark('EPL.load', load_epl, len(epl_files)),
+        Benchmark('get_series', get_series, n_datasets, reset_datasets),
+        Benchmark('guess_p', guess_p, n_waveforms),
+        Benchmark('guess_n', guess_n, n_waveforms),
+        Benchmark('save', save, n_datasets),
+        Benchmark('load_analyses', load_analyses, n_datasets),
+        Benchmark('plot_model', render, n_datasets),
+        Benchmark('SeriesPlot.load', render_pooled, n_datasets),
+        Benchmark('redraw', redraw, n_datasets),
+    ]
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare results against baseline
+
+    Returns
+    -------
+    regressions : list of str
+        Names of benchmarks whose time increased by more than `tolerance`
+        (fraction) relative to the baseline.
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result['time'] / baseline[name]['time'] - 1
+        result['change'] = change
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def format_results(results):
+    lines = [f'{"benchmark":<16}{"time (s)":>12}{"items/s":>12}'
+             f'{"peak (MB)":>12}{"change":>10}']
+    for name, r in results.items():
+        change = r.get('change')
+        change = '' if change is None else f'{change:+.1%}'
+        lines.append(f'{name:<16}{r["time"]:>12.4f}{r["throughput"]:>12.1f}'
+                     f'{r["peak_memory"]:>12.2f}{change:>10}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser('abr-benchmark')
+    parser.add_argument('--collections', type=int, default=4,
+                        help='Number of collections (e.g., animals)')
+    parser.add_argument('--frequencies', type=float, nargs='+',
+                        default=[8000, 16000], help='Frequencies (Hz)')
+    parser.add_argument('--levels', type=int, default=15,
+                        help='Number of levels (starting at 10 dB SPL in 5 dB '
+                        'steps)')
+    parser.add_argument('--samples', type=int, default=213,
+                        help='Number of samples per waveform')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', help='Benchmarks to run')
+    parser.add_argument('--baseline', help='Baseline to compare against')
+    parser.add_argument('--save-baseline', help='Save results as baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fractional increase in time that is considered '
+                        'a regression')
+    args = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+    levels = list(range(10, 10 + 5 * args.levels, 5))
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        benchmarks = build_benchmarks(Path(path), args.collections,
+                                      args.frequencies, levels, args.samples,
+                                      args.seed)
+        for benchmark in benchmarks:
+            if args.only and benchmark.name not in args.only:
+                continue
+            results[benchmark.name] = benchmark.run(args.repeat)
+
+    regressions = []
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = compare(results, baseline['results'], args.tolerance)
+
+    print(format_results(results))
+    if args.save_baseline:
+        baseline = {'settings': vars(args), 'results': results}
+        Path(args.save_baseline).write_text(json.dumps(baseline, indent=2))
+    if regressions:
+        print(f'Regressions: {", ".join(regressions)}')
+        raise SystemExit(1)
@@ -0,0 +1,236 @@
+'''
+Bootstrap confidence intervals for threshold using the individual epochs
+
+The epochs are streamed from disk in chunks and reduced into running sums so
+that the full epoch array never needs to be loaded. Resampling uses the Poisson
+bootstrap (in each replicate, every epoch is weighted by a draw from a Poisson
+distribution with a mean of 1), which can be computed in a single pass over
+the epochs and yields partial results that can be merged.
+
+The response-vs-noise statistic for each level is the RMS of the average in
+the response window divided by the RMS of the plus-minus average (the average
+computed after inverting every other epoch, which cancels the response and
+leaves an estimate of the residual noise).
+'''
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .parsers.dataset import filter_data
+from .threshold import fit_threshold, rms
+
+
+class EpochReducer:
+    '''
+    Streaming reduction of epochs into the average, the plus-minus average and
+    the Poisson bootstrap replicates of each.
+
+    Even and odd epochs are accumulated separately so that the plus-minus
+    average (half the difference between the average of the even and odd
+    epochs) fully cancels the response in each bootstrap replicate.
+
+    Parameters
+    ----------
+    n_samples : int
+        Number of samples in each epoch.
+    n_boot : int
+        Number of bootstrap replicates.
+    rng : {None, int, numpy.random.Generator}
+        Random number generator (or seed) for the bootstrap weights.
+    '''
+
+    def __init__(self, n_samples, n_boot=500, rng=None):
+        self.rng = np.random.default_rng(rng)
+        self.n = 0
+        # The first axis of each array is even, odd epochs.
+        self.count = np.zeros(2)
+        self.total = np.zeros((2, n_samples))
+        self.boot_count = np.zeros((2, n_boot))
+        self.boot_total = np.zeros((2, n_boot, n_samples))
+
+    def update(self, epochs):
+        n_boot = self.boot_count.shape[-1]
+        parity = (np.arange(len(epochs)) + self.n) % 2
+        self.n += len(epochs)
+        for i in (0, 1):
+            e = epochs[parity == i]
+            weights = self.rng.poisson(1, (n_boot, len(e))).astype(float)
+            self.count[i] += len(e)
+            self.total[i] += e.sum(axis=0)
+            self.boot_count[i] += weights.sum(axis=1)
+            self.boot_total[i] += weights @ e
+
+    def merge(self, other):
+        # Parity of the other reducer is relative to its own first epoch.
+        order = [0, 1] if (self.n % 2 == 0) else [1, 0]
+        self.n += other.n
+        self.count += other.count[order]
+        self.total += other.total[order]
+        self.boot_count += other.boot_count[order]
+        self.boot_total += other.boot_total[order]
+
+    def _reduce(self, count, total):
+        count = count[..., np.newaxis]
+        average = total.sum(axis=0) / count.sum(axis=0)
+        average_pm = (total[0] / count[0] - total[1] / count[1]) / 2
+        return average, average_pm
+
+    def get_average(self):
+        '''
+        Return average and plus-minus average of the epochs
+        '''
+        return self._reduce(self.count, self.total)
+
+    def get_bootstrap(self):
+        '''
+        Return bootstrap replicates (replicate x time) of the average and
+        plus-minus average of the epochs
+        '''
+        return self._reduce(self.boot_count, self.boot_total)
+
+
+def response_noise_ratio(x, average, average_pm, window=(1, 7)):
+    lb, ub = window
+    mask = (x >= lb) & (x <= ub)
+    return rms(average[..., mask]) / rms(average_pm[..., mask])
+
+
+def bootstrap_threshold(dataset, filter_settings=None, criterion=2,
+                        window=(1, 7), n_boot=500, ci=0.95, chunk_size=256,
+                        rng=None):
+    '''
+    Estimate threshold and its bootstrap confidence interval from the epochs
+
+    Parameters
+    ----------
+    dataset : Dataset
+        Dataset to analyze. Must support `get_epochs`.
+    filter_settings : {None, dict}
+        Filter to apply to the averages (see `Parser`).
+    criterion : float
+        Response-to-noise ratio that defines threshold.
+    window : tuple of float
+        Response window (msec).
+    n_boot : int
+        Number of bootstrap replicates.
+    ci : float
+        Width of the confidence interval.
+    chunk_size : int
+        Number of epochs to read from disk at a time.
+    rng : {None, int, numpy.random.Generator}
+        Random number generator (or seed) for the bootstrap weights.
+
+    Returns
+    -------
+    threshold : float
+        Threshold estimated from all epochs.
+    threshold_ci : tuple of float
+        Lower and upper bound of the percentile confidence interval for
+        threshold. Replicates in which the fit failed are excluded. Replicates
+        in which all levels are subthreshold have a threshold of inf.
+    ratio : pandas.DataFrame
+        Response-to-noise ratio for each level along with the lower and upper
+        bound of the percentile confidence interval. Resampling adds noise to
+        both the average and the plus-minus average, so the replicates of the
+        ratio tend to fall below the ratio computed from all epochs.
+    '''
+    rng = np.random.default_rng(rng)
+    epochs = dataset.get_epochs()
+    x = epochs.time
+
+    # All levels are reduced in a single pass through the epochs.
+    reducers = {}
+    for chunk_levels, chunk in epochs.iter_chunks(dataset.frequency,
+                                                  chunk_size=chunk_size):
+        for level in np.unique(chunk_levels):
+            if level not in reducers:
+                reducers[level] = EpochReducer(epochs.n_samples, n_boot, rng)
+            reducers[level].update(chunk[chunk_levels == level])
+    levels = np.array(sorted(reducers))
+    average = [reducers[l].get_average() for l in levels]
+    boot = [reducers[l].get_bootstrap() for l in levels]
+
+    # Stack into (average, plus-minus) x [replicate] x level x time. Filtering
+    # is linear, so filtering the averages is equivalent to filtering each
+    # epoch.
+    average = filter_data(np.stack(average, axis=1), dataset.fs,
+                          filter_settings)
+    boot = filter_data(np.stack(boot, axis=2), dataset.fs, filter_settings)
+
+    ratio = response_noise_ratio(x, *average, window=window)
+    boot_ratio = response_noise_ratio(x, *boot, window=window)
+
+    threshold, _ = fit_threshold(levels, ratio, criterion)
+    boot_threshold = [fit_threshold(levels, r, criterion)[0] \
+                      for r in boot_ratio]
+    boot_threshold = np.sort(np.array(boot_threshold))
+    boot_threshold = boot_threshold[~np.isnan(boot_threshold)]
+
+    alpha = (1 - ci) / 2
+    if len(boot_threshold):
+        i_lb = int(np.floor(alpha * (len(boot_threshold) - 1)))
+        i_ub = int(np.ceil((1 - alpha) * (len(boot_threshold) - 1)))
+        threshold_ci = boot_threshold[i_lb], boot_threshold[i_ub]
+    else:
+        threshold_ci = np.nan, np.nan
+
+    ratio = pd.DataFrame({
+        'ratio': ratio,
+        'lower': np.nanquantile(boot_ratio, alpha, axis=0),
+        'upper': np.nanquantile(boot_ratio, 1 - alpha, axis=0),
+    }, index=pd.Index(levels, name='level'))
+    return threshold, threshold_ci, ratio
+
+
+def _bootstrap_dataset(args):
+    dataset, filter_settings, kwargs = args
+    try:
+        threshold, (lower, upper), _ = bootstrap_threshold(
+            dataset, filter_settings, **kwargs)
+    except (NotImplementedError, IOError):
+        # The epochs were not saved (or the format does not support them).
+        return None
+    return threshold, lower, upper
+
+
+def bootstrap_study(parser, paths, max_workers=None, **kwargs):
+    '''
+    Estimate the threshold and its bootstrap confidence interval for all
+    datasets that have epochs
+
+    Parameters
+    ----------
+    parser : Parser
+        Parser used to find the datasets.
+    paths : list
+        Directories to scan.
+    max_workers : {None, int}
+        Number of processes. If 1, datasets are analyzed in this process.
+    **kwargs
+        Passed to `bootstrap_threshold`.
+
+    Returns
+    -------
+    thresholds : pandas.DataFrame
+        Threshold and lower and upper bound of the confidence interval indexed
+        by collection name and frequency.
+    '''
+    datasets = [ds for path in paths for ds in parser.iter_all(path)]
+    tasks = [(ds, parser._filter_settings, kwargs) for ds in datasets]
+    if max_workers == 1:
+        results = map(_bootstrap_dataset, tasks)
+    else:
+        with ProcessPoolExecutor(max_workers) as executor:
+            results = list(executor.map(_bootstrap_dataset, tasks))
+
+    keys, rows = [], []
+    for ds, result in zip(datasets, results):
+        if result is not None:
+            keys.append((ds.parent.name, ds.frequency))
+            rows.append(result)
+    names = ['name', 'frequency']
+    index = pd.MultiIndex.from_tuples(keys, names=names) if keys \
+        else pd.MultiIndex.from_arrays([[]] * len(names), names=names)
+    return pd.DataFrame(rows, index=index,
+                        columns=['threshold', 'lower', 'upper'])
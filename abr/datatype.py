@@ -4,6 +4,7 @@ Collection of classes for handling common data types
 from enum import Enum
 import functools
 import operator
+import re
 
 import numpy as np
 import pandas as pd
@@ -12,7 +13,13 @@ from scipy import signal
 from atom.api import Atom, Bool, Int, Typed, Value
 
 from .peakdetect import (generate_latencies_bound, generate_latencies_skewnorm,
-                         guess, guess_iter, peak_iterator)
+                         get_candidates, guess, guess_iter, guess_peaks,
+                         peak_iterator)
+from .threshold import estimate_threshold
+
+
+#: Latency column of a point in a saved analysis (e.g., "P1 Latency").
+P_LATENCY_COLUMN = re.compile(r'([PN])(\d+) Latency$')
 
 
 @functools.total_ordering
@@ -35,6 +42,30 @@ class ABRWaveform:
         self.level = level
         self.points = {}
         self.series = None
+        self._y = None
+        # Candidate peaks (see `peakdetect.get_candidates`)
+        self.candidates = {}
+
+    def copy(self):
+        '''
+        Return new waveform that shares the signal (and data derived from the
+        signal) with this waveform but has its own points. The signal is
+        treated as read-only.
+        '''
+        waveform = ABRWaveform(self.fs, self.signal, self.level)
+        waveform._y = self.y
+        waveform.candidates = self.candidates
+        return waveform
+
+    def set_signal(self, signal):
+        '''
+        Replace signal (e.g., as a live average is updated) and discard the
+        data derived from the old signal
+        '''
+        self.signal = signal
+        self._y = None
+        # Do not clear the dict since it may be shared with copies.
+        self.candidates = {}
 
     @property
     def x(self):
@@ -42,7 +73,9 @@ class ABRWaveform:
 
     @property
     def y(self):
-        return signal.detrend(self.signal.values)
+        if self._y is None:
+            self._y = signal.detrend(self.signal.values)
+        return self._y
 
     def is_subthreshold(self):
         if self.series.threshold is None or np.isnan(self.series.threshold):
@@ -94,15 +127,16 @@ class ABRWaveform:
             if ptype == Point.VALLEY:
                 del self.points[wave, ptype]
 
+    def _guess_index(self, wave_guess):
+        index = wave_guess.get('index', np.nan)
+        if not np.isfinite(index):
+            index = np.abs(self.x - wave_guess['x']).argmin()
+            return np.clip(index, 0, len(self.x)-1)
+        return int(index)
+
     def _set_points(self, guesses, ptype):
         for wave, wave_guess in guesses.iterrows():
-            index = wave_guess.get('index', np.nan)
-            if not np.isfinite(index):
-                index = np.abs(self.x - wave_guess['x']).argmin()
-                index = np.clip(index, 0, len(self.x)-1)
-            else:
-                index = int(index)
-            self.set_point(wave, ptype, index)
+            self.set_point(wave, ptype, self._guess_index(wave_guess))
 
 
 class WaveformPoint(Atom):
@@ -119,18 +153,24 @@ class WaveformPoint(Atom):
     unscorable = Bool(False)
 
     def __init__(self, parent, index, wave_number, point_type):
-        # Order of setting attributes is important here
         self.parent = parent
         self.point_type = point_type
         self.wave_number = wave_number
-        invert = self.is_valley()
-        iterator = peak_iterator(parent, index, invert=invert)
-        next(iterator)
-        self.iterator = iterator
         self.index = index
 
+    def _get_iterator(self):
+        # The iterator is created the first time the point is moved since
+        # finding the candidate peaks is slow and most points (e.g., those
+        # loaded from an analysis) are never moved.
+        if self.iterator is None:
+            iterator = peak_iterator(self.parent, self.index,
+                                     invert=self.is_valley())
+            next(iterator)
+            self.iterator = iterator
+        return self.iterator
+
     def _observe_index(self, event):
-        if event['type'] == 'update':
+        if event['type'] == 'update' and self.iterator is not None:
             self.iterator.send(('set', event['value']))
 
     @property
@@ -163,7 +203,7 @@ class WaveformPoint(Atom):
         return self.parent.signal.iloc[self.index]
 
     def move(self, step):
-        self.index = self.iterator.send(step)
+        self.index = self._get_iterator().send(step)
 
     def time_to_index(self, time):
         return np.searchsorted(self.parent.x, time)
@@ -178,6 +218,30 @@ class ABRSeries(object):
         self.threshold = threshold
         for waveform in self.waveforms:
             waveform.series = self
+        # Cache of guesses used by `update_guess`.
+        self._propagated = {}
+
+    def copy(self):
+        '''
+        Return new series that shares the waveform data with this series but
+        has its own threshold and points.
+        '''
+        waveforms = [w.copy() for w in self.waveforms]
+        series = ABRSeries(waveforms, self.freq)
+        for name in ('filename', 'id', 'dataset'):
+            if hasattr(self, name):
+                setattr(series, name, getattr(self, name))
+        return series
+
+    def update_signal(self, level, signal):
+        '''
+        Replace signal of the waveform at the level
+
+        Guesses propagated from the other levels are discarded since they
+        depend on the candidate peaks of this level.
+        '''
+        self.get_level(level).set_signal(signal)
+        self._propagated.clear()
 
     def get_level(self, level):
         for waveform in self.waveforms:
@@ -185,8 +249,135 @@ class ABRSeries(object):
                 return waveform
         raise AttributeError(f'{level} dB SPL not in series')
 
-    def guess_p(self, latencies):
-        level_guesses = guess_iter(self.waveforms, latencies)
+    @property
+    def x(self):
+        # All waveforms in a series share the same time vector.
+        return self.waveforms[0].x
+
+    @property
+    def levels(self):
+        return np.array([w.level for w in self.waveforms])
+
+    def get_signal(self):
+        '''
+        Return level x time matrix containing the signal of each waveform
+        (sorted in ascending order by level).
+        '''
+        return np.vstack([w.signal.values for w in self.waveforms])
+
+    def stat(self, lb, ub, func):
+        x = self.x
+        mask = (x >= lb) & (x <= ub)
+        return func(self.get_signal()[:, mask], axis=-1)
+
+    def mean(self, lb, ub):
+        return self.stat(lb, ub, np.mean)
+
+    def std(self, lb, ub):
+        return self.stat(lb, ub, np.std)
+
+    def get_point_indices(self, keys):
+        '''
+        Return arrays of point indices and unscorable flags
+
+        Parameters
+        ----------
+        keys : list of (wave, point type) tuples
+            Points to extract.
+
+        Returns
+        -------
+        index : array of int
+            Level x point array of indices. Missing points are marked as -1.
+        unscorable : array of bool
+            Level x point array indicating whether point is unscorable.
+        '''
+        shape = len(self.waveforms), len(keys)
+        index = np.full(shape, -1, dtype=int)
+        unscorable = np.zeros(shape, dtype=bool)
+        for i, waveform in enumerate(self.waveforms):
+            for j, key in enumerate(keys):
+                point = waveform.points.get(key)
+                if point is not None:
+                    index[i, j] = point.index
+                    unscorable[i, j] = point.unscorable
+        return index, unscorable
+
+    def set_point_indices(self, keys, index, unscorable):
+        '''
+        Set points from arrays of point indices and unscorable flags
+
+        This is the inverse of `get_point_indices`. Points marked as -1 are
+        not set. Points that are set replace any existing point.
+        '''
+        for i, waveform in enumerate(self.waveforms):
+            for j, (wave, ptype) in enumerate(keys):
+                if index[i, j] < 0:
+                    continue
+                point = WaveformPoint(waveform, int(index[i, j]), wave, ptype)
+                point.unscorable = bool(unscorable[i, j])
+                waveform.points[wave, ptype] = point
+
+    def get_point_measures(self, keys):
+        '''
+        Return latency and amplitude of the requested points as level x point
+        arrays. Latencies are negative for subthreshold and unscorable points
+        and amplitudes are NaN for unscorable points (see
+        `WaveformPoint.latency` and `WaveformPoint.amplitude`).
+        '''
+        index, unscorable = self.get_point_indices(keys)
+        missing = index < 0
+        index = np.clip(index, 0, None)
+
+        latency = self.x[index]
+        amplitude = np.take_along_axis(self.get_signal(), index, axis=-1)
+
+        threshold = self.threshold
+        if threshold is None or np.isnan(threshold):
+            subthreshold = np.zeros(len(self.waveforms), dtype=bool)
+        else:
+            subthreshold = self.levels < threshold
+        negate = subthreshold[:, np.newaxis] | unscorable
+        latency = np.where(negate, -np.abs(latency), latency)
+        amplitude = np.where(unscorable, np.nan, amplitude)
+        latency[missing] = np.nan
+        amplitude[missing] = np.nan
+        return latency, amplitude
+
+    def estimate_threshold(self, metric='xcorr', criterion=None, **kwargs):
+        '''
+        Estimate threshold from the response metric across all levels. See
+        `abr.threshold.estimate_threshold` for details.
+
+        Returns
+        -------
+        threshold : float
+            Estimated threshold.
+        confidence : float
+            Confidence (0 to 1) in the estimate.
+        '''
+        return estimate_threshold(self.levels, self.x, self.get_signal(),
+                                  metric, criterion, **kwargs)
+
+    def guess_p(self, latencies, guesser=None):
+        '''
+        Guess peaks
+
+        Parameters
+        ----------
+        latencies : dict
+            Latency priors keyed by wave.
+        guesser : {None, TemplateGuesser}
+            If provided, guesses are generated by matching the waveforms
+            against the templates (`latencies` are used as the fallback
+            priors). Otherwise, peaks are guessed starting at the highest level
+            and the guess at each level is used to generate the priors for the
+            next level.
+        '''
+        if guesser is None:
+            level_guesses = guess_iter(self.waveforms, latencies)
+        else:
+            level_guesses = guesser.guess(self, latencies)
         self._set_points(level_guesses, Point.PEAK)
 
     def guess_n(self):
@@ -199,16 +390,46 @@ class ABRSeries(object):
         self._set_points(level_guesses, Point.VALLEY)
 
     def update_guess(self, level, point):
+        '''
+        Propagate the corrected point to the lower levels
+
+        At each level below the correction, the point is guessed using the
+        point at the level above as the prior (as in `guess_iter`). The guess
+        only depends on the waveform and the latency of the point above, so
+        the last guess for each level and point is cached and only recomputed
+        when the point above moves. Only points whose index changed or that
+        were marked as unscorable are updated (the original guess always
+        cleared the unscorable flag).
+
+        Propagation does not stop at the first level whose guess is unchanged.
+        The points below that level may have been edited since the last
+        propagation (by the rater, undo or `mark_unscorable`), so every level
+        is checked. With the cache, checking a level whose guess is unchanged
+        does not recompute the guess.
+        '''
         waveform = self.get_level(level)
         p = waveform.points[point]
-        g = {p.wave_number: p.x}
-        g = pd.DataFrame({'x': g})
-        latencies = generate_latencies_skewnorm(g)
+        invert = p.is_valley()
+        x = p.x
 
         i = self.waveforms.index(waveform)
-        waveforms = self.waveforms[:i]
-        level_guesses = guess_iter(waveforms, latencies, invert=p.is_valley())
-        self._set_points(level_guesses, p.point_type)
+        for w in self.waveforms[:i][::-1]:
+            key = w.level, point
+            cached = self._propagated.get(key)
+            if cached is None or cached[0] != x:
+                g = pd.DataFrame({'x': {p.wave_number: x}})
+                latencies = generate_latencies_skewnorm(g)
+                metrics = get_candidates(w, invert=invert)
+                wave_guess = guess_peaks(metrics, latencies).loc[p.wave_number]
+                # Replaces the guess for the previous latency, so there is at
+                # most one entry per level and point.
+                cached = self._propagated[key] = \
+                    x, w._guess_index(wave_guess), wave_guess['x']
+            _, index, x = cached
+            current = w.points.get(point)
+            if current is None or current.index != index \
+                    or current.unscorable:
+                w.set_point(p.wave_number, p.point_type, index)
 
     def clear_points(self):
         for waveform in self.waveforms:
@@ -228,20 +449,60 @@ class ABRSeries(object):
             waveform._set_points(level_guess, ptype)
 
     def load_analysis(self, threshold, points):
+        '''
+        Load threshold and points from a saved analysis
+
+        Parameters
+        ----------
+        threshold : {None, float}
+            Threshold (dB SPL).
+        points : pandas.DataFrame
+            Analysis table indexed by level with the latency and amplitude of
+            each point (e.g., "P1 Latency" and "P1 Amplitude"). Levels that
+            are not in the series and points with a missing latency are
+            ignored. Points with a missing amplitude are unscorable.
+        '''
         if threshold is None:
             threshold = np.nan
         self.threshold = threshold
-        for j, waveform in enumerate(self.waveforms[::-1]):
-            analysis = points.iloc[j]
-            for i in range(1, 6):
-                try:
-                    p_latency = np.abs(analysis[f'P{i} Latency'])
-                    n_latency = np.abs(analysis[f'N{i} Latency'])
-                    p_amplitude = analysis[f'P{i} Amplitude']
-                    n_amplitude = analysis[f'N{i} Amplitude']
-                    p_unscorable = bool(np.isnan(p_amplitude))
-                    n_unscorable = bool(np.isnan(n_amplitude))
-                    waveform.set_point(i, Point.PEAK, latency=p_latency, unscorable=p_unscorable)
-                    waveform.set_point(i, Point.VALLEY, latency=n_latency, unscorable=n_unscorable)
-                except KeyError:
-                    pass
+        if points.empty:
+            return
+
+        keys, latency_columns, amplitude_columns = [], [], []
+        for column in points.columns:
+            match = P_LATENCY_COLUMN.match(column)
+            if match is None:
+                continue
+            code, wave = match.groups()
+            amplitude_column = f'{code}{wave} Amplitude'
+            if amplitude_column not in points:
+                continue
+            ptype = Point.PEAK if code == 'P' else Point.VALLEY
+            keys.append((int(wave), ptype))
+            latency_columns.append(column)
+            amplitude_columns.append(amplitude_column)
+
+        # Levels are saved with two decimal places. Match the rows to the
+        # waveforms by level rather than position. If a level was saved more
+        # than once, the last row is used.
+        saved = pd.Index(np.round(points.index.values.astype(float), 2))
+        unique = np.flatnonzero(~saved.duplicated(keep='last'))
+        rows = saved[unique].get_indexer(np.round(self.levels, 2))
+        missing = rows < 0
+        rows = np.where(missing, -1, unique[rows])
+
+        # Latencies of subthreshold and unscorable points are saved as
+        # negative values.
+        latency = np.abs(points[latency_columns].values[rows].astype(float))
+        amplitude = points[amplitude_columns].values[rows].astype(float)
+        latency[missing] = np.nan
+
+        # Find the sample nearest to each latency in the shared time vector.
+        x = self.x
+        index = np.clip(np.searchsorted(x, latency), 1, len(x) - 1)
+        nearer = np.abs(x[index - 1] - latency) <= np.abs(x[index] - latency)
+        index = index - nearer
+        index[np.isnan(latency)] = -1
+        unscorable = np.isnan(amplitude)
+
+        self.set_point_indices(keys, index, unscorable)
@@ -0,0 +1,128 @@
+'''
+Evaluate automated peak picking against existing analyses
+
+Every dataset that has been analyzed by at least one rater is loaded and the
+peaks and valleys are guessed using the same algorithm the raters see in the
+GUI. The latency of each guessed point is then compared against the latency
+picked by each rater. Only points that the rater scored (i.e., suprathreshold
+and not marked as unscorable) are included.
+'''
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .datatype import Point
+from .parsers import Parser
+
+
+def score_dataset(file_format, filter_settings, dataset, latencies,
+                  guesser=None):
+    '''
+    Guess peaks and valleys for dataset
+
+    Returns
+    -------
+    latency : pandas.DataFrame
+        Latency of each point (columns, e.g., "P1 Latency") indexed by level.
+    '''
+    parser = Parser(file_format, filter_settings)
+    series = parser.load(dataset)
+    series.guess_p(latencies, guesser)
+    series.guess_n()
+    waves = sorted(latencies)
+    keys = [(w, Point.PEAK) for w in waves] + \
+        [(w, Point.VALLEY) for w in waves]
+    columns = [f'P{w} Latency' for w in waves] + \
+        [f'N{w} Latency' for w in waves]
+    latency, _ = series.get_point_measures(keys)
+    index = pd.Index(series.levels, name='Level')
+    return pd.DataFrame(latency, index=index, columns=columns)
+
+
+def _to_long(df, id_vars):
+    columns = [c for c in df.columns if c.endswith(' Latency')]
+    df = df.melt(id_vars=id_vars, value_vars=columns, var_name='point',
+                 value_name='latency')
+    df['point'] = df['point'].str.split(' ').str[0]
+    df['Level'] = df['Level'].astype(float).round(2)
+    return df
+
+
+def evaluate(parser, directory, latencies, guesser=None, max_workers=None):
+    '''
+    Compare guessed latencies against rater latencies for all datasets
+
+    Parameters
+    ----------
+    parser : Parser
+        Parser used to find and load the datasets.
+    directory : {str, Path}
+        Directory containing the datasets.
+    latencies : dict
+        Latency priors keyed by wave.
+    guesser : {None, TemplateGuesser}
+        If provided, used to guess the peaks (see `ABRSeries.guess_p`).
+    max_workers : {None, int}
+        Number of processes. If 1, datasets are scored in this process.
+
+    Returns
+    -------
+    errors : pandas.DataFrame
+        One row per rater and point with the guessed latency, the rater
+        latency and the error (guessed minus rater, msec).
+    '''
+    _, waves = parser.load_analyses(directory)
+    datasets = list(waves['dataset'].unique())
+    args = (parser._file_format, parser._filter_settings)
+
+    if max_workers == 1:
+        results = [score_dataset(*args, ds, latencies, guesser) \
+                   for ds in datasets]
+    else:
+        n = len(datasets)
+        with ProcessPoolExecutor(max_workers) as executor:
+            results = list(executor.map(score_dataset, [args[0]] * n,
+                                        [args[1]] * n, datasets,
+                                        [latencies] * n, [guesser] * n))
+
+    guessed = pd.concat(results, keys=datasets, names=['dataset']) \
+        .reset_index()
+    guessed = _to_long(guessed, ['dataset', 'Level'])
+    rated = _to_long(waves, ['dataset', 'analyzer', 'Level'])
+    rated = rated.query('latency > 0')
+
+    errors = rated.merge(guessed, on=['dataset', 'Level', 'point'],
+                         suffixes=('_rater', '_guess'))
+    errors['error'] = errors['latency_guess'] - errors['latency_rater']
+    return errors
+
+
+def summarize(errors, tolerance=0.1):
+    '''
+    Summarize latency error by rater and point
+
+    Parameters
+    ----------
+    errors : pandas.DataFrame
+        Output of `evaluate`.
+    tolerance : float
+        Guesses within this many msec of the rater latency are considered a
+        match.
+    '''
+    e = errors.assign(abs_error=errors['error'].abs(),
+                      sq_error=errors['error'] ** 2,
+                      match=errors['error'].abs() <= tolerance)
+    grouped = e.groupby(['analyzer', 'point'])
+    summary = pd.DataFrame({
+        'n': grouped.size(),
+        'bias': grouped['error'].mean(),
+        'mae': grouped['abs_error'].mean(),
+        'median_ae': grouped['abs_error'].median(),
+        'rmse': np.sqrt(grouped['sq_error'].mean()),
+        'match': grouped['match'].mean(),
+    })
+    # Sort points so that P1, N1, P2, N2, etc. are together.
+    points = sorted(summary.index.unique('point'),
+                    key=lambda p: (int(p[1:]), p[0] != 'P'))
+    return summary.reindex(points, level='point')
@@ -0,0 +1,165 @@
+'''
+Export figures of analyzed series
+
+Each analyzed dataset is loaded, the analysis by the rater is applied and the
+waveform stack (with the marked points) is rendered using the Agg backend.
+Datasets are distributed across a pool of processes. Each process renders
+all of its datasets into a single figure whose artists are reused (rather
+than recreated) between datasets.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from .abrpanel import SeriesPlot
+from .parsers import Parser, load_analysis
+from .parsers.dataset import get_rater
+
+
+class Renderer:
+    '''
+    Parameters
+    ----------
+    figsize : tuple of float
+        Size of figure (inches).
+    dpi : float
+        Resolution of figure for raster formats.
+    '''
+
+    def __init__(self, figsize=(6, 9), dpi=100):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_axes([0.1, 0.1, 0.8, 0.8])
+        self.axes.set_xlabel('Time (msec)')
+        self.series_plot = SeriesPlot(self.axes)
+
+    def render(self, series, filenames, title=None):
+        self.series_plot.load(series)
+        self.axes.set_title('' if title is None else title)
+        for filename in filenames:
+            self.figure.savefig(filename)
+
+
+#: Renderer for the current process (see `get_renderer`).
+_renderer = None
+
+
+def get_renderer(figsize=(6, 9), dpi=100):
+    global _renderer
+    if _renderer is None:
+        _renderer = Renderer(figsize, dpi)
+    return _renderer
+
+
+def get_figure_filename(dataset, analyzed, output=None, suffix='.png'):
+    '''
+    Return name of figure for the analysis
+
+    If output is None, the figure is saved next to the analysis.
+    '''
+    analyzed = Path(analyzed)
+    name = analyzed.name[:-len('analyzed.txt')].rstrip('-')
+    if output is None:
+        return analyzed.with_name(name + suffix)
+    frequency = dataset._get_frequency_label()
+    rater = get_rater(analyzed)
+    name = f'{dataset.parent.name}-{frequency}'
+    # get_rater returns None if the filename has no rater and "Unknown" if the
+    # filename is not in the usual format.
+    if rater not in (None, 'Unknown'):
+        name = f'{name}-{rater}'
+    return Path(output) / f'{name}{suffix}'
+
+
+def export_dataset(file_format, filter_settings, dataset, analyzed,
+                   output=None, formats=('png',), dpi=100):
+    '''
+    Render each analysis of the dataset
+
+    Parameters
+    ----------
+    analyzed : list
+        Analysis files to render.
+
+    Returns
+    -------
+    filenames : list
+        Figures that were saved.
+    '''
+    parser = Parser(file_format, filter_settings)
+    base = parser.load(dataset)
+    renderer = get_renderer(dpi=dpi)
+    saved = []
+    for a in analyzed:
+        _, threshold, points = load_analysis(a)
+        series = base.copy()
+        series.load_analysis(threshold, points)
+        filenames = [get_figure_filename(dataset, a, output, f'.{f}') \
+                     for f in formats]
+        title = f'{series.id} {dataset._get_frequency_label()}'
+        rater = get_rater(Path(a))
+        if rater not in (None, 'Unknown'):
+            title = f'{title} ({rater})'
+        renderer.render(series, filenames, title)
+        saved.extend(filenames)
+    return saved
+
+
+def _export_dataset(args):
+    return export_dataset(*args)
+
+
+def export(parser, paths, rater=None, output=None, formats=('png',), dpi=100,
+           max_workers=None):
+    '''
+    Render all analyzed datasets
+
+    Parameters
+    ----------
+    parser : Parser
+        Parser used to find and load the datasets.
+    paths : list
+        Directories to scan.
+    rater : {None, str}
+        Rater to export. If None, the analyses of all raters are exported.
+    output : {None, str, Path}
+        Directory to save figures to. If None, each figure is saved next to
+        the analysis.
+    formats : tuple of str
+        Formats to save (e.g., png, pdf or svg).
+    dpi : float
+        Resolution of raster formats.
+    max_workers : {None, int}
+        Number of processes. If 1, figures are rendered in this process.
+
+    Returns
+    -------
+    filenames : list
+        Figures that were saved.
+    '''
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+    tasks = []
+    for path in paths:
+        for ds, analyzed in parser.find_analyses(path).items():
+            if rater is not None:
+                analyzed = [a for a in analyzed if get_rater(a) == rater]
+            if analyzed:
+                tasks.append((parser._file_format, parser._filter_settings, ds,
+                              analyzed, output, tuple(formats), dpi))
+
+    if max_workers == 1:
+        results = map(_export_dataset, tasks)
+    else:
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        executor = ProcessPoolExecutor(max_workers)
+        # Send the datasets in chunks to reduce the per-task overhead.
+        chunksize = max(1, min(32, len(tasks) // (max_workers * 4)))
+        with executor:
+            results = list(executor.map(_export_dataset, tasks,
+                                        chunksize=chunksize))
+    return [f for filenames in results for f in filenames]
@@ -0,0 +1,117 @@
+'''
+Undo/redo history for the analysis of a series
+
+Each entry is a compact snapshot of the analysis: the index and unscorable
+flag of every point (as level x point arrays), the threshold and the flags
+the presenter uses to track progress. Restoring a snapshot compares it against
+the current state and only touches the points that differ. The number of
+snapshots is bounded, so memory does not grow over long sessions.
+'''
+from collections import deque
+
+import numpy as np
+
+from .datatype import Point
+
+
+POINT_KEYS = [(w, p) for w in range(1, 6) for p in (Point.PEAK, Point.VALLEY)]
+
+
+class SeriesState:
+
+    def __init__(self, index, unscorable, threshold, flags):
+        self.index = index
+        self.unscorable = unscorable
+        self.threshold = threshold
+        self.flags = flags
+
+    @classmethod
+    def capture(cls, series, flags=None):
+        index, unscorable = series.get_point_indices(POINT_KEYS)
+        return cls(index.astype(np.int32), unscorable, series.threshold,
+                   {} if flags is None else dict(flags))
+
+    def __eq__(self, other):
+        if not isinstance(other, SeriesState):
+            return NotImplemented
+        return np.array_equal(self.index, other.index) \
+            and np.array_equal(self.unscorable, other.unscorable) \
+            and np.array_equal(self.threshold, other.threshold, equal_nan=True) \
+            and self.flags == other.flags
+
+    def restore(self, series):
+        '''
+        Restore series to this state
+
+        Returns
+        -------
+        n_changed : int
+            Number of points that were changed.
+        '''
+        current = SeriesState.capture(series)
+        changed = (current.index != self.index) | \
+            (current.unscorable != self.unscorable)
+        for i, j in zip(*np.nonzero(changed)):
+            waveform = series.waveforms[i]
+            wave, ptype = POINT_KEYS[j]
+            index = self.index[i, j]
+            if index < 0:
+                del waveform.points[wave, ptype]
+            else:
+                waveform.set_point(wave, ptype, int(index),
+                                   unscorable=bool(self.unscorable[i, j]))
+        series.threshold = self.threshold
+        return int(changed.sum())
+
+
+class History:
+    '''
+    Parameters
+    ----------
+    maxlen : int
+        Maximum number of snapshots to keep for undo (and for redo). The
+        oldest snapshots are discarded first.
+    '''
+
+    def __init__(self, maxlen=100):
+        self._undo = deque(maxlen=maxlen)
+        self._redo = deque(maxlen=maxlen)
+
+    def push(self, state):
+        '''
+        Save state prior to a change
+        '''
+        self._undo.append(state)
+        self._redo.clear()
+
+    def undo(self, current):
+        '''
+        Return state to restore (or None if there is nothing to undo)
+
+        Parameters
+        ----------
+        current : SeriesState
+            Current state. This is saved so the undo can be redone.
+        '''
+        if not self._undo:
+            return None
+        self._redo.append(current)
+        return self._undo.pop()
+
+    def redo(self, current):
+        if not self._redo:
+            return None
+        self._undo.append(current)
+        return self._redo.pop()
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+
+    @property
+    def can_undo(self):
+        return bool(self._undo)
+
+    @property
+    def can_redo(self):
+        return bool(self._redo)
@@ -0,0 +1,181 @@
+'''
+Crash-safe journal of in-progress analyses
+
+Every change the rater makes to the analysis of a dataset is appended to a
+journal file (see `Dataset.get_journal_filename`) as a JSON record on a
+separate line. Each record only contains the points that changed (along with
+the threshold, if it changed, and the presenter flags). When the dataset is
+reopened, the journal is replayed to recover the analysis. Once the analysis
+is saved, the journal is deleted.
+
+Writes are handed to a background thread so that journaling does not add
+latency to the GUI. The writer drains all pending records before flushing them
+to disk.
+'''
+import logging
+log = logging.getLogger(__name__)
+
+import atexit
+import json
+import os
+from pathlib import Path
+import queue
+import threading
+import time
+
+import numpy as np
+
+from .datatype import Point
+from .history import POINT_KEYS
+
+
+def encode_change(series, old, new):
+    '''
+    Encode change between two states of the series (see `SeriesState`) as a
+    journal record
+    '''
+    changed = (old.index != new.index) | (old.unscorable != new.unscorable)
+    points = []
+    for i, j in zip(*np.nonzero(changed)):
+        wave, ptype = POINT_KEYS[j]
+        points.append([float(series.waveforms[i].level), wave, ptype.value,
+                       int(new.index[i, j]), bool(new.unscorable[i, j])])
+    record = {'time': time.time(), 'points': points, 'flags': new.flags}
+    if not np.array_equal(old.threshold, new.threshold, equal_nan=True):
+        record['threshold'] = float(new.threshold)
+    return json.dumps(record)
+
+
+def read_journal(filename):
+    '''
+    Read records from journal
+
+    A partially-written record at the end of the file (e.g., if the program
+    crashed while writing it) is ignored.
+    '''
+    records = []
+    try:
+        with open(filename) as fh:
+            for line in fh:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    log.warning('Ignoring corrupt record in %s', filename)
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def replay(series, records):
+    '''
+    Apply journal records to series
+
+    Returns
+    -------
+    flags : dict
+        Presenter flags from the last record.
+    '''
+    flags = {}
+    for record in records:
+        for level, wave, ptype, index, unscorable in record['points']:
+            waveform = series.get_level(level)
+            ptype = Point(ptype)
+            if index < 0:
+                waveform.points.pop((wave, ptype), None)
+            else:
+                waveform.set_point(wave, ptype, index, unscorable=unscorable)
+        if 'threshold' in record:
+            series.threshold = record['threshold']
+        flags = record.get('flags', flags)
+    return flags
+
+
+class JournalWriter:
+    '''
+    Background thread that appends records to (and deletes) journal files
+
+    Commands are processed in the order they were submitted, so a journal that
+    is deleted after the analysis is saved will not be recreated by a record
+    that was still pending.
+    '''
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._handles = {}
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='JournalWriter')
+        self._thread.start()
+
+    def append(self, filename, record):
+        self._queue.put(('append', Path(filename), record))
+
+    def delete(self, filename):
+        self._queue.put(('delete', Path(filename), None))
+
+    def flush(self):
+        '''
+        Block until all pending commands have been written
+        '''
+        self._queue.join()
+
+    def _process(self, command, filename, record, dirty):
+        if command == 'append':
+            fh = self._handles.get(filename)
+            if fh is None:
+                fh = self._handles[filename] = filename.open('a')
+            fh.write(record + '\n')
+            dirty.add(filename)
+        elif command == 'delete':
+            fh = self._handles.pop(filename, None)
+            if fh is not None:
+                fh.close()
+            dirty.discard(filename)
+            try:
+                filename.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _run(self):
+        while True:
+            commands = [self._queue.get()]
+            while True:
+                try:
+                    commands.append(self._queue.get(block=False))
+                except queue.Empty:
+                    break
+
+            dirty = set()
+            for command in commands:
+                try:
+                    self._process(*command, dirty)
+                except Exception as e:
+                    # Most likely the share is not available. Close the file
+                    # so that it is reopened on the next record.
+                    log.exception(e)
+                    fh = self._handles.pop(command[1], None)
+                    if fh is not None:
+                        fh.close()
+
+            for filename in dirty:
+                try:
+                    fh = self._handles[filename]
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                except Exception as e:
+                    log.exception(e)
+
+            for _ in commands:
+                self._queue.task_done()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = JournalWriter()
+            atexit.register(_writer.flush)
+    return _writer
@@ -1,28 +1,30 @@
 import argparse
+import functools
 
-import enaml
-from enaml.application import deferred_call
-from enaml.qt.qt_application import QtApplication
-from scipy import stats
+from abr import timing
 
-with enaml.imports():
-    from abr.launch_window import LaunchWindow, STORE
-    from abr.main_window import (DNDWindow, load_files, SerialWindow)
-    from abr.compare_window import CompareWindow
-    from abr.presenter import SerialWaveformPresenter, WaveformPresenter
 
+P_LATENCY_PARAMS = {
+    1: (1.5, 0.5),
+    2: (2.5, 1),
+    3: (3.0, 1),
+    4: (4.0, 1),
+    5: (5.0, 2),
+}
 
-from abr.compare import Compare
-from abr.parsers import Parser
 
+@functools.lru_cache(maxsize=None)
+def get_latencies():
+    from abr import priors
+    return {w: priors.norm(*p) for w, p in P_LATENCY_PARAMS.items()}
 
-P_LATENCIES = {
-    1: stats.norm(1.5, 0.5),
-    2: stats.norm(2.5, 1),
-    3: stats.norm(3.0, 1),
-    4: stats.norm(4.0, 1),
-    5: stats.norm(5.0, 2),
-}
+
+def __getattr__(name):
+    # The default priors are only created when needed so that importing this
+    # module does not import numpy and scipy.
+    if name == 'P_LATENCIES':
+        return get_latencies()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def add_default_arguments(parser, waves=True):
@@ -37,19 +39,36 @@ def add_default_arguments(parser, waves=True):
     parser.add_argument('--order',
                         help='Filter order, default 1st order', default=1,
                         type=int)
-    parser.add_argument('--parser', default='EPL', help='Parser to use')
+    parser.add_argument('--parser', default='auto',
+                        help='File format (default: detect automatically)')
     parser.add_argument('--user', help='Name of person analyzing data')
+    parser.add_argument('--startup-timing', action='store_true',
+                        help='Print startup timing report on exit')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Append timing records (JSONL) to file and print '
+                        'summary on exit')
     if waves:
         group = parser.add_mutually_exclusive_group(required=True)
         group.add_argument('--threshold-only', action='store_true')
         group.add_argument('--all-waves', action='store_true')
         group.add_argument('--waves', type=int, nargs='+')
+        parser.add_argument('--guesser',
+                            help='Template model for guessing peaks '
+                            '(see abr-guesser)')
 
 
-def parse_args(parser, waves=True):
-    options = parser.parse_args()
+def parse_args(parser, waves=True, argv=None):
+    options = parser.parse_args(argv)
+    if options.startup_timing:
+        timing.enable()
+    if options.profile:
+        timing.enable_profile(options.profile)
+    timing.mark('arguments parsed')
+
+    from abr.parsers import Parser
     exclude = ('filter', 'lowpass', 'highpass', 'order', 'parser', 'user',
-               'waves', 'all_waves', 'threshold_only')
+               'waves', 'all_waves', 'threshold_only', 'guesser',
+               'startup_timing', 'profile')
     new_options = {k: v for k, v in vars(options).items() if k not in exclude}
     filter_settings = None
     if options.filter:
@@ -70,79 +89,410 @@ def parse_args(parser, waves=True):
         waves = []
     else:
         waves = options.waves[:]
-    new_options['latencies'] = {w: P_LATENCIES[w] for w in waves}
+    latencies = get_latencies()
+    new_options['latencies'] = {w: latencies[w] for w in waves}
+    if options.guesser is not None:
+        from abr.template import TemplateGuesser
+        new_options['guesser'] = TemplateGuesser.load(options.guesser)
+    else:
+        new_options['guesser'] = None
     return new_options
 
 
-def main():
+def get_application():
+    '''
+    Return running application, creating one if needed
+    '''
+    from enaml.application import Application
+    app = Application.instance()
+    if app is None:
+        from enaml.qt.qt_application import QtApplication
+        app = QtApplication()
+    timing.mark('application created')
+    return app
+
+
+def show(window):
+    from enaml.application import deferred_call
+    window.show()
+    # The first deferred call runs once the event loop has drawn the window.
+    deferred_call(timing.mark, 'window shown')
+
+
+def run(create_window, argv=None):
+    '''
+    Create window using the command-line arguments and run event loop
+    '''
+    window = create_window(argv)
+    app = get_application()
+    show(window)
+    app.start()
+    app.stop()
+
+
+def create_launcher(argv=None):
     parser = argparse.ArgumentParser('abr')
     parser.add_argument('--clear-settings', action='store_true',
                         help='Clear persisted settings')
-    args = parser.parse_args()
+    parser.add_argument('--startup-timing', action='store_true',
+                        help='Print startup timing report on exit')
+    args = parser.parse_args(argv)
+    if args.startup_timing:
+        timing.enable()
+    timing.mark('arguments parsed')
+
+    get_application()
+    import enaml
+    with enaml.imports():
+        from abr.launch_window import LaunchWindow, STORE
     if args.clear_settings:
         STORE.clear()
-
-    app = QtApplication()
     window = LaunchWindow()
-    window.show()
-    app.start()
-    app.stop()
+    timing.mark('window created')
+    return window
 
 
-def main_gui():
+def create_gui(argv=None):
     parser = argparse.ArgumentParser('abr-gui')
     add_default_arguments(parser)
     parser.add_argument('--demo', action='store_true', dest='demo',
                         default=False, help='Load demo data')
     parser.add_argument('filenames', nargs='*')
-    options = parse_args(parser)
-
-    app = QtApplication()
-    view = DNDWindow(parser=options['parser'], latencies=options['latencies'])
-    deferred_call(load_files, options['parser'], options['latencies'],
-                  options['filenames'], view.find('dock_area'))
+    options = parse_args(parser, argv=argv)
 
-    view.show()
-    app.start()
-    app.stop()
+    get_application()
+    import enaml
+    from enaml.application import deferred_call
+    with enaml.imports():
+        from abr.main_window import DNDWindow
+    view = DNDWindow(parser=options['parser'], latencies=options['latencies'],
+                     guesser=options['guesser'])
+    deferred_call(view.load_files, options['filenames'])
+    timing.mark('window created')
+    return view
 
 
-def main_batch():
+def create_batch(argv=None):
     parser = argparse.ArgumentParser('abr-batch')
     add_default_arguments(parser)
     parser.add_argument('dirnames', nargs='*')
     parser.add_argument('--skip-errors', action='store_true')
-    options = parse_args(parser)
+    parser.add_argument('--auto-threshold', action='store_true',
+                        help='Estimate threshold for the rater to confirm')
+    parser.add_argument('--queue-order', default='scan', dest='queue_order',
+                        choices=['scan', 'shuffle', 'frequency', 'collection'],
+                        help='Order to present datasets in')
+    parser.add_argument('--shuffle', action='store_const', dest='queue_order',
+                        const='shuffle', help='Present datasets in random '
+                        'order (same as --queue-order shuffle)')
+    parser.add_argument('--seed', type=int,
+                        help='Seed for the random order')
+    parser.add_argument('--queue-file',
+                        help='Save the work queue to this file. If the file '
+                        'exists, the queue is loaded from it instead of '
+                        'scanning the directories.')
+    parser.add_argument('--lease-time', type=float, default=3600,
+                        help='Time (sec) until the lease on a dataset expires')
+    parser.add_argument('--no-locking', action='store_false', dest='locking',
+                        help='Do not create lease files to prevent raters '
+                        'from working on the same dataset')
+    options = parse_args(parser, argv=argv)
     parser = options['parser']
 
-    app = QtApplication()
+    get_application()
+    import enaml
+    with enaml.imports():
+        from abr.main_window import SerialWindow
+        from abr.presenter import SerialWaveformPresenter
+    from abr.workqueue import WorkQueue
+    work_queue = WorkQueue(parser, options['dirnames'],
+                           options['queue_order'],
+                           options['seed'], options['queue_file'],
+                           options['lease_time'], options['locking'])
     presenter = SerialWaveformPresenter(parser=parser,
                                         latencies=options['latencies'],
-                                        paths=options['dirnames'])
+                                        paths=options['dirnames'],
+                                        auto_threshold=options['auto_threshold'],
+                                        guesser=options['guesser'],
+                                        work_queue=work_queue)
     view = SerialWindow(presenter=presenter)
-    view.show()
-    app.start()
-    app.stop()
+    timing.mark('window created')
+    return view
 
 
-def main_compare():
+def create_compare(argv=None):
     parser = argparse.ArgumentParser("abr-compare")
     add_default_arguments(parser)
     parser.add_argument('directory')
-    options = parse_args(parser)
+    options = parse_args(parser, argv=argv)
+
+    get_application()
+    import enaml
+    with enaml.imports():
+        from abr.compare_window import CompareWindow
+        from abr.presenter import WaveformPresenter
+    from abr.compare import Compare
 
     presenter_a = WaveformPresenter(latencies=options['latencies'], parser=options['parser'], interactive=False)
     presenter_b = WaveformPresenter(latencies=options['latencies'], parser=options['parser'], interactive=False)
-    presenter_c = WaveformPresenter(latencies=options['latencies'], parser=options['parser'])
+    presenter_c = WaveformPresenter(latencies=options['latencies'], parser=options['parser'], guesser=options['guesser'])
 
-    app = QtApplication()
     compare = Compare(options['parser'], options['directory'])
     view = CompareWindow(compare=compare,
-                         rater=options['parser']._user,
+                         rater=options['parser']._rater,
                          presenter_a=presenter_a,
                          presenter_b=presenter_b,
                          presenter_c=presenter_c,
                          )
-    view.show()
-    app.start()
-    app.stop()
+    timing.mark('window created')
+    return view
+
+
+def main():
+    run(create_launcher)
+
+
+def create_live(argv=None):
+    parser = argparse.ArgumentParser('abr-live',
+                                     description='Display averages while a '
+                                     'psiexperiment run is acquiring')
+    add_default_arguments(parser)
+    parser.add_argument('path', help='Folder containing the run')
+    parser.add_argument('--frequency', type=float,
+                        help='Frequency (Hz) to display. Required if the run '
+                        'includes more than one frequency.')
+    parser.add_argument('--epoch-size', type=float, default=8.5,
+                        help='Duration of each epoch (msec) until the run '
+                        'is complete')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='Time (sec) between checks for new epochs')
+    options = parse_args(parser, argv=argv)
+
+    import numpy as np
+    from abr.parsers.PSI import PSILiveCollection, PSILiveDataset
+    collection = PSILiveCollection(options['path'],
+                                   options['epoch_size'] * 1e-3)
+    frequency = options['frequency']
+    if frequency is None:
+        frequencies = collection.frequencies
+        if len(frequencies) != 1:
+            raise SystemExit('Specify the frequency with --frequency')
+        frequency = frequencies[0]
+    else:
+        # Frequencies of the epochs are float32.
+        frequency = np.float32(frequency)
+    dataset = PSILiveDataset(collection, frequency)
+
+    get_application()
+    import enaml
+    with enaml.imports():
+        from abr.main_window import LiveWindow
+    from abr.presenter import LiveMonitor, WaveformPresenter
+    parser = options['parser']
+    presenter = WaveformPresenter(parser, options['latencies'],
+                                  guesser=options['guesser'])
+    presenter.dataset = dataset
+    monitor = LiveMonitor(presenter=presenter, dataset=dataset,
+                          filter_settings=parser._filter_settings,
+                          interval=options['interval'])
+    view = LiveWindow(presenter=presenter, monitor=monitor)
+    monitor.start()
+    timing.mark('window created')
+    return view
+
+
+def main_gui():
+    run(create_gui)
+
+
+def main_batch():
+    run(create_batch)
+
+
+def main_live():
+    run(create_live)
+
+
+def main_compare():
+    run(create_compare)
+
+
+def main_guesser():
+    parser = argparse.ArgumentParser('abr-guesser',
+                                     description='Build template model for '
+                                     'guessing peaks from existing analyses')
+    add_default_arguments(parser, waves=False)
+    parser.add_argument('directory')
+    parser.add_argument('output', help='Filename to save model to')
+    options = parse_args(parser, waves=False)
+    from abr.template import TemplateGuesser
+    guesser = TemplateGuesser.from_analyses(options['parser'],
+                                            options['directory'])
+    guesser.save(options['output'])
+
+
+def main_watch():
+    parser = argparse.ArgumentParser('abr-watch',
+                                     description='Watch directories and '
+                                     'pre-score new recordings')
+    add_default_arguments(parser)
+    parser.set_defaults(user='auto')
+    parser.add_argument('dirnames', nargs='+')
+    parser.add_argument('--no-auto-threshold', action='store_false',
+                        dest='auto_threshold',
+                        help='Do not estimate threshold')
+    parser.add_argument('--settle', type=float, default=5,
+                        help='Time (sec) a file must be unchanged before it '
+                        'is scored')
+    parser.add_argument('--poll-interval', type=float, default=1,
+                        help='Time (sec) between checks for changes')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes (default is number of CPUs)')
+    parser.add_argument('--new-only', action='store_false', dest='existing',
+                        help='Do not score recordings that are already present')
+    parser.add_argument('--polling', action='store_true',
+                        help='Poll for changes even if watchdog is installed')
+    options = parse_args(parser)
+
+    import logging
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    from abr.watch import Watcher
+    watcher = Watcher(options['parser'], options['dirnames'],
+                      options['latencies'], options['guesser'],
+                      auto_threshold=options['auto_threshold'],
+                      settle=options['settle'],
+                      poll_interval=options['poll_interval'],
+                      max_workers=options['workers'],
+                      existing=options['existing'],
+                      polling=options['polling'])
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def main_export():
+    parser = argparse.ArgumentParser('abr-export',
+                                     description='Save figures of analyzed '
+                                     'datasets')
+    add_default_arguments(parser, waves=False)
+    parser.add_argument('dirnames', nargs='+')
+    parser.add_argument('--rater',
+                        help='Only export analyses by this rater')
+    parser.add_argument('-o', '--output',
+                        help='Directory to save figures to (default is next '
+                        'to each analysis)')
+    parser.add_argument('--format', nargs='+', default=['png'],
+                        dest='formats', help='Figure formats (e.g., png pdf)')
+    parser.add_argument('--dpi', type=float, default=100,
+                        help='Resolution of raster formats')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes (default is number of CPUs)')
+    options = parse_args(parser, waves=False)
+
+    from abr.export import export
+    filenames = export(options['parser'], options['dirnames'],
+                       options['rater'], options['output'],
+                       options['formats'], options['dpi'], options['workers'])
+    print(f'Saved {len(filenames)} figures')
+
+
+def main_summarize():
+    parser = argparse.ArgumentParser('abr-summarize',
+                                     description='Compute grand-average '
+                                     'waveforms and mean latency, amplitude '
+                                     'and threshold across datasets')
+    add_default_arguments(parser, waves=False)
+    parser.add_argument('dirnames', nargs='+')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Directory to save summary to')
+    parser.add_argument('--rater',
+                        help='Only include datasets analyzed by this rater')
+    parser.add_argument('--groups',
+                        help='CSV file with the group of each collection '
+                        '(columns "name" and "group"). Collections that are '
+                        'not listed are skipped.')
+    parser.add_argument('--no-waveforms', action='store_false',
+                        dest='waveforms',
+                        help='Only summarize the analyses (faster since the '
+                        'waveforms are not loaded)')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes (default is number of CPUs)')
+    parser.add_argument('--bootstrap', action='store_true',
+                        help='Also estimate the threshold and its bootstrap '
+                        'confidence interval from the epochs of each dataset '
+                        'that saved them (requires the "epochs" extra)')
+    options = parse_args(parser, waves=False)
+
+    import os
+    import pandas as pd
+    from abr.population import summarize
+
+    group_by = None
+    if options['groups']:
+        groups = pd.read_csv(options['groups'], dtype=str) \
+            .set_index('name')['group'].to_dict()
+        group_by = lambda ds: groups.get(ds.parent.name)
+
+    summary = summarize(options['parser'], options['dirnames'], group_by,
+                        options['rater'], options['waveforms'],
+                        max_workers=options['workers'])
+    output = options['output']
+    os.makedirs(output, exist_ok=True)
+    if options['waveforms']:
+        summary.get_waveforms().to_csv(os.path.join(output,
+                                                    'grand_average.csv'))
+    summary.get_measures().to_csv(os.path.join(output, 'measures.csv'))
+    summary.get_thresholds().to_csv(os.path.join(output, 'thresholds.csv'))
+    if options['bootstrap']:
+        from abr.bootstrap import bootstrap_study
+        bootstrap_study(options['parser'], options['dirnames'],
+                        max_workers=options['workers']) \
+            .to_csv(os.path.join(output, 'threshold_ci.csv'))
+    print(f'Saved summary to {output}')
+
+
+def main_pack():
+    parser = argparse.ArgumentParser('abr-pack',
+                                     description='Consolidate all datasets '
+                                     'found in the directories into a pack')
+    parser.add_argument('dirnames', nargs='+')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Name of pack to create (.abrpack)')
+    parser.add_argument('--parser', default='auto',
+                        help='File format (default: detect automatically)')
+    parser.add_argument('--dtype', default='<f8',
+                        help='Data type used to store the waveforms')
+    options = parser.parse_args()
+
+    from abr.parsers import Parser
+    from abr.parsers.pack import pack
+    n = pack(Parser(options.parser), options.dirnames, options.output,
+             options.dtype)
+    print(f'Packed {n} datasets')
+
+
+def main_evaluate():
+    parser = argparse.ArgumentParser('abr-evaluate',
+                                     description='Compare automatically '
+                                     'guessed peaks against existing analyses')
+    add_default_arguments(parser)
+    parser.add_argument('directory')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes (default is number of CPUs)')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Guesses within this many msec of the rater are '
+                        'considered a match')
+    parser.add_argument('--output', help='Save error for each point to CSV')
+    options = parse_args(parser)
+
+    import pandas as pd
+    from abr.evaluate import evaluate, summarize
+    errors = evaluate(options['parser'], options['directory'],
+                      options['latencies'], options['guesser'],
+                      options['workers'])
+    if options['output']:
+        errors.to_csv(options['output'], index=False)
+    with pd.option_context('display.max_rows', None, 'display.width', 120):
+        print(summarize(errors, options['tolerance']).round(3))
@@ -1,64 +1,125 @@
-import io
+from functools import cached_property
 from pathlib import Path
 import re
 
 import numpy as np
 import pandas as pd
-from scipy import signal
 
 from abr.datatype import ABRWaveform, ABRSeries
 
+from . import registry
+from .dataset import DataCollection, Dataset, filter_data
 
-def load(filename, filter_settings=None, frequencies=None):
-    filename = Path(filename)
-    with filename.open(encoding='ISO-8859-1') as f:
-        line = f.readline()
-        if not line.startswith(':RUN-'):
-            raise IOError('Unsupported file format')
 
-    p_level = re.compile(':LEVELS:([0-9;]+)')
-    p_fs = re.compile('SAMPLE \(.sec\): ([0-9]+)')
-    p_freq = re.compile('FREQ: ([0-9\.]+)')
+P_LEVEL = re.compile(r':LEVELS:([0-9;]+)')
+P_FS = re.compile(r'SAMPLE \(.sec\): ([0-9]+)')
+P_FREQ = re.compile(r'FREQ: ([0-9\.]+)')
+
+# Duration of the ABR window in usec.
+ABR_WINDOW = 8500
+
 
+def read_file(filename):
+    '''
+    Load the waveforms stored in the ABR file
+
+    Returns
+    -------
+    frequency : float
+        Stimulus frequency in Hz.
+    fs : float
+        Sampling rate in Hz.
+    data : pandas.DataFrame
+        Waveforms indexed by level with time (msec) as the columns.
+    '''
+    with filename.open(encoding='ISO-8859-1') as fh:
+        text = fh.read()
+    if not text.startswith(':RUN-'):
+        raise IOError('Unsupported file format')
 
-    abr_window = 8500  # usec
     try:
-        with filename.open(encoding='ISO-8859-1') as f:
-            header, data = f.read().split('DATA')
-
-            # Extract data from header
-            levelstring = p_level.search(header).group(1).strip(';').split(';')
-            levels = np.array(levelstring).astype(np.float32)
-            sampling_period = float(p_fs.search(header).group(1))
-            frequency = float(p_freq.search(header).group(1))
-
-            # Convert text representation of data to Numpy array
-            fs = 1e6/sampling_period
-            cutoff = int(abr_window / sampling_period)
-            data = np.array(data.split()).astype(np.float32)
-            data.shape = -1, len(levels)
-            data = data.T[:, :cutoff]
-            t = np.arange(data.shape[-1]) / fs * 1e3
-            t = pd.Index(t, name='time')
-
-            if filter_settings is not None:
-                Wn = filter_settings['highpass'], filter_settings['lowpass']
-                N = filter_settings['order']
-                b, a = signal.iirfilter(N, Wn, fs=fs)
-                data = signal.filtfilt(b, a, data, axis=-1)
-
-            waveforms = []
-            for s, level in zip(data, levels):
-                # Checks for a ABR I-O bug that sometimes saves zeroed waveforms
-                if not (s == 0).all():
-                    w = pd.Series(s, index=t)
-                    waveform = ABRWaveform(fs, w, level)
-                    waveforms.append(waveform)
-
-            series = ABRSeries(waveforms, frequency)
-            series.filename = filename
-            return [series]
+        header, data = text.split('DATA')
+
+        # Extract data from header
+        levelstring = P_LEVEL.search(header).group(1).strip(';').split(';')
+        levels = np.array(levelstring).astype(np.float32)
+        sampling_period = float(P_FS.search(header).group(1))
+        # The frequency is stored in kHz.
+        frequency = float(P_FREQ.search(header).group(1)) * 1e3
 
+        # Convert text representation of data to Numpy array
+        fs = 1e6/sampling_period
+        cutoff = int(ABR_WINDOW / sampling_period)
+        data = np.array(data.split()).astype(np.float32)
+        data.shape = -1, len(levels)
+        data = data.T[:, :cutoff]
     except (AttributeError, ValueError):
-        msg = 'Could not parse %s.  Most likely not a valid ABR file.' % fname
+        msg = 'Could not parse %s.  Most likely not a valid ABR file.' % filename
         raise IOError(msg)
+
+    # Checks for a ABR I-O bug that sometimes saves zeroed waveforms
+    mask = ~(data == 0).all(axis=-1)
+    t = pd.Index(np.arange(data.shape[-1]) / fs * 1e3, name='time')
+    index = pd.Index(levels[mask].astype(float), name='level')
+    return frequency, fs, pd.DataFrame(data[mask], index=index, columns=t)
+
+
+class EPLDataCollection(DataCollection):
+    '''
+    Each EPL CFTS file contains a single frequency.
+    '''
+
+    @cached_property
+    def _contents(self):
+        return read_file(self.filename)
+
+    @property
+    def fs(self):
+        return self._contents[1]
+
+    @property
+    def data(self):
+        return self._contents[2]
+
+    @property
+    def frequencies(self):
+        return np.array([self._contents[0]])
+
+    @property
+    def name(self):
+        return self.filename.name
+
+    def iter_frequencies(self):
+        for frequency in self.frequencies:
+            yield EPLDataset(self, frequency)
+
+
+class EPLDataset(Dataset):
+
+    def get_series(self, filter_settings=None):
+        data = self.parent.data
+        values = filter_data(data.values, self.fs, filter_settings)
+        waveforms = []
+        for level, w in zip(data.index.values, values):
+            w = pd.Series(w, index=data.columns)
+            waveforms.append(ABRWaveform(self.fs, w, float(level)))
+
+        series = ABRSeries(waveforms, self.frequency)
+        series.filename = self.filename
+        series.id = self.parent.name
+        series.dataset = self
+        return series
+
+
+def load(filename, filter_settings=None, frequencies=None):
+    collection = EPLDataCollection(filename)
+    return [ds.get_series(filter_settings) \
+            for ds in collection.iter_frequencies()]
+
+
+def iter_all(path):
+    path = Path(path)
+    if path.is_file():
+        yield from EPLDataCollection(path).iter_frequencies()
+    else:
+        yield from registry.iter_all(path, ['EPL'])
@@ -1,10 +1,24 @@
-from __future__ import division
+from functools import cached_property, lru_cache
+from pathlib import Path
 
-import pandas as pd
 import numpy as np
+import pandas as pd
 
+from abr import timing
 from abr.datatype import ABRWaveform, ABRSeries
 
+from . import registry
+from .dataset import DataCollection, Dataset, filter_data
+
+
+# Number of lines in the header. Each line contains one parameter (e.g.,
+# intensity) for each waveform stored in the file.
+N_HEADER = 20
+
+# Start time of stimulus in usec (since sampling period is reported in usec,
+# we should try to be consistent with all time units).
+STIMULUS_START = 12.5e3
+
 
 ################################################################################
 # Utility functions
@@ -31,14 +45,9 @@ def _parse_line(line):
         return [t for t in tokens if t]
 
 
-def load_metadata(filename):
+def _parse_metadata(lines):
     '''
-    Load the metadata stored in the ABR file
-
-    Parameters:
-    -----------
-    filename : string
-        Filename to load
+    Parse the metadata stored in the header of the ABR file
 
     Returns
     -------
@@ -46,18 +55,11 @@ def load_metadata(filename):
         Dataframe containing information on each waveform
     '''
     info = {}
-    with open(filename, 'r') as fh:
-        for i, line in enumerate(fh):
-            if i == 20:
-                break
-            name = line.split(',', 1)[0].strip(':').lower()
-            info[name] = _parse_line(line)
+    for line in lines:
+        name = line.split(',', 1)[0].strip(':').lower()
+        info[name] = _parse_line(line)
     info = pd.DataFrame(info)
-
-    # Number the trials.  We will use this number later to look up which column
-    # contains the ABR waveform for corresponding parameter.
-    info['waveform'] = np.arange(len(info))
-    info.set_index('waveform', inplace=True)
+    info.index.name = 'waveform'
 
     # Convert the intensity to the actual level in dB SPL
     info['level'] = np.round(info.intensity/10)*10
@@ -70,103 +72,131 @@ def load_metadata(filename):
 
     # The rows where level is 110 dB SPL have a different scaling factor.
     info.loc[info.level == 110, 'waveform_sf'] = 3.37e2
-
-    # Start time of stimulus in usec (since sampling period is reported in usec,
-    # we should try to be consistent with all time units).
-    info['stimulus_start'] = 12.5e3
     return info
 
 
-def load_waveforms(filename, info):
+@lru_cache(maxsize=64)
+@timing.timed('NCRAR.read_file')
+def _read_file(filename, mtime):
     '''
-    Load the waveforms stored in the ABR file
-
-    Only the waveforms specified in info will be loaded.  For example, if you
-    have filtered the info DataFrame to only contain waveforms from channel 1,
-    only those waveforms will be loaded.
-
-    Parameters:
-    -----------
-    filename : string
-        Filename to load
-    info : pandas.DataFrame
-        Waveform metadata (see `load_metadata`)
+    Load the metadata and waveforms stored in the ABR file in a single pass
 
     Returns
     -------
     info : pandas.DataFrame
-        Dataframe containing waveforms
-
+        Dataframe containing information on each waveform
+    waveforms : 2D array
+        Waveform x sample array (in uV) in the same order as info.
     '''
-    # Read the waveform table into a dataframe
-    df = pd.io.parsers.read_csv(filename, skiprows=20)
-
-    # Keep only the columns containing the signal of interest.  There are six
-    # columns for each trial.  We only want the column containing the raw
-    # average (i.e., not converted to uV).
-    df = df[[c for c in df.columns if c.startswith('Average:')]]
-
-    # Renumber them so we can look them up by number.  The numbers should
-    # correspond to the trial number we generated in `load_metadata`.
-    df.columns = np.arange(len(df.columns))
-
-    # Loop through the entries in the info DataFrame.  This dataframe contains
-    # metadata needed for processing the waveform (e.g., it tells us which
-    # waveforms to keep, the scaling factor to use, etc.).
-    signals = []
-    for w_index, w_info in info.iterrows():
-        # Compute time of each point.  Currently in usec because smp. period is
-        # in usec.
-        t = np.arange(len(df), dtype=np.float32)*w_info['smp. period']
-        # Subtract stimulus start so that t=0 is when stimulus begins.  Convert
-        # to msec.
-        t = (t-w_info['stimulus_start'])*1e-3
-        time = pd.Index(t, name='time')
-
-        # Divide by the scaling factor and convert from nV to uV
-        s = df[w_index]/w_info['waveform_sf']*1e-3
-        s.index = time
-        signals.append(s)
-
-    # Merge together the waveforms into a single DataFrame
-    waveforms = pd.concat(signals, keys=info.index, names=['waveform'])
-    waveforms = waveforms.unstack(level='waveform')
-    return waveforms
+    with filename.open() as fh:
+        header = [fh.readline() for _ in range(N_HEADER)]
+        if not header[0].startswith('Identifier:'):
+            raise IOError('Unsupported file format')
+        info = _parse_metadata(header)
+
+        # There are six columns for each waveform. We only want the column
+        # containing the raw average (i.e., not converted to uV). They are in
+        # the same order as the waveforms in the header.
+        data = pd.read_csv(fh, usecols=lambda c: c.startswith('Average:'),
+                           dtype=np.float64)
+
+    # Divide by the scaling factor and convert from nV to uV
+    waveforms = data.values.T / info['waveform_sf'].values[:, np.newaxis]
+    return info, waveforms * 1e-3
+
+
+def read_file(filename):
+    # The modification time is part of the cache key so that files that are
+    # rewritten (e.g., while a run is acquiring) are read again.
+    return _read_file(filename, filename.stat().st_mtime_ns)
+
+
+timing.register_counters('NCRAR.read_file',
+                         lambda: _read_file.cache_info()._asdict())
+
+
+class NCRARDataCollection(DataCollection):
+
+    def __init__(self, filename, channel=1):
+        self.filename = Path(filename)
+        self.channel = channel
+
+    @cached_property
+    def info(self):
+        info, _ = read_file(self.filename)
+        return info[info.channel == self.channel]
+
+    @cached_property
+    def fs(self):
+        return 1 / (self.info['smp. period'].iloc[0] * 1e-6)
+
+    @cached_property
+    def data(self):
+        '''
+        Waveforms indexed by frequency and level with time (msec re. stimulus
+        onset) as the columns. Samples acquired before the stimulus are
+        dropped.
+        '''
+        _, waveforms = read_file(self.filename)
+        info = self.info
+        waveforms = waveforms[info.index.values]
+        t = (np.arange(waveforms.shape[-1]) * 1e6 / self.fs - STIMULUS_START)
+        t = t * 1e-3
+        mask = t >= 0
+        index = pd.MultiIndex.from_arrays(
+            [info['stim. freq.'].values, info['level'].values],
+            names=['frequency', 'level'])
+        columns = pd.Index(t[mask], name='time')
+        return pd.DataFrame(waveforms[:, mask], index=index, columns=columns) \
+            .sort_index()
+
+    @cached_property
+    def frequencies(self):
+        return self.data.index.unique('frequency').values
+
+    @property
+    def name(self):
+        return self.filename.stem
+
+    def iter_frequencies(self):
+        for frequency in self.frequencies:
+            yield NCRARDataset(self, frequency)
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'channel': self.channel}
+
+
+class NCRARDataset(Dataset):
+
+    def get_series(self, filter_settings=None):
+        data = self.parent.data.loc[self.frequency]
+        values = filter_data(data.values, self.fs, filter_settings)
+        time = data.columns
+
+        waveforms = []
+        for level, w in zip(data.index.values, values):
+            w = pd.Series(w, index=time)
+            waveforms.append(ABRWaveform(self.fs, w, float(level)))
+
+        series = ABRSeries(waveforms, self.frequency)
+        series.filename = self.filename
+        series.id = self.parent.name
+        series.dataset = self
+        return series
 
 
 ################################################################################
 # API
 ################################################################################
-
-# Minimum wave 1 latencies
-latencies = {
-    1000: 3.1,
-    3000: 2.1,
-    4000: 2.3,
-    6000: 1.8,
-}
-
-def load(fname, filter=None, abr_window=8.5e-3):
-    with open(fname) as fh:
-        line = fh.readline()
-        if not line.startswith('Identifier:'):
-            raise IOError('Unsupported file format')
-    info = load_metadata(fname)
-    info = info[info.channel == 1]
-    fs = 1/(info.iloc[0]['smp. period']*1e-6)
-    series = []
-    for frequency, f_info in info.groupby('stim. freq.'):
-        signal = load_waveforms(fname, f_info)
-        signal = signal[signal.index >= 0]
-        waveforms = []
-        min_latency = latencies.get(frequency)
-        for i, row in f_info.iterrows():
-            s = signal[i].values[np.newaxis]
-            waveform = ABRWaveform(fs, s, row['level'], min_latency=min_latency,
-                                   filter=filter)
-            waveforms.append(waveform)
-
-        s = ABRSeries(waveforms, frequency/1e3)
-        s.filename = fname
-        series.append(s)
-    return series
+def load(fname, filter_settings=None):
+    collection = NCRARDataCollection(fname)
+    return [ds.get_series(filter_settings) \
+            for ds in collection.iter_frequencies()]
+
+
+def iter_all(path):
+    path = Path(path)
+    if path.is_file():
+        yield from NCRARDataCollection(path).iter_frequencies()
+    else:
+        yield from registry.iter_all(path, ['NCRAR'])
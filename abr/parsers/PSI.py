@@ -1,16 +1,18 @@
 from functools import cached_property, lru_cache
 import glob
+import io
 import json
 import os.path
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from scipy import signal
 
+from abr import timing
+from abr.bootstrap import EpochReducer, response_noise_ratio
 from abr.datatype import ABRWaveform, ABRSeries
 
-from .dataset import DataCollection, Dataset
+from .dataset import DataCollection, Dataset, filter_data
 
 
 def get_filename(pathname, suffix='ABR average waveforms.csv'):
@@ -29,7 +31,8 @@ def get_filename(pathname, suffix='ABR average waveforms.csv'):
 
 
 @lru_cache(maxsize=64)
-def read_file(filename):
+@timing.timed('PSI.read_file')
+def _read_file(filename, mtime):
     with filename.open() as fh:
         # This supports a variable-length header where we may not have included
         # some levels (e.g., epoch_n and epoch_reject_ratio).
@@ -51,6 +54,16 @@ def read_file(filename):
     return data.T
 
 
+def read_file(filename):
+    # The modification time is part of the cache key so that files that are
+    # rewritten (e.g., while a run is acquiring) are read again.
+    return _read_file(filename, filename.stat().st_mtime_ns)
+
+
+timing.register_counters('PSI.read_file',
+                         lambda: _read_file.cache_info()._asdict())
+
+
 class PSIDataCollection(DataCollection):
 
     def __init__(self, filename):
@@ -66,17 +79,38 @@ class PSIDataCollection(DataCollection):
             fs = np.mean(np.diff(data.columns.values)**-1)
         return fs
 
+    @cached_property
+    def _averages(self):
+        return read_file(self.filename)
+
     @cached_property
     def data(self):
-        data = read_file(self.filename)
+        data = self._averages
         keep = ['frequency', 'level']
         drop = [c for c in data.index.names if c not in keep]
         return data.reset_index(drop, drop=True)
 
+    @cached_property
+    def epoch_info(self):
+        '''
+        Per-waveform information from the header of the average waveforms file
+        (e.g., epoch_n and epoch_reject_ratio) indexed by frequency and level.
+        '''
+        return self._averages.index.to_frame(index=False) \
+            .set_index(['frequency', 'level'])
+
+    @cached_property
+    def epochs(self):
+        return PSIEpochs(self)
+
     @cached_property
     def frequencies(self):
         return self.data.index.unique('frequency').values
 
+    @property
+    def time(self):
+        return self.data.columns.values
+
     @property
     def name(self):
         return self.filename.parent.stem
@@ -100,13 +134,13 @@ class PSIDataset(Dataset):
     def fs(self):
         return self.parent.fs
 
+    def get_epochs(self):
+        return self.parent.epochs
+
     def get_series(self, filter_settings=None):
         data = self.parent.data.loc[self.frequency]
         if filter_settings is not None:
-            Wn = filter_settings['highpass'], filter_settings['lowpass']
-            N = filter_settings['order']
-            b, a = signal.iirfilter(N, Wn, fs=self.fs)
-            data_filt = signal.filtfilt(b, a, data.values, axis=-1)
+            data_filt = filter_data(data.values, self.fs, filter_settings)
             data = pd.DataFrame(data_filt, columns=data.columns, index=data.index)
 
         waveforms = []
@@ -121,6 +155,408 @@ class PSIDataset(Dataset):
         return series
 
 
+#: Columns of the epoch metadata containing the frequency and level of each
+#: epoch (in order of preference). Click runs have no frequency column.
+FREQUENCY_COLUMNS = ['target_tone_frequency', 'frequency']
+LEVEL_COLUMNS = ['target_tone_level', 'target_click_level', 'level']
+
+
+def _find_column(columns, names):
+    for name in names:
+        if name in columns:
+            return name
+    return None
+
+
+def format_epoch_metadata(metadata):
+    '''
+    Return the onset (t0, sec), frequency and level of each epoch from the
+    epoch metadata saved by psiexperiment ("erp_metadata.csv")
+
+    Frequency and level are float32 to match the average waveforms file.
+    Clicks have a frequency of -1.
+    '''
+    level = _find_column(metadata.columns, LEVEL_COLUMNS)
+    if 't0' not in metadata or level is None:
+        raise IOError('Unsupported epoch metadata')
+    frequency = _find_column(metadata.columns, FREQUENCY_COLUMNS)
+    if frequency is None:
+        frequency = np.full(len(metadata), -1, dtype='f')
+    else:
+        frequency = metadata[frequency].replace('click', -1).astype('f')
+    return pd.DataFrame({
+        't0': metadata['t0'].astype(float).values,
+        'frequency': np.asarray(frequency, dtype='f'),
+        'level': metadata[level].astype('f').values,
+    })
+
+
+def open_eeg(path):
+    '''
+    Open the continuous EEG saved by psiexperiment
+
+    Depending on the version of psiexperiment, the EEG is saved as a zarr
+    ("eeg.zarr" or "eeg") or bcolz ("eeg") array. The corresponding package
+    must be installed to read it. Samples are only read from disk as the
+    array is sliced.
+
+    Returns
+    -------
+    eeg : array
+        EEG samples. If there is more than one channel, the last axis is time.
+    fs : float
+        Sampling rate of the EEG (Hz).
+    '''
+    path = Path(path)
+    for store in (path / 'eeg.zarr', path / 'eeg'):
+        if (store / '.zarray').exists() or (store / 'zarr.json').exists():
+            import zarr
+            eeg = zarr.open_array(str(store), mode='r')
+            return eeg, float(eeg.attrs['fs'])
+    store = path / 'eeg'
+    if store.is_dir():
+        import bcolz
+        eeg = bcolz.carray(rootdir=str(store), mode='r')
+        return eeg, float(eeg.attrs['fs'])
+    raise IOError(f'Could not find EEG for {path}')
+
+
+def read_epochs(eeg, start, n_samples):
+    '''
+    Read epochs from the EEG
+
+    Since the arrays are stored in compressed chunks, epochs separated by
+    less than the duration of an epoch are read together (i.e., as the span
+    of EEG covering them). Otherwise, only the samples of each epoch are
+    read.
+
+    Parameters
+    ----------
+    eeg : array
+        EEG (see `open_eeg`). Only the first channel is read.
+    start : array of int
+        Index of the first sample of each epoch.
+    n_samples : int
+        Number of samples in each epoch.
+
+    Returns
+    -------
+    epochs : 2D array
+        Epoch x time array.
+    '''
+    start = np.asarray(start, dtype=int)
+    if not len(start):
+        return np.empty((0, n_samples))
+    epochs = []
+    gap = np.diff(start)
+    breaks = np.flatnonzero((gap > 2 * n_samples) | (gap < 0)) + 1
+    for run in np.split(start, breaks):
+        lb, ub = run.min(), run.max() + n_samples
+        samples = eeg[lb:ub] if eeg.ndim == 1 else eeg[0, lb:ub]
+        samples = np.asarray(samples, dtype=float)
+        epochs.append(samples[(run - lb)[:, np.newaxis] + np.arange(n_samples)])
+    return np.concatenate(epochs)
+
+
+class PSIEpochs:
+    '''
+    Access to the individual epochs of a psiexperiment run
+
+    psiexperiment saves the continuous EEG (see `open_eeg`) along with a
+    table of the onset (t0), frequency and level of each epoch
+    ("erp_metadata.csv"). Each epoch spans the same time window (relative to
+    its onset) as the average waveforms file.
+
+    Epochs are only read from disk as they are requested, so this can be used
+    with recordings that are too large to fit in memory.
+    '''
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.path = parent.filename.parent
+        self.metadata_filename = self.path / 'erp_metadata.csv'
+
+    @cached_property
+    def metadata(self):
+        return format_epoch_metadata(pd.read_csv(self.metadata_filename))
+
+    def get_eeg(self):
+        # Opened on each call so that samples saved since the last call (if
+        # the run is acquiring) are included.
+        return open_eeg(self.path)[0]
+
+    @cached_property
+    def fs(self):
+        return open_eeg(self.path)[1]
+
+    @property
+    def time(self):
+        return self.parent.time
+
+    @property
+    def n_samples(self):
+        return len(self.time)
+
+    def get_start(self, t0):
+        '''
+        Return index of the first EEG sample of the epochs with the onsets
+        '''
+        t0 = np.asarray(t0, dtype=float) + self.time[0] * 1e-3
+        return np.round(t0 * self.fs).astype(int)
+
+    def get_indices(self, frequency, level=None, eeg=None):
+        '''
+        Return indices of the epochs that have been saved
+
+        If level is None, the epochs of all levels are returned.
+        '''
+        if eeg is None:
+            eeg = self.get_eeg()
+        metadata = self.metadata
+        start = self.get_start(metadata['t0'].values)
+        mask = (metadata['frequency'].values == frequency) & \
+            (start >= 0) & (start + self.n_samples <= eeg.shape[-1])
+        if level is not None:
+            mask &= metadata['level'].values == level
+        return np.flatnonzero(mask)
+
+    def get_levels(self, frequency):
+        metadata = self.metadata
+        mask = metadata['frequency'].values == frequency
+        return np.unique(metadata['level'].values[mask])
+
+    def iter_chunks(self, frequency, level=None, chunk_size=256):
+        '''
+        Iterate through epochs for the frequency in a single pass
+
+        Parameters
+        ----------
+        level : {None, float}
+            If None, the epochs of all levels are returned (in the order they
+            were acquired).
+
+        Yields
+        ------
+        levels : 1D array
+            Level of each epoch.
+        epochs : 2D array
+            Epoch x time array containing up to `chunk_size` epochs.
+        '''
+        eeg = self.get_eeg()
+        indices = self.get_indices(frequency, level, eeg)
+        start = self.get_start(self.metadata['t0'].values[indices])
+        levels = self.metadata['level'].values[indices]
+        for i in range(0, len(indices), chunk_size):
+            yield levels[i:i+chunk_size], \
+                read_epochs(eeg, start[i:i+chunk_size], self.n_samples)
+
+
+class PSILiveCollection(PSIDataCollection):
+    '''
+    Run that is still acquiring
+
+    The average waveforms file is not saved until the run is complete, so the
+    averages are computed from the epochs as they are saved (see
+    `PSILiveAverage`). Analyses are saved under the same name as the analyses
+    of the completed run.
+
+    Parameters
+    ----------
+    path : {str, Path}
+        Folder containing the run.
+    epoch_size : float
+        Duration of each epoch (sec) starting at its onset. Ignored once the
+        run is complete, in which case the time window of the average
+        waveforms file is used.
+    '''
+
+    def __init__(self, path, epoch_size=8.5e-3):
+        path = Path(path)
+        try:
+            self.filename = get_filename(path)
+        except IOError:
+            self.filename = path / 'ABR average waveforms.csv'
+        self.epoch_size = epoch_size
+        self._frequencies = None
+
+    @cached_property
+    def fs(self):
+        return self.epochs.fs
+
+    @cached_property
+    def time(self):
+        if self.filename.exists():
+            return super().time
+        n_samples = int(round(self.epoch_size * self.fs))
+        return np.arange(n_samples) / self.fs * 1e3
+
+    @property
+    def frequencies(self):
+        # New frequencies may be added as the run acquires, so the metadata is
+        # read again whenever it has grown.
+        size = self.epochs.metadata_filename.stat().st_size
+        if self._frequencies is None or self._frequencies[0] != size:
+            text = self.epochs.metadata_filename.read_text()
+            # Only use complete lines.
+            text = text[:text.rfind('\n') + 1]
+            metadata = pd.read_csv(io.StringIO(text))
+            frequency = format_epoch_metadata(metadata)['frequency']
+            self._frequencies = size, frequency.unique()
+        return self._frequencies[1]
+
+    def iter_frequencies(self):
+        for frequency in self.frequencies:
+            yield PSILiveDataset(self, frequency)
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'epoch_size': self.epoch_size}
+
+
+class PSILiveDataset(PSIDataset):
+
+    def get_live_average(self):
+        return PSILiveAverage(self.parent.epochs, self.frequency)
+
+    def get_series(self, filter_settings=None):
+        live = self.get_live_average()
+        live.update()
+        waveforms = [ABRWaveform(self.fs, s, level) for level, s in \
+                     live.get_signals(filter_settings=filter_settings).items()]
+        series = ABRSeries(waveforms, self.frequency)
+        series.filename = self.parent.filename
+        series.id = self.parent.name
+        series.dataset = self
+        return series
+
+
+class PSILiveAverage:
+    '''
+    Running average of the epochs for one frequency of a run that is acquiring
+
+    Each call to `update` reads only the epochs saved since the last call
+    (epochs are only used once both their row in the metadata file and all of
+    their EEG samples have been written) and adds them to the running sums
+    for each level.
+    '''
+
+    def __init__(self, epochs, frequency):
+        self.epochs = epochs
+        self.frequency = frequency
+        self.n_read = 0
+        self.reducers = {}
+        self._header = None
+        self._metadata_offset = 0
+        self._metadata = []
+
+    def _read_metadata(self):
+        with self.epochs.metadata_filename.open('rb') as fh:
+            fh.seek(self._metadata_offset)
+            text = fh.read()
+        # Only use complete lines.
+        end = text.rfind(b'\n') + 1
+        self._metadata_offset += end
+        lines = text[:end].decode().splitlines()
+        if self._header is None and lines:
+            self._header = lines.pop(0)
+        if not lines:
+            return
+        metadata = pd.read_csv(io.StringIO('\n'.join([self._header] + lines)))
+        metadata = format_epoch_metadata(metadata)
+        self._metadata.extend(metadata.itertuples(index=False, name=None))
+
+    def update(self):
+        '''
+        Read new epochs
+
+        Returns
+        -------
+        levels : set
+            Levels that have new epochs.
+        '''
+        self._read_metadata()
+        if len(self._metadata) <= self.n_read:
+            return set()
+
+        eeg = self.epochs.get_eeg()
+        n_samples = self.epochs.n_samples
+        metadata = np.array(self._metadata[self.n_read:])
+        start = self.epochs.get_start(metadata[:, 0])
+        # Epochs are saved in order, so stop at the first epoch that does not
+        # have all of its samples yet.
+        incomplete = np.flatnonzero(start + n_samples > eeg.shape[-1])
+        n_new = incomplete[0] if len(incomplete) else len(metadata)
+        if n_new == 0:
+            return set()
+        self.n_read += n_new
+
+        mask = (metadata[:n_new, 1] == self.frequency) & (start[:n_new] >= 0)
+        levels = metadata[:n_new][mask, 2]
+        epochs = read_epochs(eeg, start[:n_new][mask], n_samples)
+        changed = set()
+        for level in np.unique(levels):
+            level = float(level)
+            if level not in self.reducers:
+                self.reducers[level] = EpochReducer(n_samples, n_boot=0)
+            self.reducers[level].update(epochs[levels == level])
+            changed.add(level)
+        return changed
+
+    def get_n_epochs(self):
+        return {level: r.n for level, r in self.reducers.items()}
+
+    def get_response_noise_ratio(self, filter_settings=None, window=(1, 7)):
+        '''
+        Return response-to-noise ratio (see `bootstrap.response_noise_ratio`)
+        keyed by level
+
+        This can be used to decide whether the response at a level is clearly
+        above (or below) threshold before all epochs have been acquired.
+        '''
+        levels = sorted(self.reducers)
+        if not levels:
+            return {}
+        fs = self.epochs.parent.fs
+        average, average_pm = zip(*[self.reducers[l].get_average() \
+                                    for l in levels])
+        # The plus-minus average is undefined until there are at least two
+        # epochs.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            average = filter_data(np.vstack(average), fs, filter_settings)
+            average_pm = filter_data(np.vstack(average_pm), fs,
+                                     filter_settings)
+            ratio = response_noise_ratio(self.epochs.time, average,
+                                         average_pm, window)
+        return dict(zip(levels, ratio))
+
+    def get_signals(self, levels=None, filter_settings=None):
+        '''
+        Return average waveform for each level
+
+        Parameters
+        ----------
+        levels : {None, iterable}
+            Levels to return. If None, all levels are returned.
+        filter_settings : {None, dict}
+            Filter to apply (see `Parser`).
+
+        Returns
+        -------
+        signals : dict
+            Average (pandas.Series indexed by time) keyed by level.
+        '''
+        if levels is None:
+            levels = self.reducers.keys()
+        levels = sorted(levels)
+        if not levels:
+            return {}
+        averages = np.vstack([self.reducers[l].get_average()[0] \
+                              for l in levels])
+        averages = filter_data(averages, self.epochs.parent.fs,
+                               filter_settings)
+        time = pd.Index(self.epochs.time, name='time')
+        return {l: pd.Series(a, index=time) for l, a in zip(levels, averages)}
+
+
 def iter_all(path):
     results = []
     path = Path(path)
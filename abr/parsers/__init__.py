@@ -19,28 +19,43 @@ The save function must return a message.  If there is an error in saving, throw
 the appropriate exception.
 '''
 
-import importlib
 import re
 from glob import glob
 import os
 from pathlib import Path
+import threading
 import time
 
 import pandas as pd
 import numpy as np
 
 import abr
+from .. import timing
 from ..datatype import Point
+from . import registry
 
 
-def waveform_string(waveform):
-    data = [f'{waveform.level:.2f}']
-    data.append(f'{waveform.mean(0, 1)}')
-    data.append(f'{waveform.std(0, 1)}')
-    for _, point in sorted(waveform.points.items()):
-        data.append(f'{point.latency:.8f}')
-        data.append(f'{point.amplitude:.8f}')
-    return '\t'.join(data)
+def spreadsheet_string(model, point_keys):
+    '''
+    Format the analysis table for the series
+
+    Baseline statistics and point measures for all levels are computed in a
+    single pass over the level x time signal matrix and the rows are written
+    highest level first.
+    '''
+    levels = model.levels
+    mean = model.mean(0, 1)
+    std = model.std(0, 1)
+    latency, amplitude = model.get_point_measures(point_keys)
+
+    n = len(point_keys)
+    measures = np.empty((len(levels), n * 2))
+    measures[:, ::2] = latency
+    measures[:, 1::2] = amplitude
+
+    row = '\t'.join(['{:.2f}', '{}', '{}'] + ['{:.8f}'] * (n * 2))
+    rows = zip(levels[::-1], mean[::-1], std[::-1], measures[::-1])
+    return '\n'.join(row.format(l, m, s, *v) for l, m, s, v in rows)
 
 
 def filter_string(waveform):
@@ -115,28 +130,104 @@ def parse_peaks(peaks, threshold):
     return p_latencies, n_latencies
 
 
+class SeriesCache:
+    '''
+    Reference-counted cache of loaded series
+
+    Entries are keyed by dataset and filter settings. Each call to `acquire`
+    returns a new series with its own threshold and points that shares the
+    (read-only) waveform data of the cached series. The entry is discarded
+    once every series acquired from it has been released.
+    '''
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(dataset, filter_settings):
+        if filter_settings is not None:
+            filter_settings = tuple(sorted(filter_settings.items()))
+        return dataset, filter_settings
+
+    def acquire(self, dataset, filter_settings):
+        key = self._key(dataset, filter_settings)
+        # The lookup and the increment must be done together. Otherwise, the
+        # entry can be discarded by `release` in between.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] += 1
+        timing.count('SeriesCache.miss' if entry is None else 'SeriesCache.hit')
+        if entry is None:
+            # Load outside the lock so that other datasets can be loaded in
+            # parallel.
+            with timing.span('Parser.load', dataset):
+                series = dataset.get_series(filter_settings)
+            with self._lock:
+                entry = self._entries.setdefault(key, [series, 0])
+                entry[1] += 1
+        series = entry[0].copy()
+        series.cache_key = key
+        return series
+
+    def release(self, series):
+        key = getattr(series, 'cache_key', None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            # Releasing the same series more than once has no effect.
+            series.cache_key = None
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class Parser(object):
 
-    def __init__(self, file_format, filter_settings, user=None):
+    def __init__(self, file_format=None, filter_settings=None, user=None):
         '''
         Parameters
         ----------
-        file_format : string
-            File format that will be loaded.
+        file_format : {None, string}
+            File format that will be loaded (see `registry`). If None or
+            'auto', the format of each file is detected when scanning.
         filter_settings : {None, dict}
             If None, no filtering is applied. If dict, must contain ftype,
             lowpass, highpass and order as keys.
         user : {None, string}
             Person analyzing the data.
         '''
+        if file_format == 'auto':
+            file_format = None
         self._file_format = file_format
         self._filter_settings = filter_settings
         self._rater = user
-        self._module_name = f'abr.parsers.{file_format}'
-        self._module = importlib.import_module(self._module_name)
+        self._format = None if file_format is None \
+            else registry.get_format(file_format)
+        self._cache = SeriesCache()
 
     def load(self, fs):
-        return fs.get_series(self._filter_settings)
+        with timing.span('Parser.load', fs):
+            return fs.get_series(self._filter_settings)
+
+    def acquire(self, fs):
+        '''
+        Load series through the shared cache
+
+        Series acquired for the same dataset share the waveform data, so views
+        of the same dataset (e.g., the presenters in compare mode) only load
+        and filter it once. Each series must be released (see `release`) once
+        it is no longer needed.
+        '''
+        return self._cache.acquire(fs, self._filter_settings)
+
+    def release(self, series):
+        self._cache.release(series)
 
     def save(self, model):
         # Assume that all waveforms were filtered identically
@@ -151,8 +242,7 @@ class Parser(object):
                 columns.append(f'{point_type_code}{point_number} {measure}')
 
         columns = '\t'.join(columns)
-        spreadsheet = '\n'.join(waveform_string(w) \
-                                for w in reversed(model.waveforms))
+        spreadsheet = spreadsheet_string(model, point_keys)
 
         if model.freq == -1:
             stimulus = 'Stimulus: click'
@@ -172,7 +262,10 @@ class Parser(object):
             fh.writelines(content)
 
     def iter_all(self, path):
-        yield from self._module.iter_all(path)
+        if self._format is None:
+            yield from registry.iter_all(path)
+        else:
+            yield from self._format.iter_all(path)
 
     def find_processed(self, path):
         for ds in self.iter_all(path):
@@ -229,6 +322,7 @@ NOTE: Negative latencies indicate no peak. NaN for amplitudes indicate peak was
 
 
 PARSER_MAP = {
+    'auto': 'Detect automatically',
     'PSI': 'psiexperiment',
     'NCRAR': 'IHS text export',
     'EPL': 'EPL CFTS',
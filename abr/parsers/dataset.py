@@ -2,10 +2,37 @@ import functools
 from pathlib import Path
 import re
 
+from scipy import signal
+
+from abr import timing
+
 
 P_RATER = re.compile('.*(?:kHz|click)(?:-(\w+))?-analyzed.txt')
 
 
+@timing.timed('filter_data')
+def filter_data(data, fs, filter_settings):
+    '''
+    Bandpass filter data along the last axis
+
+    Parameters
+    ----------
+    data : array
+        Data to filter.
+    fs : float
+        Sampling rate of data.
+    filter_settings : {None, dict}
+        If None, data is returned unchanged. Otherwise, must contain lowpass,
+        highpass and order as keys.
+    '''
+    if filter_settings is None:
+        return data
+    Wn = filter_settings['highpass'], filter_settings['lowpass']
+    N = filter_settings['order']
+    b, a = signal.iirfilter(N, Wn, fs=fs)
+    return signal.filtfilt(b, a, data, axis=-1)
+
+
 def get_rater(filename):
     try:
         return P_RATER.match(filename.name).group(1)
@@ -37,11 +64,17 @@ class DataCollection:
     def iter_frequencies(self):
         raise NotImplementedError
 
+    def __getstate__(self):
+        # Do not pickle cached data (e.g., when saving the batch work queue).
+        return {'filename': self.filename}
+
 
 @functools.total_ordering
 class Dataset:
 
     filename_template = '{filename}-{frequency}-{rater}analyzed.txt'
+    lock_template = '{filename}-{frequency}.lock'
+    journal_template = '{filename}-{frequency}-{rater}journal.jsonl'
 
     def __init__(self, parent, frequency):
         self.parent = parent
@@ -58,19 +91,39 @@ class Dataset:
     def get_series(self, filter_settings=None):
         raise NotImplementedError
 
-    def get_analyzed_filename(self, rater):
+    def get_epochs(self):
+        raise NotImplementedError
+
+    def _get_frequency_label(self):
         if self.frequency == -1:
-            frequency = 'click'
-        else:
-            frequency = str(round(self.frequency * 1e-3, 3)) + 'kHz'
-        print(frequency)
+            return 'click'
+        return str(round(self.frequency * 1e-3, 3)) + 'kHz'
 
+    def get_analyzed_filename(self, rater):
+        frequency = self._get_frequency_label()
         filename = self.filename.with_suffix('')
         if rater != '*':
             rater = rater + '-'
         return self.filename_template \
             .format(filename=filename, frequency=frequency, rater=rater)
 
+    def get_journal_filename(self, rater):
+        '''
+        Return name of the journal of the in-progress analysis by the rater
+        '''
+        frequency = self._get_frequency_label()
+        filename = self.filename.with_suffix('')
+        return self.journal_template \
+            .format(filename=filename, frequency=frequency, rater=rater + '-')
+
+    def get_lock_filename(self):
+        '''
+        Return name of the lease file used by the batch work queue
+        '''
+        frequency = self._get_frequency_label()
+        filename = self.filename.with_suffix('')
+        return self.lock_template.format(filename=filename, frequency=frequency)
+
     def find_analyzed_files(self):
         glob_pattern = self.get_analyzed_filename('*')
         path = Path(glob_pattern)
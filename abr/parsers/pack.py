@@ -0,0 +1,303 @@
+'''
+Consolidated study archive
+
+`pack` converts every dataset found by a parser into a single directory (the
+"pack", named with a `.abrpack` suffix) so that the study can be scanned and
+loaded without opening and parsing thousands of small files. The pack
+contains:
+
+    manifest.json
+        Version of the pack format and the dtype of the waveforms.
+    collections.csv
+        One row per collection (e.g., psiexperiment run or EPL file) with the
+        name, source filename, format and sampling rate.
+    datasets.csv
+        One row per dataset (i.e., collection and frequency) with the dtype of
+        the frequency and the location of the waveforms, levels and time in
+        the binary files.
+    waveforms.bin
+        Unfiltered waveforms (level x time for each dataset, concatenated).
+    levels.npy, time.npy
+        Levels of each waveform and time of each sample (concatenated).
+
+The pack is written to a temporary directory that is renamed once complete,
+so a pack that exists is never partially written. The binary files are
+memory-mapped when opened, so loading a dataset is a slice of the mapped file.
+Filtering is applied when the series is loaded.
+
+Analyses of packed datasets are read from and saved next to the source files
+(source filenames are stored relative to the directory containing the pack
+when possible), so they are shared with analyses of the unpacked data.
+'''
+import logging
+log = logging.getLogger(__name__)
+
+from functools import cached_property, lru_cache
+import json
+import os
+from pathlib import Path
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from abr import timing
+from abr.datatype import ABRWaveform, ABRSeries
+
+from .dataset import DataCollection, Dataset, filter_data
+
+
+PACK_VERSION = 1
+SUFFIX = '.abrpack'
+
+
+def _relative_to(filename, root):
+    try:
+        return os.path.relpath(filename, root)
+    except ValueError:
+        # Different drives on Windows.
+        return str(filename)
+
+
+def pack(parser, paths, output, dtype='<f8'):
+    '''
+    Write all datasets found by the parser to a pack
+
+    Parameters
+    ----------
+    parser : Parser
+        Parser used to find and load the datasets.
+    paths : list
+        Directories (or files) to scan.
+    output : {str, Path}
+        Name of pack to create.
+    dtype : str
+        Data type used to store the waveforms.
+
+    Returns
+    -------
+    n_datasets : int
+        Number of datasets packed.
+    '''
+    output = Path(output)
+    if output.suffix != SUFFIX:
+        output = output.with_name(output.name + SUFFIX)
+    if output.exists():
+        raise FileExistsError(f'{output} already exists')
+    tmp = output.with_name(f'.{output.name}.{os.getpid()}.tmp')
+    tmp.mkdir(parents=True)
+    try:
+        n = _write_pack(parser, paths, tmp, output.resolve().parent, dtype)
+        os.rename(tmp, output)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return n
+
+
+def _write_pack(parser, paths, output, root, dtype):
+    dtype = np.dtype(dtype)
+
+    collections = {}
+    datasets = []
+    levels = []
+    time = []
+    offset = level_offset = time_offset = 0
+
+    with (output / 'waveforms.bin').open('wb') as fh:
+        for path in paths:
+            for ds in parser.iter_all(path):
+                with timing.span('pack', ds):
+                    series = ds.get_series()
+                key = ds.parent.filename.resolve(), ds.parent.name
+                if key not in collections:
+                    collections[key] = {
+                        'collection': len(collections),
+                        'name': ds.parent.name,
+                        'filename': _relative_to(ds.filename.resolve(), root),
+                        'format': type(ds.parent).__module__.rsplit('.', 1)[-1],
+                        'fs': ds.fs,
+                    }
+                data = np.vstack([w.signal.values for w in series.waveforms])
+                fh.write(np.ascontiguousarray(data, dtype=dtype).tobytes())
+                levels.extend(w.level for w in series.waveforms)
+                time.append(series.waveforms[0].x)
+                n_levels, n_samples = data.shape
+                datasets.append({
+                    'collection': collections[key]['collection'],
+                    'frequency': ds.frequency,
+                    'frequency_dtype': np.asarray(ds.frequency).dtype.str,
+                    'offset': offset,
+                    'level_offset': level_offset,
+                    'time_offset': time_offset,
+                    'n_levels': n_levels,
+                    'n_samples': n_samples,
+                })
+                offset += data.size
+                level_offset += n_levels
+                time_offset += n_samples
+
+    np.save(output / 'levels.npy', np.array(levels, dtype='f8'))
+    time = np.concatenate(time) if time else np.array([])
+    np.save(output / 'time.npy', time.astype('f8'))
+    pd.DataFrame(list(collections.values()),
+                 columns=['collection', 'name', 'filename', 'format', 'fs']) \
+        .to_csv(output / 'collections.csv', index=False)
+    columns = ['collection', 'frequency', 'frequency_dtype', 'offset',
+               'level_offset', 'time_offset', 'n_levels', 'n_samples']
+    pd.DataFrame(datasets, columns=columns) \
+        .to_csv(output / 'datasets.csv', index=False)
+    manifest = {'version': PACK_VERSION, 'dtype': dtype.str}
+    (output / 'manifest.json').write_text(json.dumps(manifest, indent=2))
+    return len(datasets)
+
+
+class PackStore:
+    '''
+    Read-only access to a pack
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path).absolute()
+        manifest = json.loads((self.path / 'manifest.json').read_text())
+        if manifest['version'] > PACK_VERSION:
+            raise IOError(f'{self.path} was created by a newer version')
+        self.dtype = np.dtype(manifest['dtype'])
+        # Convert the tables to dictionaries since looking up individual
+        # values in a DataFrame is slow.
+        collections = pd.read_csv(self.path / 'collections.csv',
+                                  index_col='collection')
+        self.collections = collections.to_dict('index')
+        datasets = pd.read_csv(self.path / 'datasets.csv')
+        self.datasets = {}
+        self.frequencies = {c: [] for c in self.collections}
+        if 'frequency_dtype' not in datasets:
+            datasets['frequency_dtype'] = '<f8'
+        for row in datasets.itertuples(index=False):
+            # Restore the frequency with the dtype used by the source format
+            # (e.g., float32 for psiexperiment) so that packed datasets
+            # compare equal to the unpacked datasets.
+            frequency = np.dtype(row.frequency_dtype).type(row.frequency)
+            self.datasets[row.collection, frequency] = row
+            self.frequencies[row.collection].append(frequency)
+
+    @cached_property
+    def waveforms(self):
+        filename = self.path / 'waveforms.bin'
+        if filename.stat().st_size == 0:
+            return np.array([], dtype=self.dtype)
+        return np.memmap(filename, dtype=self.dtype, mode='r')
+
+    @cached_property
+    def levels(self):
+        return np.load(self.path / 'levels.npy', mmap_mode='r')
+
+    @cached_property
+    def time(self):
+        return np.load(self.path / 'time.npy', mmap_mode='r')
+
+    def get_source(self, collection):
+        # Normalize so that the source compares equal to the filename of the
+        # unpacked dataset.
+        filename = self.path.parent / self.collections[collection]['filename']
+        return Path(os.path.normpath(filename))
+
+    def get_data(self, collection, frequency):
+        '''
+        Returns
+        -------
+        levels : 1D array
+        time : 1D array
+        waveforms : 2D array
+            Level x time view of the mapped waveforms.
+        '''
+        info = self.datasets[collection, frequency]
+        n_levels, n_samples = info.n_levels, info.n_samples
+        o = info.offset
+        waveforms = self.waveforms[o:o + n_levels * n_samples] \
+            .reshape((n_levels, n_samples))
+        o = info.level_offset
+        levels = self.levels[o:o + n_levels]
+        o = info.time_offset
+        time = self.time[o:o + n_samples]
+        return levels, time, waveforms
+
+
+@lru_cache(maxsize=8)
+def _open_pack(path, key):
+    return PackStore(path)
+
+
+def open_pack(path):
+    # A pack that is deleted and written again has a new manifest, so the
+    # manifest is part of the cache key to avoid serving the old pack.
+    path = Path(path).absolute()
+    st = (path / 'manifest.json').stat()
+    return _open_pack(path, (st.st_ino, st.st_mtime_ns))
+
+
+class PackDataCollection(DataCollection):
+
+    def __init__(self, filename, collection):
+        self.filename = Path(filename)
+        self.collection = collection
+
+    @property
+    def store(self):
+        return open_pack(self.filename)
+
+    @cached_property
+    def source(self):
+        return self.store.get_source(self.collection)
+
+    @property
+    def fs(self):
+        return self.store.collections[self.collection]['fs']
+
+    @property
+    def frequencies(self):
+        return np.array(self.store.frequencies[self.collection])
+
+    @property
+    def name(self):
+        return self.store.collections[self.collection]['name']
+
+    def iter_frequencies(self):
+        for frequency in self.frequencies:
+            yield PackDataset(self, frequency)
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'collection': self.collection}
+
+
+class PackDataset(Dataset):
+
+    @property
+    def filename(self):
+        # Analyses are stored next to the source file.
+        return self.parent.source
+
+    def get_series(self, filter_settings=None):
+        store = self.parent.store
+        levels, time, data = store.get_data(self.parent.collection,
+                                            self.frequency)
+        data = filter_data(data, self.fs, filter_settings)
+        time = pd.Index(time, name='time')
+
+        waveforms = []
+        for level, w in zip(levels, data):
+            w = pd.Series(w, index=time, copy=False)
+            waveforms.append(ABRWaveform(self.fs, w, float(level)))
+
+        series = ABRSeries(waveforms, self.frequency)
+        series.filename = self.filename
+        series.id = self.parent.name
+        series.dataset = self
+        return series
+
+
+def iter_all(path):
+    path = Path(path)
+    store = open_pack(path)
+    for collection in store.collections:
+        yield from PackDataCollection(path, collection).iter_frequencies()
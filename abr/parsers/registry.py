@@ -0,0 +1,192 @@
+'''
+Registry of file formats
+
+Each format is described by a `ParserFormat` that names the module
+implementing the format (i.e., the module that defines `iter_all`) and a
+sniffer that recognizes the format from the path and the first few bytes of a
+file. Sniffing does not import the parser module, so scanning a directory that
+contains several formats only imports the modules for the formats actually
+found.
+
+Additional formats can be registered by other packages using the
+`abr.parsers` entry point group. The entry point must refer to a
+`ParserFormat` instance (not the parser module itself) and should be defined
+in a lightweight module since all entry points are loaded the first time
+formats are detected. For example, in `pyproject.toml`::
+
+    [project.entry-points."abr.parsers"]
+    mylab = "mylab.abr_format:FORMAT"
+
+where `mylab/abr_format.py` contains::
+
+    from abr.parsers.registry import ParserFormat
+
+    FORMAT = ParserFormat('mylab', 'mylab.abr_parser', 'My lab format',
+                          magic=b'MYLAB')
+'''
+import logging
+log = logging.getLogger(__name__)
+
+import importlib
+from importlib import metadata
+from pathlib import Path
+import threading
+
+
+ENTRY_POINT_GROUP = 'abr.parsers'
+
+#: Number of bytes read from each file for sniffing.
+HEAD_SIZE = 64
+
+
+class ParserFormat:
+    '''
+    Parameters
+    ----------
+    name : str
+        Name of the format (as passed to `Parser`).
+    module : str
+        Name of the module implementing the format.
+    description : str
+        Human-readable description of the format.
+    magic : {None, bytes, tuple of bytes}
+        If provided, files starting with these bytes are recognized.
+    sniff : {None, callable}
+        If provided, called with the path and the first `HEAD_SIZE` bytes of
+        the file (None if the path is a directory). Returns True if the path
+        contains data in this format.
+    '''
+
+    def __init__(self, name, module, description='', magic=None, sniff=None):
+        self.name = name
+        self.module = module
+        self.description = description
+        self.magic = magic
+        self._sniff = sniff
+
+    def sniff(self, path, head):
+        if self.magic is not None and head is not None \
+                and head.startswith(self.magic):
+            return True
+        if self._sniff is not None:
+            return self._sniff(path, head)
+        return False
+
+    def load_module(self):
+        return importlib.import_module(self.module)
+
+    def iter_all(self, path):
+        yield from self.load_module().iter_all(path)
+
+    def __repr__(self):
+        return f'ParserFormat({self.name!r}, {self.module!r})'
+
+
+def _sniff_psi(path, head):
+    # psiexperiment saves each run to its own directory.
+    return head is None and 'abr_io' in path.stem
+
+
+def _sniff_pack(path, head):
+    return head is None and path.suffix == '.abrpack'
+
+
+BUILTIN_FORMATS = [
+    ParserFormat('pack', 'abr.parsers.pack', 'Packed study (see abr-pack)',
+                 sniff=_sniff_pack),
+    ParserFormat('PSI', 'abr.parsers.PSI', 'psiexperiment', sniff=_sniff_psi),
+    ParserFormat('NCRAR', 'abr.parsers.NCRAR', 'IHS text export',
+                 magic=b'Identifier:'),
+    ParserFormat('EPL', 'abr.parsers.EPL', 'EPL CFTS', magic=b':RUN-'),
+]
+
+
+_formats = None
+_formats_lock = threading.Lock()
+
+
+def _load_entry_points():
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        entry_points = entry_points.get(ENTRY_POINT_GROUP, [])
+    formats = []
+    for entry_point in entry_points:
+        try:
+            formats.append(entry_point.load())
+        except Exception as e:
+            log.warning('Could not load parser %s: %s', entry_point.name, e)
+    return formats
+
+
+def get_formats():
+    '''
+    Return registered formats keyed by name
+    '''
+    global _formats
+    with _formats_lock:
+        if _formats is None:
+            formats = {f.name: f for f in BUILTIN_FORMATS}
+            for f in _load_entry_points():
+                formats.setdefault(f.name, f)
+            _formats = formats
+    return _formats
+
+
+def get_format(name):
+    # Avoid loading the entry points for the builtin formats.
+    for f in BUILTIN_FORMATS:
+        if f.name == name:
+            return f
+    try:
+        return get_formats()[name]
+    except KeyError:
+        raise ValueError(f'Unsupported file format {name}') from None
+
+
+def read_head(path, size=HEAD_SIZE):
+    try:
+        with open(path, 'rb') as fh:
+            return fh.read(size)
+    except OSError:
+        return b''
+
+
+def detect(path, formats=None):
+    '''
+    Return format of path (or None if not recognized)
+
+    Parameters
+    ----------
+    path : Path
+        File or directory.
+    formats : {None, list of str}
+        Names of formats to check. If None, all registered formats are checked.
+    '''
+    path = Path(path)
+    head = None if path.is_dir() else read_head(path)
+    if formats is None:
+        candidates = get_formats().values()
+    else:
+        candidates = [get_format(f) for f in formats]
+    for f in candidates:
+        if f.sniff(path, head):
+            return f
+    return None
+
+
+def iter_all(path, formats=None):
+    '''
+    Iterate through all datasets under path, detecting the format of each file
+
+    Directories recognized by a format (e.g., psiexperiment runs) are not
+    searched further.
+    '''
+    path = Path(path)
+    f = detect(path, formats)
+    if f is not None:
+        yield from f.iter_all(path)
+    elif path.is_dir():
+        for child in sorted(path.iterdir()):
+            yield from iter_all(child, formats)
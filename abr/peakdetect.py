@@ -2,9 +2,12 @@ import operator as op
 
 import numpy as np
 import pandas as pd
-from scipy import signal, stats
+from scipy import signal
 
+from . import priors, timing
 
+
+@timing.timed('find_peaks')
 def find_peaks(waveform, distance=0.5e-3, prominence=50, wlen=None,
                invert=False, detrend=True):
 
@@ -29,15 +32,34 @@ def find_peaks(waveform, distance=0.5e-3, prominence=50, wlen=None,
     return metrics
 
 
+def get_candidates(waveform, invert=False, **kwargs):
+    '''
+    Return candidate peaks for waveform (see `find_peaks`)
+
+    The result is cached on the waveform (if it supports caching) since the
+    candidates only depend on the signal and the arguments. The returned
+    DataFrame must not be modified.
+    '''
+    cache = getattr(waveform, 'candidates', None)
+    if cache is None:
+        return find_peaks(waveform, invert=invert, **kwargs)
+    key = invert, tuple(sorted(kwargs.items()))
+    if key not in cache:
+        cache[key] = find_peaks(waveform, invert=invert, **kwargs)
+    return cache[key]
+
+
 def guess_peaks(metrics, latency):
     p_score_norm = metrics['prominences'] / metrics['prominences'].sum()
     guess = {}
     for i in sorted(latency.keys()):
         l = latency[i]
-        l_score = metrics['x'].apply(l.pdf)
+        l_score = pd.Series(l.pdf(metrics['x'].values), index=metrics.index)
         l_score_norm = l_score / l_score.sum()
         score = 5 * l_score_norm + p_score_norm
-        m = score.idxmax()
+        # Newer versions of pandas raise an error (rather than returning NaN)
+        # when all scores are NaN.
+        m = score.idxmax() if score.notna().any() else np.nan
         if np.isfinite(m):
             guess[i] = metrics.loc[m]
             metrics = metrics.loc[m+1:]
@@ -54,28 +76,29 @@ def generate_latencies_bound(guess, max_time=8.5, sd=0.25):
         t_lb = guess.loc[lb, 'x']
         t_ub = guess.loc[ub, 'x']
         b = (t_ub-t_lb)/sd
-        latency[lb] = stats.truncnorm(0, b, t_lb, sd)
+        latency[lb] = priors.truncnorm(0, b, t_lb, sd)
 
     g = guess.iloc[-1]
     t = g['x']
     wave = g.name
     b = (max_time-t)/sd
-    latency[wave] = stats.truncnorm(0, b, t, sd)
+    latency[wave] = priors.truncnorm(0, b, t, sd)
     return latency
 
 
 def generate_latencies_skewnorm(guess, skew=3):
     latencies = {}
     for w, row in guess.iterrows():
-        latencies[w] = stats.skewnorm(skew, row['x'], 0.1)
+        latencies[w] = priors.skewnorm(skew, row['x'], 0.1)
     return latencies
 
 
+@timing.timed('guess_iter')
 def guess_iter(waveforms, latencies, invert=False):
     waveforms = sorted(waveforms, key=op.attrgetter('level'), reverse=True)
     guesses = {}
     for w in waveforms:
-        metrics = find_peaks(w, invert=invert)
+        metrics = get_candidates(w, invert=invert)
         guesses[w.level] = guess_peaks(metrics, latencies)
         latencies = generate_latencies_skewnorm(guesses[w.level])
     return guesses
@@ -84,7 +107,7 @@ def guess_iter(waveforms, latencies, invert=False):
 def guess(waveforms, latencies, invert=False):
     guesses = {}
     for w in waveforms:
-        metrics = find_peaks(w, invert=invert)
+        metrics = get_candidates(w, invert=invert)
         guesses[w.level] = guess_peaks(metrics, latencies[w.level])
     return guesses
 
@@ -97,8 +120,8 @@ def peak_iterator(waveform, index, invert=False):
     ----------
     index : tuple of (step_mode, step_size)
     '''
-    metrics = find_peaks(waveform, distance=0.25e-3, prominence=25,
-                         invert=invert)
+    metrics = get_candidates(waveform, distance=0.25e-3, prominence=25,
+                             invert=invert)
 
     while True:
         step_mode, step_size = yield index
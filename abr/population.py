@@ -0,0 +1,372 @@
+'''
+Population summaries across collections
+
+Grand-average waveforms and the mean and SEM of the point measures (latency
+and amplitude growth) and thresholds are accumulated one dataset at a time
+using running statistics (Welford's algorithm), so memory does not grow with
+the number of datasets. Partial summaries (e.g., computed by worker processes
+on subsets of the datasets) are combined using `PopulationSummary.merge`.
+
+Datasets are grouped by a user-provided function of the dataset (e.g., mapping
+the name of each animal to a genotype). Waveforms are grouped by group,
+frequency and level. Point measures and thresholds are additionally grouped by
+rater.
+
+Only points that the rater scored (i.e., suprathreshold and not marked as
+unscorable) are included in the point measures. Thresholds that were not
+found (i.e., all levels marked as suprathreshold or subthreshold) are not
+included in the thresholds.
+'''
+from concurrent.futures import as_completed, ProcessPoolExecutor
+import os
+
+import numpy as np
+import pandas as pd
+
+from .datatype import P_LATENCY_COLUMN
+from .parsers import Parser, load_analysis
+from .parsers.dataset import get_rater
+
+
+class RunningStats:
+    '''
+    Running mean and variance of each element of an array
+
+    Observations that are not finite (e.g., NaN for missing samples) are
+    ignored, so each element has its own count.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of each observation.
+    '''
+
+    def __init__(self, shape=()):
+        self.n = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float)
+        valid = np.isfinite(x)
+        x = np.where(valid, x, 0)
+        n = self.n + valid
+        delta = np.where(valid, x - self.mean, 0)
+        mean = self.mean + np.divide(delta, n, out=np.zeros_like(delta),
+                                     where=n > 0)
+        self.m2 = self.m2 + delta * np.where(valid, x - mean, 0)
+        self.n, self.mean = n, mean
+
+    def merge(self, other):
+        '''
+        Add the observations accumulated by other
+        '''
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        scale = np.divide(other.n, n, out=np.zeros_like(n), where=n > 0)
+        self.mean = self.mean + delta * scale
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.n * scale
+        self.n = n
+
+    def get_mean(self):
+        return np.where(self.n > 0, self.mean, np.nan)
+
+    def get_std(self, ddof=1):
+        n = self.n - ddof
+        return np.sqrt(np.divide(self.m2, n, out=np.full_like(n, np.nan),
+                                 where=n > 0))
+
+    def get_sem(self):
+        n = np.where(self.n > 0, self.n, np.nan)
+        return self.get_std() / np.sqrt(n)
+
+
+def _merge_stats(stats, other):
+    for key, s in other.items():
+        if key in stats:
+            stats[key].merge(s)
+        else:
+            stats[key] = s
+
+
+def _sort_points(points):
+    # Sort points so that P1, N1, P2, N2, etc. are together.
+    return sorted(points, key=lambda p: (int(p[1:]), p[0] != 'P'))
+
+
+class PopulationSummary:
+    '''
+    Parameters
+    ----------
+    time : {None, array}
+        Time (msec) of the grand-average waveforms. Waveforms sampled at
+        other times are interpolated (samples outside the range of the
+        waveform are excluded). If None, the time of the first waveform is
+        used. Summaries can only be merged if they use the same time.
+    '''
+
+    def __init__(self, time=None):
+        self.time = None if time is None else np.asarray(time, dtype=float)
+        self.waveforms = {}
+        self.measures = {}
+        self.thresholds = {}
+
+    def add_series(self, series, group=None):
+        '''
+        Add the waveforms of the series to the grand averages
+        '''
+        x = series.x
+        if self.time is None:
+            self.time = np.asarray(x, dtype=float)
+        signal = series.get_signal()
+        if not np.array_equal(x, self.time):
+            signal = [np.interp(self.time, x, s, left=np.nan, right=np.nan) \
+                      for s in signal]
+        for level, s in zip(np.round(series.levels, 2), signal):
+            key = group, series.freq, level
+            if key not in self.waveforms:
+                self.waveforms[key] = RunningStats(len(self.time))
+            self.waveforms[key].update(s)
+
+    def add_analysis(self, frequency, threshold, points, rater, group=None):
+        '''
+        Add the threshold and point measures of a saved analysis
+
+        Parameters
+        ----------
+        frequency : float
+            Frequency of the dataset (Hz).
+        threshold : {None, float}
+            Threshold (dB SPL).
+        points : pandas.DataFrame
+            Analysis table indexed by level (see `load_analysis`).
+        rater : str
+            Name of rater.
+        '''
+        key = group, rater, frequency
+        if key not in self.thresholds:
+            self.thresholds[key] = RunningStats()
+        self.thresholds[key].update(np.nan if threshold is None else threshold)
+
+        levels = np.round(points.index.values.astype(float), 2)
+        for column in points.columns:
+            match = P_LATENCY_COLUMN.match(column)
+            if match is None:
+                continue
+            point = ''.join(match.groups())
+            amplitude_column = f'{point} Amplitude'
+            if amplitude_column not in points:
+                continue
+            latency = points[column].values.astype(float)
+            amplitude = points[amplitude_column].values.astype(float)
+            # Latencies of points that were not scored are negative.
+            scored = latency > 0
+            measures = np.where(scored[:, np.newaxis],
+                                np.stack([latency, amplitude], axis=-1),
+                                np.nan)
+            for level, m in zip(levels, measures):
+                key = group, rater, frequency, level, point
+                if key not in self.measures:
+                    self.measures[key] = RunningStats(2)
+                self.measures[key].update(m)
+
+    def merge(self, other):
+        '''
+        Add the datasets summarized by other
+        '''
+        if other.waveforms:
+            if self.time is None:
+                self.time = other.time
+            elif not np.array_equal(self.time, other.time):
+                raise ValueError('Summaries must use the same time')
+        _merge_stats(self.waveforms, other.waveforms)
+        _merge_stats(self.measures, other.measures)
+        _merge_stats(self.thresholds, other.thresholds)
+
+    def get_waveforms(self):
+        '''
+        Return grand-average waveforms
+
+        Returns
+        -------
+        waveforms : pandas.DataFrame
+            Mean, SEM and number of waveforms averaged at each time (columns)
+            indexed by group, frequency, level and statistic.
+        '''
+        keys, rows = [], []
+        for key, s in sorted(self.waveforms.items()):
+            for statistic, value in (('mean', s.get_mean()),
+                                     ('sem', s.get_sem()),
+                                     ('n', s.n)):
+                keys.append(key + (statistic,))
+                rows.append(value)
+        names = ['group', 'frequency', 'level', 'statistic']
+        index = pd.MultiIndex.from_tuples(keys, names=names) if keys \
+            else pd.MultiIndex.from_arrays([[]] * len(names), names=names)
+        columns = pd.Index([] if self.time is None else self.time, name='time')
+        return pd.DataFrame(rows, index=index, columns=columns)
+
+    def get_measures(self):
+        '''
+        Return mean and SEM of latency and amplitude of each point
+
+        Returns
+        -------
+        measures : pandas.DataFrame
+            Indexed by group, rater, frequency, level and point.
+        '''
+        keys, rows = [], []
+        for key, s in self.measures.items():
+            mean, sem = s.get_mean(), s.get_sem()
+            keys.append(key)
+            rows.append((s.n[0], mean[0], sem[0], mean[1], sem[1]))
+        names = ['group', 'rater', 'frequency', 'level', 'point']
+        columns = ['n', 'latency_mean', 'latency_sem', 'amplitude_mean',
+                   'amplitude_sem']
+        index = pd.MultiIndex.from_tuples(keys, names=names) if keys \
+            else pd.MultiIndex.from_arrays([[]] * len(names), names=names)
+        measures = pd.DataFrame(rows, index=index, columns=columns)
+        measures = measures.sort_index()
+        if measures.empty:
+            return measures
+        points = _sort_points(measures.index.unique('point'))
+        return measures.reindex(points, level='point')
+
+    def get_thresholds(self):
+        '''
+        Return mean, SD and SEM of the thresholds
+
+        Returns
+        -------
+        thresholds : pandas.DataFrame
+            Indexed by group, rater and frequency.
+        '''
+        keys, rows = [], []
+        for key, s in sorted(self.thresholds.items()):
+            keys.append(key)
+            # Statistics of scalars are 0-d arrays.
+            rows.append((float(s.n), float(s.get_mean()), float(s.get_std()),
+                         float(s.get_sem())))
+        names = ['group', 'rater', 'frequency']
+        index = pd.MultiIndex.from_tuples(keys, names=names) if keys \
+            else pd.MultiIndex.from_arrays([[]] * len(names), names=names)
+        return pd.DataFrame(rows, index=index,
+                            columns=['n', 'mean', 'sd', 'sem'])
+
+
+def summarize_datasets(file_format, filter_settings, items, rater=None,
+                       waveforms=True, time=None):
+    '''
+    Summarize datasets
+
+    Parameters
+    ----------
+    items : list of (dataset, group) tuples
+        Datasets to summarize and the group of each.
+
+    Returns
+    -------
+    summary : PopulationSummary
+    '''
+    parser = Parser(file_format, filter_settings)
+    summary = PopulationSummary(time)
+    for ds, group in items:
+        analyzed = ds.find_analyzed_files()
+        if rater is not None:
+            analyzed = [a for a in analyzed if get_rater(a) == rater]
+            if not analyzed:
+                continue
+        if waveforms:
+            summary.add_series(parser.load(ds), group)
+        for a in analyzed:
+            _, threshold, points = load_analysis(a)
+            summary.add_analysis(ds.frequency, threshold, points,
+                                 get_rater(a) or 'Unknown', group)
+    return summary
+
+
+def _summarize_datasets(args):
+    return summarize_datasets(*args)
+
+
+def summarize(parser, paths, group_by=None, rater=None, waveforms=True,
+              time=None, max_workers=None):
+    '''
+    Summarize all datasets in a single pass
+
+    Parameters
+    ----------
+    parser : Parser
+        Parser used to find and load the datasets.
+    paths : list
+        Directories to scan.
+    group_by : {None, callable}
+        Called with each dataset and returns the group of the dataset (or
+        None to skip the dataset). If None, all datasets are in one group.
+    rater : {None, str}
+        If provided, only datasets analyzed by this rater are included.
+        Otherwise, all datasets (and the analyses of all raters) are
+        included.
+    waveforms : bool
+        If True, compute the grand-average waveforms. This requires loading
+        each dataset (rather than just the analyses).
+    time : {None, array}
+        Time of the grand-average waveforms (see `PopulationSummary`). If
+        None, the time of the first dataset is used.
+    max_workers : {None, int}
+        Number of processes. If 1, datasets are summarized in this process.
+
+    Returns
+    -------
+    summary : PopulationSummary
+    '''
+    items = []
+    for path in paths:
+        for ds in parser.iter_all(path):
+            group = None if group_by is None else group_by(ds)
+            if group_by is None or group is not None:
+                items.append((ds, group))
+
+    args = parser._file_format, parser._filter_settings
+    if max_workers == 1 or not items:
+        return summarize_datasets(*args, items, rater, waveforms, time)
+
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    # Each task summarizes a chunk of datasets, so only one partial summary
+    # per chunk is sent back. The partial summaries are merged as they
+    # arrive.
+    n = max(1, min(256, len(items) // (max_workers * 4)))
+    tasks = [(*args, items[i:i+n], rater, waveforms, time) \
+             for i in range(0, len(items), n)]
+    # If the time is not provided, each task uses the time of its first
+    # dataset. Partial summaries can only be merged if they use the same
+    # time, so they are kept separate by time until all tasks are done.
+    summaries = {}
+    task_keys = {}
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(_summarize_datasets, task): i \
+                   for i, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            partial = future.result()
+            key = partial.time.tobytes() if partial.waveforms else None
+            task_keys[futures[future]] = key
+            if key in summaries:
+                summaries[key].merge(partial)
+            else:
+                summaries[key] = partial
+
+        # Use the time of the first dataset (as when summarizing in this
+        # process). Chunks that used a different time are summarized again
+        # using this time.
+        keys = [task_keys[i] for i in range(len(tasks))]
+        reference = next((k for k in keys if k is not None), None)
+        summary = summaries.pop(reference)
+        if None in summaries:
+            summary.merge(summaries.pop(None))
+        redo = [task[:-1] + (summary.time,) \
+                for task, key in zip(tasks, keys) if key in summaries]
+        for future in as_completed([executor.submit(_summarize_datasets, t) \
+                                    for t in redo]):
+            summary.merge(future.result())
+    return summary
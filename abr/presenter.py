@@ -1,3 +1,7 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from pathlib import Path
 import threading
 import queue
 
@@ -10,78 +14,29 @@ from enaml.application import timed_call
 
 from matplotlib.figure import Figure
 from matplotlib.axes import Axes
-from matplotlib import transforms as T
 
-from abr.abrpanel import WaveformPlot
-from abr.datatype import ABRSeries, WaveformPoint, Point
+from abr import timing
+from abr.abrpanel import SeriesPlot, WaveformPlot, plot_model
+from abr.datatype import ABRSeries, ABRWaveform, WaveformPoint, Point
+from abr.history import History, SeriesState
+from abr import journal
 from abr.parsers.dataset import Dataset
+from abr.workqueue import WorkQueue
 
 
-def plot_model(axes, model):
-    n = len(model.waveforms)
-    offset_step = 1/(n+1)
-    plots = []
-
-    text_trans = T.blended_transform_factory(axes.figure.transFigure,
-                                             axes.transAxes)
-
-
-    limits = [(w.y.min(), w.y.max()) for w in model.waveforms]
-    base_scale = np.mean(np.abs(np.array(limits)))
-
-    bscale_in_box = T.Bbox([[0, -base_scale], [1, base_scale]])
-    bscale_out_box = T.Bbox([[0, -1], [1, 1]])
-    bscale_in = T.BboxTransformFrom(bscale_in_box)
-    bscale_out = T.BboxTransformTo(bscale_out_box)
-
-    tscale_in_box = T.Bbox([[0, -1], [1, 1]])
-    tscale_out_box = T.Bbox([[0, 0], [1, offset_step]])
-    tscale_in = T.BboxTransformFrom(tscale_in_box)
-    tscale_out = T.BboxTransformTo(tscale_out_box)
-
-    minmax_in_box = T.Bbox([[0, 0], [1, 1]])
-    minmax_out_box = T.Bbox([[0, 0], [1, 1]])
-    minmax_in = T.BboxTransformFrom(minmax_in_box)
-    minmax_out = T.BboxTransformTo(minmax_out_box)
-
-    boxes = {
-        'tscale': tscale_in_box,
-        'tnorm': [],
-        'norm_limits': limits/base_scale,
-        'minmax': minmax_out_box,
-    }
-
-    for i, waveform in enumerate(model.waveforms):
-        y_min, y_max = waveform.y.min(), waveform.y.max()
-        tnorm_in_box = T.Bbox([[0, -1], [1, 1]])
-        tnorm_out_box = T.Bbox([[0, -1], [1, 1]])
-        tnorm_in = T.BboxTransformFrom(tnorm_in_box)
-        tnorm_out = T.BboxTransformTo(tnorm_out_box)
-        boxes['tnorm'].append(tnorm_in_box)
-
-        offset = offset_step * i + offset_step * 0.5
-        translate = T.Affine2D().translate(0, offset)
-
-        y_trans = bscale_in + bscale_out + \
-            tnorm_in + tnorm_out + \
-            tscale_in + tscale_out + \
-            translate + \
-            minmax_in + minmax_out + \
-            axes.transAxes
-        trans = T.blended_transform_factory(axes.transData, y_trans)
-
-        plot = WaveformPlot(waveform, axes, trans)
-        plots.append(plot)
-
-        text_trans = T.blended_transform_factory(axes.transAxes, y_trans)
-        axes.text(-0.05, 0, f'{waveform.level}', transform=text_trans)
-
-    axes.set_yticks([])
-    axes.grid()
-    for spine in ('top', 'left', 'right'):
-        axes.spines[spine].set_visible(False)
-
-    return plots, boxes
+def undoable(method):
+    '''
+    Decorator for presenter methods that change the analysis so that the
+    change can be undone
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.begin_change()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.end_change()
+    return wrapper
 
 
 class WaveformPresenter(Atom):
@@ -90,6 +45,7 @@ class WaveformPresenter(Atom):
     raters = List()
 
     axes = Typed(Axes)
+    series_plot = Typed(SeriesPlot)
     dataset = Typed(Dataset)
     model = Typed(ABRSeries)
 
@@ -112,40 +68,115 @@ class WaveformPresenter(Atom):
 
     parser = Value()
     latencies = Dict()
+    guesser = Value()
 
     batch_mode = Bool(False)
     interactive = Bool(True)
     modified = Bool(False)
 
+    #: If True, threshold is estimated when the series is loaded so that the
+    #: rater only needs to confirm it.
+    auto_threshold = Bool(False)
+    threshold_confidence = Float(np.nan)
+
+    #: Undo/redo history for the current series.
+    history = Typed(History, ())
+    _change_depth = Int(0)
+    _change_state = Value()
+
+    #: Journal of changes that have not been saved (None if disabled).
+    journal_filename = Value()
+
     def _default_axes(self):
         axes = self.figure.add_axes([0.1, 0.1, 0.8, 0.8])
+        axes.set_xlabel('Time (msec)')
         return axes
 
-    def __init__(self, parser, latencies, interactive=True):
+    def _default_series_plot(self):
+        return SeriesPlot(self.axes)
+
+    def __init__(self, parser, latencies, interactive=True, guesser=None):
         self.parser = parser
         self.latencies = latencies
         self.interactive = interactive
-
-    def load(self, dataset):
-        self.dataset = dataset
-        self.raters = dataset.list_raters()
-
-        self._current = 0
-        self.axes.clear()
-        self.axes.set_xlabel('Time (msec)')
-        self.model = self.parser.load(dataset)
-        self.plots, self.boxes = plot_model(self.axes, self.model)
-
-        self.normalized = False
-        self.threshold_marked = False
-        self.peaks_marked = False
-        self.valleys_marked = False
-
-        # Set current before toggle. Ordering is important.
-        self.current = len(self.model.waveforms)-1
-        self.toggle = None
-        self.update()
-        self.modified = False
+        self.guesser = guesser
+
+    def load(self, dataset, model=None):
+        '''
+        Load dataset
+
+        Parameters
+        ----------
+        dataset : Dataset
+            Dataset to load.
+        model : {None, ABRSeries}
+            Series that has already been acquired for the dataset (e.g., by
+            `AsyncLoader`). If None, the series is acquired from the parser.
+        '''
+        with timing.span('WaveformPresenter.load', dataset):
+            self.dataset = dataset
+            self.raters = dataset.list_raters()
+            self.history.clear()
+
+            self._current = 0
+            # Acquire the new series before releasing the old one so the
+            # cached data is reused if the same dataset is reloaded.
+            if model is None:
+                model = self.parser.acquire(dataset)
+            if self.model is not None:
+                self.parser.release(self.model)
+            self.model = model
+            self.plots, self.boxes = self.series_plot.load(self.model)
+
+            self.normalized = False
+            self.threshold_marked = False
+            self.peaks_marked = False
+            self.valleys_marked = False
+            self.threshold_confidence = np.nan
+            if self.auto_threshold:
+                self.preset_threshold()
+
+            self.journal_filename = None
+            recovered = False
+            if self.interactive and self.parser._rater:
+                self.journal_filename = \
+                    Path(dataset.get_journal_filename(self.parser._rater))
+                recovered = self.replay_journal()
+
+            # Set current before toggle. Ordering is important.
+            self.current = len(self.model.waveforms)-1
+            self.toggle = None
+            self.update()
+            self.modified = recovered
+
+    def replay_journal(self):
+        '''
+        Recover unsaved changes from the journal
+
+        Returns True if changes were recovered.
+        '''
+        filename = self.journal_filename
+        if not filename.exists():
+            return False
+        analyzed = Path(self.dataset.get_analyzed_filename(self.parser._rater))
+        if analyzed.exists() and \
+                analyzed.stat().st_mtime >= filename.stat().st_mtime:
+            # The analysis was saved after the last change in the journal.
+            journal.get_writer().delete(filename)
+            return False
+        records = journal.read_journal(filename)
+        if not records:
+            return False
+        flags = journal.replay(self.model, records)
+        for name, value in flags.items():
+            setattr(self, name, value)
+        return True
+
+    def _journal_change(self, old, new):
+        if self.journal_filename is None:
+            return
+        record = journal.encode_change(self.model, old, new)
+        journal.get_writer().append(self.journal_filename, record)
 
     def save(self):
         if np.isnan(self.model.threshold):
@@ -154,14 +185,77 @@ class WaveformPresenter(Atom):
             if not self.peaks_marked or not self.valleys_marked:
                 raise ValueError('Waves not identified')
         self.parser.save(self.model)
+        if self.journal_filename is not None:
+            journal.get_writer().delete(self.journal_filename)
         self.raters = self.dataset.list_raters()
         self.modified = False
 
     def update(self):
-        for p in self.plots:
-            p.update()
-        if self.axes.figure.canvas is not None:
-            self.axes.figure.canvas.draw()
+        with timing.span('WaveformPresenter.update', self.dataset):
+            for p in self.plots:
+                p.update()
+            if self.axes.figure.canvas is not None:
+                with timing.span('canvas.draw'):
+                    self.axes.figure.canvas.draw()
+
+    def _live_series(self, waveforms, threshold=np.nan):
+        series = ABRSeries(waveforms, self.dataset.frequency, threshold)
+        series.filename = self.dataset.filename
+        series.id = self.dataset.parent.name
+        series.dataset = self.dataset
+        return series
+
+    def update_live(self, signals):
+        '''
+        Update waveforms with new averages from a run that is acquiring
+
+        Only the waveforms for the levels that changed are redrawn (and only
+        their candidate peaks are discarded). If there are new levels, the
+        series is replotted, keeping the threshold, points and selection.
+
+        Parameters
+        ----------
+        signals : dict
+            Average (pandas.Series indexed by time) keyed by level.
+        '''
+        if self.model is None:
+            waveforms = [ABRWaveform(self.dataset.fs, s, l) \
+                         for l, s in signals.items()]
+            self.load(self.dataset, self._live_series(waveforms))
+            return
+
+        levels = list(self.model.levels)
+        new = []
+        for level, signal in signals.items():
+            if level not in levels:
+                new.append(ABRWaveform(self.dataset.fs, signal, level))
+                continue
+            self.model.update_signal(level, signal)
+            i = levels.index(level)
+            self.plots[i].update_signal()
+            y = self.model.waveforms[i].y
+            self.boxes['norm_limits'][i] = \
+                np.array([y.min(), y.max()]) / self.boxes['base_scale']
+
+        if new:
+            level = levels[self.current]
+            normalized, scale = self.normalized, self.scale
+            waveforms = self.model.waveforms + new
+            self.model = self._live_series(waveforms, self.model.threshold)
+            self.plots, self.boxes = self.series_plot.load(self.model)
+            self._current = list(self.model.levels).index(level)
+            self.plots[self._current].current = True
+            for plot in self.plots:
+                point = plot.point_plots.get(self._toggle)
+                if point is not None:
+                    point.current = True
+            self.scale = scale
+
+        if self.normalized or (new and normalized):
+            # Also redraws the plot.
+            self.normalized = True
+        else:
+            self.update()
 
     def _get_current(self):
         return self._current
@@ -219,9 +313,11 @@ class WaveformPresenter(Atom):
         self.boxes['minmax'].set_points(points)
         self.update()
 
+    @undoable
     def set_suprathreshold(self):
         self.set_threshold(-np.inf)
 
+    @undoable
     def set_subthreshold(self):
         self.set_threshold(np.inf)
         if self.latencies:
@@ -230,6 +326,7 @@ class WaveformPresenter(Atom):
             if not self.valleys_marked:
                 self.guess()
 
+    @undoable
     def set_threshold(self, threshold=None):
         if threshold is None:
             threshold = self.get_current_waveform().level
@@ -240,6 +337,21 @@ class WaveformPresenter(Atom):
         self.update()
         self.modified = True
 
+    def close(self):
+        '''
+        Release the series (e.g., when the tab showing it is closed)
+        '''
+        if self.model is not None:
+            self.parser.release(self.model)
+
+    def preset_threshold(self):
+        threshold, confidence = self.model.estimate_threshold()
+        self.threshold_confidence = confidence
+        # Keep the existing threshold if the fit failed. The threshold is inf
+        # if all levels are subthreshold.
+        if not np.isnan(threshold):
+            self.model.threshold = threshold
+
     def _get_toggle(self):
         return self._toggle
 
@@ -257,15 +369,18 @@ class WaveformPresenter(Atom):
                 point.current = True
         self.update()
 
+    @undoable
     def guess(self):
         if not self.latencies:
             return
         if not self.peaks_marked:
-            self.model.guess_p(self.latencies)
+            with timing.span('ABRSeries.guess_p', self.dataset):
+                self.model.guess_p(self.latencies, self.guesser)
             ptype = Point.PEAK
             self.peaks_marked = True
         elif not self.valleys_marked:
-            self.model.guess_n()
+            with timing.span('ABRSeries.guess_n', self.dataset):
+                self.model.guess_n()
             ptype = Point.VALLEY
             self.valleys_marked = True
         else:
@@ -276,16 +391,19 @@ class WaveformPresenter(Atom):
         self.update()
         self.modified = True
 
+    @undoable
     def update_point(self):
         level = self.model.waveforms[self.current].level
         self.model.update_guess(level, self.toggle)
         self.update()
 
+    @undoable
     def move_selected_point(self, step):
         point = self.get_current_point()
         point.move(step)
         self.update()
 
+    @undoable
     def set_selected_point(self, time):
         try:
             point = self.get_current_point()
@@ -296,6 +414,7 @@ class WaveformPresenter(Atom):
         except:
             pass
 
+    @undoable
     def toggle_selected_point_unscorable(self):
         try:
             point = self.get_current_point()
@@ -305,6 +424,7 @@ class WaveformPresenter(Atom):
         except:
             pass
 
+    @undoable
     def mark_unscorable(self, mode):
         try:
             for waveform in self.model.waveforms:
@@ -318,12 +438,60 @@ class WaveformPresenter(Atom):
         except:
             pass
 
+    def _capture(self):
+        flags = {
+            'threshold_marked': self.threshold_marked,
+            'peaks_marked': self.peaks_marked,
+            'valleys_marked': self.valleys_marked,
+        }
+        return SeriesState.capture(self.model, flags)
+
+    def begin_change(self):
+        '''
+        Start a change to the analysis that can be undone
+
+        Calls can be nested (e.g., when one change triggers another). The
+        state is only saved once the outermost change ends and only if the
+        analysis actually changed.
+        '''
+        if self._change_depth == 0 and self.model is not None:
+            self._change_state = self._capture()
+        self._change_depth += 1
+
+    def end_change(self):
+        self._change_depth -= 1
+        if self._change_depth == 0 and self._change_state is not None:
+            state = self._capture()
+            if state != self._change_state:
+                self.history.push(self._change_state)
+                self._journal_change(self._change_state, state)
+            self._change_state = None
+
+    def _restore(self, current, state):
+        if state is None:
+            return
+        state.restore(self.model)
+        for name, value in state.flags.items():
+            setattr(self, name, value)
+        self._journal_change(current, state)
+        self.modified = True
+        self.update()
+
+    def undo(self):
+        current = self._capture()
+        self._restore(current, self.history.undo(current))
+
+    def redo(self):
+        current = self._capture()
+        self._restore(current, self.history.redo(current))
+
     def get_current_waveform(self):
         return self.model.waveforms[self.current]
 
     def get_current_point(self):
         return self.get_current_waveform().points[self.toggle]
 
+    @undoable
     def clear_points(self):
         self.model.clear_points()
         self.peaks_marked = False
@@ -331,18 +499,21 @@ class WaveformPresenter(Atom):
         self.update()
         self.modified = True
 
+    @undoable
     def clear_peaks(self):
         self.model.clear_peaks()
         self.peaks_marked = False
         self.update()
         self.modified = True
 
+    @undoable
     def clear_valleys(self):
         self.model.clear_valleys()
         self.valleys_marked = False
         self.update()
         self.modified = True
 
+    @undoable
     def load_analysis(self, rater):
         self.clear_points()
         _, th, peaks = self.dataset.load_analysis(rater)
@@ -365,17 +536,224 @@ class WaveformPresenter(Atom):
             self.toggle = number, Point.VALLEY
 
 
-def scan_worker(parser, paths, queue, stop):
-    for path in paths:
-        for ds in parser.find_unprocessed(path):
-            queue.put(('append', ds))
+def scan_worker(work_queue, queue, stop):
+    for ds in work_queue.iter_pending(stop):
+        queue.put(('append', ds))
+    queue.put(('complete',))
+
+
+def _put_loaded(parser, filename, future, queue, stop):
+    if stop.is_set():
+        future.cancel()
+    if future.cancelled():
+        return
+    try:
+        series = future.result()
+    except Exception as e:
+        queue.put(('error', filename, e))
+        return
+    if stop.is_set():
+        parser.release(series)
+    else:
+        queue.put(('loaded', stop, series.dataset, series))
+
+
+def load_worker(parser, filenames, queue, stop, max_workers):
+    with ThreadPoolExecutor(max_workers) as executor:
+        for filename in filenames:
+            # Return the series in the order they were found so that tabs are
+            # opened in a predictable order. Series are handed back as soon
+            # as they (and all series found before them) are ready rather
+            # than waiting for the scan of the file to finish.
+            futures = deque()
+            try:
+                for ds in parser.iter_all(filename):
+                    if stop.is_set():
+                        break
+                    futures.append(executor.submit(parser.acquire, ds))
+                    queue.put(('found',))
+                    while futures and futures[0].done():
+                        _put_loaded(parser, filename, futures.popleft(),
+                                    queue, stop)
+            except Exception as e:
+                queue.put(('error', filename, e))
+
+            while futures:
+                _put_loaded(parser, filename, futures.popleft(), queue, stop)
             if stop.is_set():
                 break
-        if stop.is_set():
-            break
     queue.put(('complete',))
 
 
+class AsyncLoader(Atom):
+    '''
+    Loads datasets in the background
+
+    The datasets found in each file are loaded and filtered by a pool of
+    worker threads. As each series is ready, it is handed back to the GUI
+    thread via the `loaded` callback.
+    '''
+    parser = Value()
+    max_workers = Int(4)
+
+    #: Callback that receives the dataset and series once loaded.
+    loaded = Value()
+
+    #: Callback that receives the list of files that could not be loaded.
+    failed = Value()
+
+    n_found = Int(0)
+    n_loaded = Int(0)
+    loading = Bool(False)
+
+    _queue = Value()
+    _stop_events = List()
+    _n_active = Int(0)
+    _errors = List()
+
+    def _default__queue(self):
+        return queue.Queue()
+
+    def load(self, filenames):
+        if not self.loading:
+            self.n_found = 0
+            self.n_loaded = 0
+            self._errors = []
+            self._stop_events = []
+        # Each batch has its own event so that cancel stops all batches that
+        # are still loading.
+        stop = threading.Event()
+        self._stop_events.append(stop)
+        args = (self.parser, filenames, self._queue, stop, self.max_workers)
+        thread = threading.Thread(target=load_worker, args=args, daemon=True)
+        thread.start()
+        self._n_active += 1
+        if not self.loading:
+            self.loading = True
+            timed_call(10, self.poll)
+
+    def cancel(self):
+        for stop in self._stop_events:
+            stop.set()
+
+    def poll(self):
+        # Only handle one loaded series per call since plotting must be done
+        # on the GUI thread. This keeps the GUI responsive while loading.
+        while True:
+            try:
+                mesg = self._queue.get(block=False)
+            except queue.Empty:
+                break
+            if mesg[0] == 'found':
+                self.n_found += 1
+            elif mesg[0] == 'error':
+                self._errors.append(mesg[1])
+            elif mesg[0] == 'complete':
+                self._n_active -= 1
+            elif mesg[0] == 'loaded':
+                self.n_loaded += 1
+                stop, dataset, series = mesg[1:]
+                if stop.is_set():
+                    self.parser.release(series)
+                elif self.loaded is not None:
+                    self.loaded(dataset, series)
+                break
+
+        if self._n_active > 0 or not self._queue.empty():
+            timed_call(10, self.poll)
+        else:
+            self.loading = False
+            if self._errors and self.failed is not None:
+                self.failed(self._errors)
+
+
+def live_worker(dataset, filter_settings, interval, queue, stop):
+    live = None
+    while not stop.is_set():
+        try:
+            if live is None:
+                live = dataset.get_live_average()
+            changed = live.update()
+        except OSError:
+            # The run has not yet saved any epochs.
+            changed = set()
+        except Exception as e:
+            queue.put(('error', e))
+            return
+        if changed:
+            signals = live.get_signals(changed, filter_settings)
+            ratio = live.get_response_noise_ratio(filter_settings)
+            queue.put(('update', signals, live.get_n_epochs(), ratio))
+        stop.wait(interval)
+
+
+class LiveMonitor(Atom):
+    '''
+    Updates the presenter as a run that is acquiring saves new epochs
+
+    New epochs are read and averaged in a background thread. Only the
+    averages of the levels that have new epochs are handed back to the GUI
+    thread.
+    '''
+    presenter = Typed(WaveformPresenter)
+    dataset = Value()
+    filter_settings = Value()
+
+    #: Time (sec) between checks for new epochs.
+    interval = Float(0.5)
+
+    #: Number of epochs and response-to-noise ratio keyed by level.
+    n_epochs = Dict()
+    response_noise_ratio = Dict()
+
+    running = Bool(False)
+    error = Value()
+
+    _queue = Value()
+    _stop_event = Value()
+    _thread = Value()
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = queue.Queue()
+        self._stop_event = threading.Event()
+        args = (self.dataset, self.filter_settings, self.interval,
+                self._queue, self._stop_event)
+        self._thread = threading.Thread(target=live_worker, args=args,
+                                        daemon=True)
+        self._thread.start()
+        self.running = True
+        timed_call(10, self.poll)
+
+    def stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    def poll(self):
+        # Merge pending updates so that each level is only redrawn once.
+        signals = {}
+        while True:
+            try:
+                mesg = self._queue.get(block=False)
+            except queue.Empty:
+                break
+            if mesg[0] == 'error':
+                self.error = mesg[1]
+            elif mesg[0] == 'update':
+                signals.update(mesg[1])
+                self.n_epochs = mesg[2]
+                self.response_noise_ratio = mesg[3]
+
+        if signals:
+            self.presenter.update_live(signals)
+
+        if self._thread.is_alive():
+            timed_call(int(self.interval * 1e3), self.poll)
+        else:
+            self.running = False
+
+
 class SerialWaveformPresenter(WaveformPresenter):
 
     unprocessed = List()
@@ -384,22 +762,31 @@ class SerialWaveformPresenter(WaveformPresenter):
     current_model = Int(-1)
     batch_mode = set_default(True)
 
-    scan_paths = Value()
+    work_queue = Value()
     scan_queue = Value()
     scan_stop_event = Value()
     scan_complete = Bool(False)
     scan_thread = Value()
 
-    def __init__(self, parser, latencies, paths):
-        super().__init__(parser, latencies)
-        self.scan_paths = paths
+    #: Set once the window is closed so that the lease is no longer renewed.
+    closed = Bool(False)
+
+    def __init__(self, parser, latencies, paths, auto_threshold=False,
+                 guesser=None, work_queue=None):
+        super().__init__(parser, latencies, guesser=guesser)
+        self.auto_threshold = auto_threshold
+        if work_queue is None:
+            work_queue = WorkQueue(parser, paths)
+        self.work_queue = work_queue
         self.scan_queue = queue.Queue()
         self.scan_stop_event = threading.Event()
-        args = (self.parser, self.scan_paths, self.scan_queue, self.scan_stop_event)
+        args = (self.work_queue, self.scan_queue, self.scan_stop_event)
         self.scan_thread = threading.Thread(target=scan_worker, args=args)
         self.scan_thread.start()
         self.unprocessed = []
         timed_call(100, self.scan_poll)
+        if work_queue.locking:
+            timed_call(int(work_queue.lease_time * 500), self.renew_lease)
 
     def scan_poll(self):
         while True:
@@ -418,23 +805,51 @@ class SerialWaveformPresenter(WaveformPresenter):
             self.load_next()
 
     def scan_stop(self):
+        self.closed = True
         self.scan_stop_event.set()
 
+    def renew_lease(self):
+        if self.closed:
+            return
+        if self.dataset is not None:
+            self.work_queue.renew(self.dataset)
+        timed_call(int(self.work_queue.lease_time * 500), self.renew_lease)
+
+    def release_lease(self):
+        self.closed = True
+        if self.dataset is not None:
+            self.work_queue.release(self.dataset)
+
     def load_model(self):
         fs = self.unprocessed[self.current_model]
+        if self.dataset is not None and self.dataset != fs:
+            self.work_queue.release(self.dataset)
         self.load(fs)
 
     def load_prior(self):
         if self.current_model < 1:
             return
+        # The lease on the earlier dataset was released when the rater moved
+        # on, so it must be claimed again (it has usually been analyzed by
+        # this rater already).
+        fs = self.unprocessed[self.current_model - 1]
+        if not self.work_queue.claim(fs, processed=True):
+            raise ValueError('The previous dataset is being analyzed by '
+                             'another rater')
         self.current_model -= 1
         self.load_model()
 
     def load_next(self):
-        if self.current_model >= (len(self.unprocessed) - 1):
-            return
-        self.current_model += 1
-        self.load_model()
+        # Skip datasets that other raters have claimed (or analyzed) since the
+        # directories were scanned.
+        while self.current_model < (len(self.unprocessed) - 1):
+            fs = self.unprocessed[self.current_model + 1]
+            if self.work_queue.claim(fs):
+                self.current_model += 1
+                self.load_model()
+                break
+            self.unprocessed.pop(self.current_model + 1)
+        self.n_unprocessed = len(self.unprocessed)
 
     def save(self):
         super().save()
@@ -0,0 +1,107 @@
+'''
+Latency priors
+
+Lightweight replacements for the frozen `scipy.stats` distributions used as
+latency priors by the peak guessing algorithm. Creating a frozen scipy
+distribution is expensive relative to evaluating it, and new priors are
+created for every wave at every level each time peaks are guessed. These
+classes only support what the guessing algorithm needs (`pdf` and `mean`),
+accept the same parameters as their scipy counterparts and evaluate the pdf
+for an array of latencies in closed form.
+
+The constructors (`norm`, `truncnorm` and `skewnorm`) are memoized, so repeated
+parameter sets (e.g., when a rater corrects a single point and the guesses at
+the other levels are regenerated) return the same object.
+'''
+import functools
+
+import numpy as np
+from scipy.special import ndtr
+
+
+SQRT_2PI = np.sqrt(2 * np.pi)
+
+
+def _phi(z):
+    return np.exp(-0.5 * z ** 2) / SQRT_2PI
+
+
+class Normal:
+
+    def __init__(self, loc=0, scale=1):
+        self.loc = float(loc)
+        self.scale = float(scale)
+
+    def pdf(self, x):
+        z = (np.asarray(x, dtype=float) - self.loc) / self.scale
+        return _phi(z) / self.scale
+
+    def mean(self):
+        return self.loc
+
+    def __repr__(self):
+        return f'Normal(loc={self.loc}, scale={self.scale})'
+
+
+class TruncNorm:
+    '''
+    Normal distribution truncated to [a, b] (in units of scale relative to loc)
+    '''
+
+    def __init__(self, a, b, loc=0, scale=1):
+        self.a = float(a)
+        self.b = float(b)
+        self.loc = float(loc)
+        self.scale = float(scale)
+        self._mass = ndtr(self.b) - ndtr(self.a) if self.a < self.b else 0
+
+    def pdf(self, x):
+        z = (np.asarray(x, dtype=float) - self.loc) / self.scale
+        if self._mass <= 0:
+            return np.full(z.shape, np.nan)
+        pdf = _phi(z) / (self.scale * self._mass)
+        return np.where((z >= self.a) & (z <= self.b), pdf, 0)
+
+    def mean(self):
+        if self._mass <= 0:
+            return np.nan
+        delta = (_phi(self.a) - _phi(self.b)) / self._mass
+        return self.loc + self.scale * delta
+
+    def __repr__(self):
+        return f'TruncNorm(a={self.a}, b={self.b}, loc={self.loc}, ' \
+            f'scale={self.scale})'
+
+
+class SkewNorm:
+
+    def __init__(self, a, loc=0, scale=1):
+        self.a = float(a)
+        self.loc = float(loc)
+        self.scale = float(scale)
+
+    def pdf(self, x):
+        z = (np.asarray(x, dtype=float) - self.loc) / self.scale
+        return 2 * _phi(z) * ndtr(self.a * z) / self.scale
+
+    def mean(self):
+        delta = self.a / np.sqrt(1 + self.a ** 2)
+        return self.loc + self.scale * delta * np.sqrt(2 / np.pi)
+
+    def __repr__(self):
+        return f'SkewNorm(a={self.a}, loc={self.loc}, scale={self.scale})'
+
+
+@functools.lru_cache(maxsize=4096)
+def norm(loc=0, scale=1):
+    return Normal(loc, scale)
+
+
+@functools.lru_cache(maxsize=4096)
+def truncnorm(a, b, loc=0, scale=1):
+    return TruncNorm(a, b, loc, scale)
+
+
+@functools.lru_cache(maxsize=4096)
+def skewnorm(a, loc=0, scale=1):
+    return SkewNorm(a, loc, scale)
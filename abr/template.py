@@ -0,0 +1,261 @@
+'''
+Template-matching peak guesser
+
+The guesser is built from the analyses that raters have already saved for a
+study. For each frequency and level it stores the mean and standard deviation
+of the latency of each peak along with a template waveform (the average of the
+normalized suprathreshold waveforms). The model is stored as a compressed NumPy
+archive.
+
+When guessing, each waveform in the series is cross-correlated against the
+template for the closest frequency and level. The latency priors for that
+level are shifted by the lag that maximizes the correlation and then used to
+pick among the candidate peaks.
+'''
+import numpy as np
+from scipy import fft, interpolate
+
+from . import priors
+from .peakdetect import get_candidates, guess_peaks
+
+
+MAX_WAVES = 5
+
+
+def _normalize(y):
+    y = y - np.mean(y, axis=-1, keepdims=True)
+    norm = np.sqrt(np.sum(y ** 2, axis=-1, keepdims=True))
+    norm[norm == 0] = 1
+    return y / norm
+
+
+def _nearest(values, targets):
+    values = np.asarray(values)
+    targets = np.atleast_1d(targets)
+    return np.abs(values[:, np.newaxis] - targets).argmin(axis=0)
+
+
+class TemplateGuesser:
+    '''
+    Parameters
+    ----------
+    time : array
+        Time (msec) of each sample in the templates.
+    frequencies : array
+        Frequencies (Hz) in the model. Click is -1.
+    levels : array
+        Levels (dB SPL) in the model.
+    templates : array
+        Frequency x level x time array of templates. Templates that could not
+        be computed are NaN.
+    latency_mean : array
+        Frequency x level x wave array of mean latency (msec) of each peak.
+    latency_sd : array
+        Frequency x level x wave array of standard deviation of latency.
+    latency_n : array
+        Frequency x level x wave array of number of analyses used to compute
+        the latency statistics.
+    '''
+
+    def __init__(self, time, frequencies, levels, templates, latency_mean,
+                 latency_sd, latency_n):
+        self.time = np.asarray(time)
+        self.frequencies = np.asarray(frequencies)
+        self.levels = np.asarray(levels)
+        self.templates = np.asarray(templates)
+        self.latency_mean = np.asarray(latency_mean)
+        self.latency_sd = np.asarray(latency_sd)
+        self.latency_n = np.asarray(latency_n)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as fh:
+            return cls(**fh)
+
+    def save(self, filename):
+        np.savez_compressed(filename, time=self.time,
+                            frequencies=self.frequencies, levels=self.levels,
+                            templates=self.templates,
+                            latency_mean=self.latency_mean,
+                            latency_sd=self.latency_sd,
+                            latency_n=self.latency_n)
+
+    @classmethod
+    def from_analyses(cls, parser, study_directory, time=None):
+        '''
+        Build model from the analyses saved for all datasets in the directory
+
+        Parameters
+        ----------
+        parser : Parser
+            Parser used to find the datasets and analyses. The filter settings
+            of the parser are used when loading waveforms for the templates.
+        study_directory : {str, Path}
+            Directory containing the datasets.
+        time : {None, array}
+            Time (msec) of each sample in the templates. Defaults to 0 to 10
+            msec in steps of 10 usec.
+        '''
+        if time is None:
+            time = np.arange(0, 10, 1e-2)
+        thresholds, waves = parser.load_analyses(study_directory)
+        waves = waves.merge(thresholds, on=['dataset', 'analyzer'])
+        waves['frequency'] = waves['dataset'].map(lambda d: d.frequency)
+
+        frequencies = np.sort(waves['frequency'].unique())
+        levels = np.sort(waves['Level'].unique())
+        shape = len(frequencies), len(levels), MAX_WAVES
+
+        # Latency statistics. Subthreshold and unscorable points have negative
+        # latencies and are excluded.
+        columns = {f'P{i} Latency': i for i in range(1, MAX_WAVES + 1)}
+        columns = {k: v for k, v in columns.items() if k in waves}
+        latencies = waves.melt(id_vars=['frequency', 'Level'],
+                               value_vars=list(columns), var_name='wave',
+                               value_name='latency')
+        latencies['wave'] = latencies['wave'].map(columns)
+        latencies = latencies.query('latency > 0')
+        latency = latencies.groupby(['frequency', 'Level', 'wave'])['latency'] \
+            .agg(['mean', 'std', 'count'])
+
+        fi = np.searchsorted(frequencies, latency.index.get_level_values(0))
+        li = np.searchsorted(levels, latency.index.get_level_values(1))
+        wi = latency.index.get_level_values(2).values - 1
+        latency_mean = np.full(shape, np.nan)
+        latency_sd = np.full(shape, np.nan)
+        latency_n = np.zeros(shape, dtype=int)
+        latency_mean[fi, li, wi] = latency['mean'].values
+        latency_sd[fi, li, wi] = latency['std'].values
+        latency_n[fi, li, wi] = latency['count'].values
+
+        # Templates are the average of the normalized suprathreshold waveforms.
+        # If more than one rater analyzed the dataset, the median threshold is
+        # used.
+        total = np.zeros((len(frequencies), len(levels), len(time)))
+        count = np.zeros((len(frequencies), len(levels)))
+        dataset_th = thresholds.groupby('dataset')['thresholds'].median()
+        for dataset, threshold in dataset_th.items():
+            if np.isnan(threshold) or threshold == np.inf:
+                continue
+            series = parser.load(dataset)
+            keep = series.levels >= threshold
+            if not keep.any():
+                continue
+            y = _normalize(series.get_signal()[keep])
+            y = interpolate.interp1d(series.x, y, axis=-1, bounds_error=False,
+                                     fill_value=0)(time)
+            fi = np.searchsorted(frequencies, dataset.frequency)
+            li = np.searchsorted(levels, series.levels[keep])
+            valid = levels[np.clip(li, 0, len(levels) - 1)] == series.levels[keep]
+            total[fi, li[valid]] += y[valid]
+            count[fi, li[valid]] += 1
+
+        templates = np.full(total.shape, np.nan)
+        mask = count > 0
+        templates[mask] = _normalize(total[mask] / count[mask, np.newaxis])
+        return cls(time, frequencies, levels, templates, latency_mean,
+                   latency_sd, latency_n)
+
+    def get_lags(self, series, max_lag=0.5):
+        '''
+        Find lag (msec) of each waveform in the series relative to the template
+
+        Returns
+        -------
+        fi : int
+            Index of frequency in model.
+        li : array of int
+            Index of level in model for each waveform.
+        lag : array of float
+            Lag for each waveform. NaN if no template is available.
+        '''
+        fi = _nearest(self.frequencies, series.freq)[0]
+        available = ~np.isnan(self.templates[fi]).any(axis=-1)
+        li = _nearest(self.levels, series.levels)
+        if available.any():
+            a = np.flatnonzero(available)
+            li_template = a[_nearest(self.levels[a], series.levels)]
+        else:
+            return fi, li, np.full(len(li), np.nan)
+
+        y = _normalize(series.get_signal())
+        y = interpolate.interp1d(series.x, y, axis=-1, bounds_error=False,
+                                 fill_value=0)(self.time)
+        y = _normalize(y)
+        t = self.templates[fi, li_template]
+
+        n = len(self.time)
+        n_lag = int(round(max_lag / np.mean(np.diff(self.time))))
+        nfft = fft.next_fast_len(2 * n - 1)
+        c = fft.irfft(fft.rfft(y, nfft) * np.conj(fft.rfft(t, nfft)), nfft)
+        c = np.concatenate((c[:, nfft-n_lag:], c[:, :n_lag+1]), axis=-1)
+        lag = (c.argmax(axis=-1) - n_lag) * np.mean(np.diff(self.time))
+        return fi, li, lag
+
+    def get_latencies(self, series, waves, default=None, max_lag=0.5):
+        '''
+        Return latency priors for each level in the series
+
+        Parameters
+        ----------
+        series : ABRSeries
+            Series to generate priors for.
+        waves : list of int
+            Waves to generate priors for.
+        default : {None, dict}
+            Priors (keyed by wave) to use when the model does not have any
+            information for the wave at that frequency and level.
+        max_lag : float
+            Maximum lag (msec) between the template and waveform.
+
+        Returns
+        -------
+        latencies : dict
+            Dictionary mapping level to the priors (keyed by wave) for that
+            level.
+        '''
+        if default is None:
+            default = {}
+        fi, li, lag = self.get_lags(series, max_lag)
+        lag = np.nan_to_num(lag)
+        mean = self.latency_mean[fi, li]
+        sd = np.fmax(np.nan_to_num(self.latency_sd[fi, li], nan=0.25), 0.1)
+        latencies = {}
+        for i, level in enumerate(series.levels):
+            level_priors = {}
+            for w in waves:
+                m = mean[i, w - 1]
+                if np.isfinite(m):
+                    level_priors[w] = priors.norm(m + lag[i], sd[i, w - 1])
+                elif w in default:
+                    level_priors[w] = default[w]
+            latencies[level] = level_priors
+        return latencies
+
+    def guess(self, series, latencies, invert=False):
+        '''
+        Guess peaks for each waveform in the series
+
+        Parameters
+        ----------
+        series : ABRSeries
+            Series to guess.
+        latencies : dict
+            Default priors (keyed by wave). Priors are generated for the waves
+            in this dictionary.
+        invert : bool
+            If True, guess valleys instead of peaks.
+
+        Returns
+        -------
+        guesses : dict
+            Dictionary mapping level to the guesses for that level (see
+            `abr.peakdetect.guess`).
+        '''
+        level_latencies = self.get_latencies(series, list(latencies),
+                                             latencies)
+        guesses = {}
+        for w in series.waveforms:
+            metrics = get_candidates(w, invert=invert)
+            guesses[w.level] = guess_peaks(metrics, level_latencies[w.level])
+        return guesses
@@ -0,0 +1,175 @@
+'''
+Automated threshold estimation
+
+The response metric is computed for all levels of a series at once from the
+level x time signal matrix. A sigmoidal level-growth function is then fit to
+the metric and threshold is the lowest tested level at which the fitted
+function meets the criterion.
+'''
+import numpy as np
+from scipy import fft, optimize
+
+
+def rms(x, axis=-1):
+    return np.sqrt(np.mean(x ** 2, axis=axis))
+
+
+def _normalize(signal):
+    signal = signal - signal.mean(axis=-1, keepdims=True)
+    norm = np.linalg.norm(signal, axis=-1, keepdims=True)
+    norm[norm == 0] = 1
+    return signal / norm
+
+
+def adjacent_xcorr(x, signal, window=(0, 8.5), max_lag=0.5):
+    '''
+    Peak cross-correlation between waveforms at adjacent levels
+
+    Parameters
+    ----------
+    x : array
+        Time (msec) of each sample.
+    signal : array
+        Level x time matrix, sorted in ascending order by level. May have
+        additional leading dimensions (e.g., bootstrap replicates).
+    window : tuple of float
+        Time window (msec) to use for the correlation.
+    max_lag : float
+        Maximum lag (msec) to search for the peak of the correlation. This
+        allows for the shift in latency with level.
+
+    Returns
+    -------
+    r : array
+        Correlation for each level. Each level is correlated with the next
+        highest level (the highest level uses the correlation with the level
+        below it).
+    '''
+    lb, ub = window
+    mask = (x >= lb) & (x <= ub)
+    s = _normalize(signal[..., mask])
+    n = s.shape[-1]
+    n_lag = int(round(max_lag / np.mean(np.diff(x))))
+    nfft = fft.next_fast_len(2 * n - 1)
+    s_fft = fft.rfft(s, nfft, axis=-1)
+    c = fft.irfft(s_fft[..., 1:, :] * np.conj(s_fft[..., :-1, :]), nfft,
+                  axis=-1)
+    c = np.concatenate((c[..., nfft-n_lag:], c[..., :n_lag+1]), axis=-1)
+    r = c.max(axis=-1)
+    return np.concatenate((r, r[..., -1:]), axis=-1)
+
+
+def response_rms_ratio(x, signal, window=(1, 7), noise_window=None):
+    '''
+    Ratio of the RMS in the response window to the RMS of the noise
+
+    If `noise_window` is None, the response window of the lowest level is used
+    as the estimate of the noise.
+    '''
+    lb, ub = window
+    mask = (x >= lb) & (x <= ub)
+    response = rms(signal[..., mask])
+    if noise_window is None:
+        noise = response[..., :1]
+    else:
+        lb, ub = noise_window
+        mask = (x >= lb) & (x <= ub)
+        noise = rms(signal[..., mask])
+    return response / noise
+
+
+def sigmoid(level, lower, upper, midpoint, slope):
+    return lower + (upper - lower) / (1 + np.exp(-(level - midpoint) / slope))
+
+
+def fit_threshold(levels, metric, criterion):
+    '''
+    Fit level-growth function to metric and find threshold
+
+    Parameters
+    ----------
+    levels : array
+        Stimulus levels, sorted in ascending order.
+    metric : array
+        Response metric for each level.
+    criterion : float
+        Value of metric that defines threshold.
+
+    Returns
+    -------
+    threshold : float
+        Lowest level at which the fitted function meets the criterion. This is
+        inf if no level meets the criterion (all levels are subthreshold) and
+        NaN if the fit fails.
+    confidence : float
+        Coefficient of determination (0 to 1) of the fit.
+    '''
+    levels = np.asarray(levels, dtype=float)
+    metric = np.asarray(metric, dtype=float)
+    valid = np.isfinite(metric)
+    levels, metric = levels[valid], metric[valid]
+    if len(levels) < 4:
+        return np.nan, 0.0
+
+    step = np.median(np.diff(levels))
+    p0 = [metric.min(), metric.max(), np.median(levels), step]
+    bounds = ([-np.inf, -np.inf, levels[0] - 10 * step, step * 0.1],
+              [np.inf, np.inf, levels[-1] + 10 * step, np.ptp(levels)])
+    try:
+        p, _ = optimize.curve_fit(sigmoid, levels, metric, p0=p0,
+                                  bounds=bounds, maxfev=2000)
+    except (RuntimeError, ValueError):
+        return np.nan, 0.0
+
+    predicted = sigmoid(levels, *p)
+    ss_res = np.sum((metric - predicted) ** 2)
+    ss_tot = np.sum((metric - metric.mean()) ** 2)
+    confidence = 1 - ss_res / ss_tot if ss_tot > 0 else 0.0
+    confidence = float(np.clip(confidence, 0, 1))
+
+    above = levels[predicted >= criterion]
+    threshold = above[0] if len(above) else np.inf
+    return float(threshold), confidence
+
+
+METRICS = {
+    'xcorr': (adjacent_xcorr, 0.35),
+    'rms': (response_rms_ratio, 2.0),
+}
+
+
+def estimate_threshold(levels, x, signal, metric='xcorr', criterion=None,
+                       **kwargs):
+    '''
+    Estimate threshold of a series
+
+    Parameters
+    ----------
+    levels : array
+        Stimulus levels, sorted in ascending order.
+    x : array
+        Time (msec) of each sample.
+    signal : 2D array
+        Level x time matrix.
+    metric : {'xcorr', 'rms'}
+        Response metric. `xcorr` is the peak cross-correlation between adjacent
+        levels and `rms` is the ratio of the RMS in the response window to the
+        RMS of the noise.
+    criterion : {None, float}
+        Criterion for threshold. If None, the default for the metric is used
+        (0.35 for `xcorr` and 2 for `rms`).
+    **kwargs
+        Passed to the metric function.
+
+    Returns
+    -------
+    threshold : float
+        Estimated threshold (see `fit_threshold`).
+    confidence : float
+        Confidence (0 to 1) in the estimate.
+    '''
+    func, default_criterion = METRICS[metric]
+    if criterion is None:
+        criterion = default_criterion
+    values = func(x, signal, **kwargs)
+    return fit_threshold(levels, values, criterion)
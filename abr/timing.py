@@ -0,0 +1,312 @@
+'''
+Startup timing report and profiling
+
+When enabled (using the `--startup-timing` flag of the command-line tools or
+by setting the `ABR_STARTUP_TIMING` environment variable), the time at which
+each stage of startup is reached is recorded along with the time spent
+importing each module. The report is printed to stderr when the program exits.
+The import times are reported in the same format as `python -X importtime`
+(self and cumulative time of each module, indented by import depth).
+
+Profiling is enabled using the `--profile FILE` flag of the command-line tools
+or by setting the `ABR_PROFILE` environment variable to the name of the file.
+Each timing span (e.g., loading, filtering, peak detection and drawing) is
+written to the file as a JSON record on a separate line that includes the
+dataset being processed (if any). Counters (e.g., cache hits and misses) and a
+summary of the time spent in each span and the slowest datasets are written
+as the final record and printed to stderr on exit.
+'''
+import atexit
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+
+START = time.perf_counter()
+
+enabled = False
+marks = []
+
+
+class _TimedLoader:
+
+    def __init__(self, loader, timer):
+        self.loader = loader
+        self.timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Restore the original loader so that nothing downstream sees the
+        # wrapper (e.g., when loading package resources).
+        module.__loader__ = self.loader
+        module.__spec__.loader = self.loader
+        self.timer.exec_module(self.loader, module)
+
+
+class ImportTimer:
+    '''
+    Meta path finder that records the time spent executing each module
+    '''
+
+    def __init__(self):
+        self.records = []
+        self._local = threading.local()
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(spec.loader, self)
+        return spec
+
+    def exec_module(self, loader, module):
+        stack = self._local.__dict__.setdefault('stack', [])
+        depth = len(stack)
+        stack.append(0)
+        start = time.perf_counter()
+        try:
+            loader.exec_module(module)
+        finally:
+            cumulative = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            self.records.append((module.__name__, depth, cumulative - children,
+                                 cumulative))
+
+
+import_timer = None
+
+
+def enable(imports=True):
+    '''
+    Enable startup timing
+
+    Parameters
+    ----------
+    imports : bool
+        If True, also record the time spent importing each module. Only
+        modules imported after this call are included.
+    '''
+    global enabled, import_timer
+    if enabled:
+        return
+    enabled = True
+    if imports:
+        import_timer = ImportTimer()
+        sys.meta_path.insert(0, import_timer)
+    atexit.register(report)
+
+
+def mark(name):
+    '''
+    Record time (relative to startup) at which stage was reached
+    '''
+    if enabled:
+        marks.append((name, time.perf_counter() - START))
+
+
+def report(file=None, min_time=5e-3):
+    '''
+    Print report
+
+    Parameters
+    ----------
+    file : file-like
+        File to print report to. Defaults to stderr.
+    min_time : float
+        Imports whose cumulative time (sec) is less than this are omitted.
+    '''
+    if file is None:
+        file = sys.stderr
+    print('Startup timing (sec since start)', file=file)
+    for name, t in marks:
+        print(f'{t:10.3f}  {name}', file=file)
+    if import_timer is None:
+        return
+    print('import time: self [us] | cumulative | imported package', file=file)
+    for name, depth, t_self, t_cumulative in import_timer.records:
+        if t_cumulative < min_time:
+            continue
+        print(f'import time: {t_self*1e6:9.0f} | {t_cumulative*1e6:10.0f} | '
+              f'{"  " * depth}{name}', file=file)
+
+
+profile_file = None
+counters = collections.Counter()
+_profile_lock = threading.Lock()
+_span_stats = {}
+_dataset_stats = collections.Counter()
+_counter_providers = {}
+_current_dataset = contextvars.ContextVar('dataset', default=None)
+
+
+def enable_profile(filename):
+    '''
+    Enable profiling
+
+    Parameters
+    ----------
+    filename : {str, Path}
+        File to append the JSONL timing records to.
+    '''
+    global profile_file
+    if profile_file is not None:
+        return
+    profile_file = open(filename, 'a')
+    atexit.register(write_profile_summary)
+
+
+def dataset_label(dataset):
+    return f'{dataset.filename}:{dataset.frequency}'
+
+
+def _write(record):
+    profile_file.write(json.dumps(record) + '\n')
+
+
+@contextlib.contextmanager
+def span(name, dataset=None):
+    '''
+    Time the enclosed block when profiling is enabled
+
+    Parameters
+    ----------
+    name : str
+        Name of span.
+    dataset : {None, Dataset}
+        Dataset being processed. If None, the dataset of the enclosing span
+        (if any) is used.
+    '''
+    if profile_file is None:
+        yield
+        return
+
+    token = None
+    outermost = False
+    if dataset is not None:
+        label = dataset_label(dataset)
+        outermost = _current_dataset.get() != label
+        token = _current_dataset.set(label)
+    label = _current_dataset.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        if token is not None:
+            _current_dataset.reset(token)
+        with _profile_lock:
+            stats = _span_stats.setdefault(name, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            if outermost:
+                # Only the outermost span for the dataset is included in the
+                # total to avoid counting nested spans twice.
+                _dataset_stats[label] += duration
+            _write({
+                'span': name,
+                'dataset': label,
+                'start': start - START,
+                'duration': duration,
+                'thread': threading.current_thread().name,
+            })
+
+
+def timed(name):
+    '''
+    Decorator that times each call to the function when profiling is enabled
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if profile_file is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    '''
+    Increment counter when profiling is enabled
+    '''
+    if profile_file is not None:
+        with _profile_lock:
+            counters[name] += n
+
+
+def register_counters(name, provider):
+    '''
+    Register callable that returns a dictionary of counters to include in the
+    summary (e.g., `functools.lru_cache` statistics)
+    '''
+    _counter_providers[name] = provider
+
+
+def get_profile_summary(n_datasets=10):
+    all_counters = dict(counters)
+    for name, provider in _counter_providers.items():
+        for key, value in provider().items():
+            all_counters[f'{name}.{key}'] = value
+    spans = {n: {'count': c, 'total': t, 'mean': t / c, 'max': m} \
+             for n, (c, t, m) in _span_stats.items()}
+    return {
+        'spans': spans,
+        'counters': all_counters,
+        'slowest_datasets': _dataset_stats.most_common(n_datasets),
+    }
+
+
+def format_profile_summary(summary):
+    lines = [f'{"span":<32}{"count":>8}{"total (s)":>12}{"mean (ms)":>12}'
+             f'{"max (ms)":>12}']
+    spans = sorted(summary['spans'].items(), key=lambda x: -x[1]['total'])
+    for name, s in spans:
+        lines.append(f'{name:<32}{s["count"]:>8}{s["total"]:>12.3f}'
+                     f'{s["mean"]*1e3:>12.2f}{s["max"]*1e3:>12.2f}')
+    if summary['counters']:
+        lines.append('')
+        for name, value in sorted(summary['counters'].items()):
+            lines.append(f'{name:<32}{value:>8}')
+    if summary['slowest_datasets']:
+        lines.append('')
+        lines.append('Slowest datasets (s)')
+        for label, total in summary['slowest_datasets']:
+            lines.append(f'{total:10.3f}  {label}')
+    return '\n'.join(lines)
+
+
+def write_profile_summary(file=None):
+    if file is None:
+        file = sys.stderr
+    summary = get_profile_summary()
+    with _profile_lock:
+        _write({'summary': summary})
+        profile_file.flush()
+    print(format_profile_summary(summary), file=file)
+
+
+if os.environ.get('ABR_STARTUP_TIMING'):
+    enable()
+if os.environ.get('ABR_PROFILE'):
+    enable_profile(os.environ['ABR_PROFILE'])
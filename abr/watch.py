@@ -0,0 +1,314 @@
+'''
+Watch directories and pre-score new recordings as they are acquired
+
+The watcher keeps track of the files under each directory. Once a file that
+completes a recording (e.g., the "ABR average waveforms.csv" file saved by
+psiexperiment at the end of a run, or an EPL/IHS file) has stopped changing,
+each dataset in the recording is loaded, filtered, scored (threshold estimated
+and peaks and valleys guessed) and saved as an analysis by the rater (by
+default, "auto") in a pool of worker processes. Raters can then load the
+pre-scored analysis as a starting point.
+
+A file has stopped changing once its size and modification time are the same
+on two consecutive checks and it has not been modified for `settle` seconds.
+Recordings that cannot be loaded (e.g., because acquisition was still writing
+to the file) are retried up to `max_retries` times.
+
+If watchdog is installed, the watcher is notified of changes by the operating
+system. Otherwise, the directories are polled.
+'''
+import logging
+log = logging.getLogger(__name__)
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import os
+from pathlib import Path
+import threading
+import time
+
+import numpy as np
+
+from .parsers import Parser, registry
+
+
+PSI_AVERAGE_SUFFIX = 'ABR average waveforms.csv'
+
+
+def score_dataset(file_format, filter_settings, rater, dataset, latencies,
+                  guesser=None, auto_threshold=True):
+    '''
+    Load, score and save analysis of dataset
+
+    Returns
+    -------
+    filename : {None, str}
+        Name of analysis file. None if the threshold could not be estimated,
+        in which case the analysis is not saved so that the dataset is left
+        for the rater. If all levels are subthreshold, the threshold is saved
+        as inf.
+    '''
+    parser = Parser(file_format, filter_settings, rater)
+    series = parser.load(dataset)
+    if auto_threshold:
+        threshold, _ = series.estimate_threshold()
+        if np.isnan(threshold):
+            return None
+        series.threshold = threshold
+    if latencies:
+        series.guess_p(latencies, guesser)
+        series.guess_n()
+    parser.save(series)
+    return dataset.get_analyzed_filename(rater)
+
+
+def _walk(path):
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            yield os.path.join(root, filename)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+class Watcher:
+    '''
+    Parameters
+    ----------
+    parser : Parser
+        Parser used to load and save the datasets. The rater must be set.
+    paths : list
+        Directories to watch.
+    latencies : dict
+        Latency priors keyed by wave (see `ABRSeries.guess_p`). If empty, only
+        the threshold is estimated.
+    guesser : {None, TemplateGuesser}
+        If provided, used to guess the peaks.
+    auto_threshold : bool
+        If True, estimate threshold.
+    settle : float
+        Time (sec) a file must remain unchanged before it is loaded.
+    poll_interval : float
+        Time (sec) between checks.
+    max_workers : {None, int}
+        Number of worker processes. No more than this many datasets are
+        scored at once.
+    max_retries : int
+        Number of times to retry a recording that could not be loaded.
+    existing : bool
+        If True, score recordings that are already present (and not yet
+        analyzed by the rater) when the watcher is started.
+    polling : bool
+        If True, poll even if watchdog is available.
+    '''
+
+    def __init__(self, parser, paths, latencies, guesser=None,
+                 auto_threshold=True, settle=5, poll_interval=1,
+                 max_workers=None, max_retries=3, existing=True,
+                 polling=False):
+        if parser._rater is None:
+            raise ValueError('Rater must be set')
+        self.parser = parser
+        self.paths = [Path(p) for p in paths]
+        self.latencies = latencies
+        self.guesser = guesser
+        self.auto_threshold = auto_threshold
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.max_workers = max_workers or os.cpu_count()
+        self.max_retries = max_retries
+        self.existing = existing
+        self.polling = polling
+
+        # Last stat of each file seen.
+        self._known = {}
+        # Files that have changed and have not yet settled.
+        self._changed = {}
+        # Files reported by watchdog since the last check.
+        self._events = set()
+        self._events_lock = threading.Lock()
+        # Datasets waiting to be scored. Files that failed are retried after
+        # a delay that increases with the number of attempts.
+        self._pending = deque()
+        self._attempts = {}
+        self._retry_time = {}
+        self._futures = {}
+
+    ############################################################################
+    # Change detection
+    ############################################################################
+    def _start_observer(self):
+        if self.polling:
+            return None
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            log.info('watchdog not installed. Polling for changes.')
+            return None
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+
+            def on_any_event(self, event):
+                if event.is_directory:
+                    return
+                paths = [event.src_path, getattr(event, 'dest_path', '')]
+                with watcher._events_lock:
+                    watcher._events.update(p for p in paths if p)
+
+        observer = Observer()
+        for path in self.paths:
+            observer.schedule(Handler(), str(path), recursive=True)
+        observer.start()
+        return observer
+
+    def _get_candidates(self, observer):
+        if observer is None:
+            for path in self.paths:
+                yield from _walk(path)
+        else:
+            with self._events_lock:
+                events, self._events = self._events, set()
+            yield from events
+        # Files that have not yet settled are checked on every pass.
+        yield from list(self._changed)
+
+    def check(self, observer=None):
+        '''
+        Check for files that have changed and queue the datasets in files that
+        have settled
+        '''
+        now = time.time()
+        for filename in set(self._get_candidates(observer)):
+            stat = _stat(filename)
+            if stat is None:
+                self._known.pop(filename, None)
+                self._changed.pop(filename, None)
+                continue
+            if self._known.get(filename) == stat:
+                if filename in self._changed \
+                        and (now - stat[1]) >= self.settle \
+                        and now >= self._retry_time.get(filename, 0):
+                    del self._changed[filename]
+                    self.queue_recording(Path(filename))
+                continue
+            self._known[filename] = stat
+            self._changed[filename] = stat
+            # Give files that have been rewritten a fresh set of attempts.
+            self._attempts.pop(filename, None)
+            self._retry_time.pop(filename, None)
+
+    def _get_recording(self, filename):
+        '''
+        Return path to pass to `Parser.iter_all` if file completes a recording
+        '''
+        formats = None if self.parser._file_format is None \
+            else [self.parser._file_format]
+        if registry.detect(filename, formats) is not None:
+            return filename
+        if filename.name.endswith(PSI_AVERAGE_SUFFIX) and \
+                registry.detect(filename.parent, formats) is not None:
+            return filename.parent
+        return None
+
+    def queue_recording(self, filename):
+        path = self._get_recording(filename)
+        if path is None:
+            return
+        try:
+            datasets = list(self.parser.iter_all(path))
+        except Exception as e:
+            log.warning('Could not read %s: %s', path, e)
+            self._retry(filename)
+            return
+        for ds in datasets:
+            if ds in self._futures.values() or ds in self._pending:
+                continue
+            if Path(ds.get_analyzed_filename(self.parser._rater)).exists():
+                continue
+            self._pending.append(ds)
+
+    def _retry(self, filename):
+        n = self._attempts.get(filename, 0) + 1
+        self._attempts[filename] = n
+        if n < self.max_retries:
+            self._changed[filename] = self._known.get(filename)
+            self._retry_time[filename] = time.time() + self.settle * n
+        else:
+            log.error('Giving up on %s', filename)
+
+    ############################################################################
+    # Scoring
+    ############################################################################
+    def dispatch(self, executor):
+        while self._pending and len(self._futures) < self.max_workers:
+            ds = self._pending.popleft()
+            future = executor.submit(score_dataset, self.parser._file_format,
+                                     self.parser._filter_settings,
+                                     self.parser._rater, ds, self.latencies,
+                                     self.guesser, self.auto_threshold)
+            self._futures[future] = ds
+
+    def collect(self, timeout=0):
+        if not self._futures:
+            return
+        done, _ = wait(self._futures, timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            ds = self._futures.pop(future)
+            try:
+                filename = future.result()
+            except Exception as e:
+                log.warning('Could not score %s (%.0f Hz): %s', ds.filename,
+                            ds.frequency, e)
+                self._retry(str(ds.filename))
+                continue
+            if filename is None:
+                log.warning('Could not estimate threshold for %s (%.0f Hz). '
+                            'Not saved.', ds.filename, ds.frequency)
+            else:
+                log.info('Saved %s', filename)
+
+    def run(self, stop=None):
+        '''
+        Watch directories until stop is set
+
+        Parameters
+        ----------
+        stop : {None, threading.Event}
+            If None, runs until interrupted.
+        '''
+        if stop is None:
+            stop = threading.Event()
+
+        # Record the files that are already present.
+        for path in self.paths:
+            for filename in _walk(path):
+                stat = _stat(filename)
+                if stat is not None:
+                    self._known[filename] = stat
+                    if self.existing:
+                        self._changed[filename] = stat
+
+        observer = self._start_observer()
+        try:
+            with ProcessPoolExecutor(self.max_workers) as executor:
+                while not stop.is_set():
+                    self.check(observer)
+                    self.dispatch(executor)
+                    if self._futures:
+                        self.collect(self.poll_interval)
+                    else:
+                        stop.wait(self.poll_interval)
+                while self._futures:
+                    self.collect(None)
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
@@ -0,0 +1,381 @@
+'''
+Work queue for batch mode
+
+The queue determines the order in which unprocessed datasets are presented to
+the rater and hands out leases so that raters working on the same share at the
+same time (e.g., from different computers) do not analyze the same dataset.
+
+A lease is a small file (see `Dataset.get_lock_filename`) that is created
+next to the analysis files. Creating the file uses `O_CREAT | O_EXCL`, so only
+one rater can hold the lease for a dataset. Leases expire after `lease_time`
+seconds (in case the program crashed or the computer was turned off before the
+lease was released) and are renewed by the batch window while the rater is
+working on the dataset. Since expiration is based on the clock of each
+computer, the clocks should be reasonably in sync. Each work queue has its own
+session ID, so a lease can only be resumed by the session that holds it (two
+windows opened by the same rater on the same computer do not share leases).
+
+The ordered list of datasets can be saved to a queue file. If the queue file
+exists, it is used instead of scanning the directories. Datasets that have
+been analyzed since the queue file was created are dropped when it is loaded.
+The queue file is JSON (the class and constructor arguments of each dataset)
+so that it can be shared by raters running different versions. If it cannot be
+read, the directories are scanned and the file is rewritten.
+'''
+import logging
+log = logging.getLogger(__name__)
+
+import importlib
+import json
+import os
+from pathlib import Path
+import random
+import socket
+import time
+import uuid
+
+import numpy as np
+
+
+ORDER = {
+    'scan': 'Order in which datasets were found',
+    'shuffle': 'Random order',
+    'frequency': 'By frequency, then by filename',
+    'collection': 'By filename, then by frequency',
+}
+
+
+QUEUE_FILE_VERSION = 1
+
+
+def _get_class_name(obj):
+    return f'{type(obj).__module__}:{type(obj).__qualname__}'
+
+
+def _get_class(name):
+    module, qualname = name.split(':')
+    obj = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def dump_dataset(dataset):
+    '''
+    Return JSON-serializable description of dataset
+    '''
+    state = {k: str(v) if isinstance(v, Path) else v \
+             for k, v in dataset.parent.__getstate__().items()}
+    frequency = dataset.frequency
+    return {
+        'dataset': _get_class_name(dataset),
+        'collection': _get_class_name(dataset.parent),
+        'state': state,
+        'frequency': float(frequency),
+        # Restore the original type since datasets compare by frequency.
+        'frequency_dtype': np.asarray(frequency).dtype.str,
+    }
+
+
+def load_dataset(info):
+    '''
+    Create dataset from description returned by `dump_dataset`
+    '''
+    collection_class = _get_class(info['collection'])
+    collection = collection_class.__new__(collection_class)
+    state = dict(info['state'])
+    state['filename'] = Path(state['filename'])
+    collection.__dict__.update(state)
+    frequency = np.dtype(info['frequency_dtype']).type(info['frequency'])
+    return _get_class(info['dataset'])(collection, frequency)
+
+
+def order_datasets(datasets, order='scan', seed=None):
+    '''
+    Sort datasets
+
+    Parameters
+    ----------
+    datasets : list of Dataset
+        Datasets to sort.
+    order : {'scan', 'shuffle', 'frequency', 'collection'}
+        Order (see `ORDER`).
+    seed : {None, int}
+        Seed for the random number generator when shuffling.
+    '''
+    datasets = list(datasets)
+    if order == 'scan':
+        return datasets
+    elif order == 'shuffle':
+        random.Random(seed).shuffle(datasets)
+        return datasets
+    elif order == 'frequency':
+        return sorted(datasets, key=lambda d: (d.frequency, d.filename))
+    elif order == 'collection':
+        return sorted(datasets, key=lambda d: (d.filename, d.frequency))
+    raise ValueError(f'Unsupported order {order}')
+
+
+class WorkQueue:
+    '''
+    Parameters
+    ----------
+    parser : Parser
+        Parser used to find the unprocessed datasets.
+    paths : list
+        Directories to scan.
+    order : {'scan', 'shuffle', 'frequency', 'collection'}
+        Order to present the datasets in (see `ORDER`).
+    seed : {None, int}
+        Seed for the random number generator when shuffling.
+    queue_file : {None, str, Path}
+        If provided, the ordered queue is saved to this file. If the file
+        already exists, the queue is loaded from it rather than scanning the
+        directories.
+    lease_time : float
+        Time (sec) until a lease expires.
+    locking : bool
+        If False, leases are not used.
+    '''
+
+    def __init__(self, parser, paths, order='scan', seed=None,
+                 queue_file=None, lease_time=3600, locking=True):
+        if order not in ORDER:
+            raise ValueError(f'Unsupported order {order}')
+        self.parser = parser
+        self.paths = paths
+        self.order = order
+        self.seed = seed
+        self.queue_file = None if queue_file is None else Path(queue_file)
+        self.lease_time = lease_time
+        self.locking = locking
+        self.owner = f'{parser._rater}@{socket.gethostname()}'
+        self.session = uuid.uuid4().hex
+
+    def is_processed(self, dataset):
+        return Path(dataset.get_analyzed_filename(self.parser._rater)).exists()
+
+    def iter_pending(self, stop=None):
+        '''
+        Iterate through the unprocessed datasets in order
+
+        Parameters
+        ----------
+        stop : {None, threading.Event}
+            If set, scanning stops.
+        '''
+        datasets = self.read_queue_file()
+        if datasets is not None:
+            for ds in datasets:
+                if stop is not None and stop.is_set():
+                    break
+                if not self.is_processed(ds):
+                    yield ds
+            return
+
+        datasets = []
+        for path in self.paths:
+            for ds in self.parser.find_unprocessed(path):
+                if stop is not None and stop.is_set():
+                    return
+                datasets.append(ds)
+                # Datasets can be handed out as they are found unless they
+                # need to be sorted first.
+                if self.order == 'scan':
+                    yield ds
+
+        if self.order != 'scan':
+            datasets = order_datasets(datasets, self.order, self.seed)
+
+        if self.queue_file is not None:
+            self.write_queue_file(datasets)
+
+        if self.order != 'scan':
+            yield from datasets
+
+    def read_queue_file(self):
+        '''
+        Return datasets in queue file (None if there is no queue file or it
+        cannot be read)
+        '''
+        if self.queue_file is None or not self.queue_file.exists():
+            return None
+        try:
+            content = json.loads(self.queue_file.read_text())
+            if content['version'] > QUEUE_FILE_VERSION:
+                raise ValueError('Queue file was created by a newer version')
+            return [load_dataset(info) for info in content['datasets']]
+        except Exception as e:
+            log.warning('Could not read queue file %s (%s). Scanning '
+                        'directories instead.', self.queue_file, e)
+            return None
+
+    def write_queue_file(self, datasets):
+        content = {
+            'version': QUEUE_FILE_VERSION,
+            'datasets': [dump_dataset(ds) for ds in datasets],
+        }
+        # Write to a temporary file first so that other raters never see a
+        # partially written queue.
+        path = self.queue_file
+        tmp = path.with_name(f'{path.name}.{uuid.uuid4().hex}')
+        tmp.write_text(json.dumps(content, indent=1))
+        os.replace(tmp, path)
+
+    def _read_lease(self, path):
+        '''
+        Return session and expiration time of the lease
+        '''
+        try:
+            lease = json.loads(path.read_text())
+            return lease['session'], lease['expires']
+        except FileNotFoundError:
+            raise
+        except Exception:
+            # The lease is being written (or the program crashed while writing
+            # it). Fall back to the modification time.
+            return None, path.stat().st_mtime + self.lease_time
+
+    def _lease_content(self):
+        return json.dumps({
+            'owner': self.owner,
+            'session': self.session,
+            'expires': time.time() + self.lease_time,
+        })
+
+    def claim(self, dataset, processed=False):
+        '''
+        Claim dataset
+
+        Parameters
+        ----------
+        dataset : Dataset
+            Dataset to claim.
+        processed : bool
+            If True, datasets that have already been analyzed can be claimed
+            (e.g., when the rater goes back to revise an analysis).
+
+        Returns
+        -------
+        claimed : bool
+            False if another rater holds the lease for the dataset or (unless
+            `processed` is True) the dataset has already been analyzed.
+        '''
+        if not processed and self.is_processed(dataset):
+            return False
+        if not self.locking:
+            return True
+
+        path = Path(dataset.get_lock_filename())
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    lease = self._read_lease(path)
+                except FileNotFoundError:
+                    continue
+                session, expires = lease
+                if session != self.session and expires > time.time():
+                    return False
+
+                # Either the lease has expired or this session already holds
+                # it. Move the lease aside before removing it. Only one
+                # rater can succeed with the rename.
+                stale = path.with_name(f'{path.name}.{uuid.uuid4().hex}')
+                try:
+                    os.rename(path, stale)
+                except FileNotFoundError:
+                    continue
+                try:
+                    if self._read_lease(stale) != lease:
+                        # Another rater replaced the lease between the read
+                        # and the rename. Put it back.
+                        os.link(stale, path)
+                        return False
+                except OSError:
+                    return False
+                finally:
+                    stale.unlink()
+                continue
+
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(self._lease_content())
+            # The dataset may have been analyzed by another rater (that shares
+            # the same name) before we created the lease.
+            if not processed and self.is_processed(dataset):
+                self.release(dataset)
+                return False
+            return True
+        return False
+
+    def owns(self, dataset):
+        try:
+            session, _ = self._read_lease(Path(dataset.get_lock_filename()))
+        except FileNotFoundError:
+            return False
+        return session == self.session
+
+    def _take_lease(self, path):
+        '''
+        Move the lease aside if it is held by this session
+
+        Returns the new name of the lease (None if this session does not hold
+        the lease, in which case the lease is left in place). Since only one
+        rater can succeed with the rename, the lease cannot be replaced by
+        another rater between checking the session and acting on the lease.
+        '''
+        aside = path.with_name(f'{path.name}.{uuid.uuid4().hex}')
+        try:
+            os.rename(path, aside)
+        except FileNotFoundError:
+            return None
+        try:
+            session, _ = self._read_lease(aside)
+        except OSError:
+            session = None
+        if session == self.session:
+            return aside
+        # Put back the lease of the other rater (unless a new lease was
+        # created in the meantime).
+        try:
+            os.link(aside, path)
+        except OSError:
+            pass
+        aside.unlink()
+        return None
+
+    def renew(self, dataset):
+        '''
+        Extend lease on dataset
+
+        Returns
+        -------
+        renewed : bool
+            False if this session no longer holds the lease.
+        '''
+        if not self.locking:
+            return True
+        path = Path(dataset.get_lock_filename())
+        aside = self._take_lease(path)
+        if aside is None:
+            return False
+        try:
+            aside.write_text(self._lease_content())
+            # Fails if another rater created a lease while ours was aside.
+            os.link(aside, path)
+            return True
+        except OSError:
+            return False
+        finally:
+            aside.unlink()
+
+    def release(self, dataset):
+        '''
+        Release lease on dataset
+        '''
+        if not self.locking:
+            return
+        aside = self._take_lease(Path(dataset.get_lock_filename()))
+        if aside is not None:
+            aside.unlink()